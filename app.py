@@ -121,6 +121,9 @@ def delete_chat_history(chat_id: str):
     try:
         if os.path.exists(file_path):
             os.remove(file_path)
+        # 同时清除该对话的历史摘要缓存
+        if st.session_state.rag_agent:
+            st.session_state.rag_agent.history_manager.forget(chat_id)
         return True
     except Exception as e:
         st.error(f"删除对话失败: {e}")
@@ -580,10 +583,12 @@ def main():
                             # 使用TextSplitter进行分块
                             chunks = splitter.split_documents(raw_docs)
 
-                            # 添加到向量数据库
+                            # 按确定性 ID 写入向量数据库：重复上传同一文件不会产生重复块，文件更新后旧块会被替换
                             if chunks:
-                                success = st.session_state.rag_agent.vector_store.add_documents_incremental(chunks)
-                                if success:
+                                failed_ids = st.session_state.rag_agent.vector_store.upsert_documents(
+                                    chunks, replace_sources=True
+                                )
+                                if not failed_ids:
                                     total_chunks += len(chunks)
                                     print(f"成功添加 {len(chunks)} 个块到知识库")
                                 else:
@@ -785,57 +790,60 @@ def main():
         # 生成回答
         with chat_container:
             with st.chat_message("assistant"):
-                with st.spinner("🤔 正在思考..." if not has_image else "🖼️ 正在分析图片..."):
-                    try:
+                try:
+                    # 图片分析与检索期间显示加载状态，回答生成阶段逐字流式输出
+                    with st.spinner("🤔 正在思考..." if not has_image else "🖼️ 正在分析图片..."):
                         if has_image:
                             # 图片问答模式 - 使用高质量图片进行AI分析
                             image_base64 = process_uploaded_image(uploaded_file, for_history=False)
-                            answer = st.session_state.rag_agent.answer_image_question(
+                            answer_stream = st.session_state.rag_agent.answer_image_question_stream(
                                 query=prompt,
                                 image_base64=image_base64,
-                                chat_history=st.session_state.chat_history[:-1]  # 不包含当前问题
+                                chat_history=st.session_state.chat_history[:-1],  # 不包含当前问题
+                                chat_id=st.session_state.current_chat_id
                             )
                         else:
                             # 普通文本问答
-                            answer = st.session_state.rag_agent.answer_question(
+                            answer_stream = st.session_state.rag_agent.answer_question_stream(
                                 prompt,
-                                chat_history=st.session_state.chat_history[:-1]  # 不包含当前问题
+                                chat_history=st.session_state.chat_history[:-1],  # 不包含当前问题
+                                chat_id=st.session_state.current_chat_id
                             )
 
-                        st.write(answer)
+                    answer = st.write_stream(answer_stream)
 
-                        # 添加助手消息到历史
-                        st.session_state.chat_history.append({"role": "assistant", "content": answer})
-
-                        # 自动保存对话历史
-                        if st.session_state.current_chat_id:
-                            save_chat_history(
-                                st.session_state.current_chat_id,
-                                st.session_state.chat_history
-                            )
-                            # 刷新对话列表
-                            st.session_state.chat_list = load_chat_list()
+                    # 添加助手消息到历史
+                    st.session_state.chat_history.append({"role": "assistant", "content": answer})
 
-                        # 清空图片上传区域并强制重新渲染
-                        st.session_state.upload_counter += 1
-                        st.rerun()  # 强制重新渲染页面，清空所有UI元素
+                    # 自动保存对话历史
+                    if st.session_state.current_chat_id:
+                        save_chat_history(
+                            st.session_state.current_chat_id,
+                            st.session_state.chat_history
+                        )
+                        # 刷新对话列表
+                        st.session_state.chat_list = load_chat_list()
 
-                    except Exception as e:
-                        error_msg = f"❌ 回答生成失败: {str(e)}"
-                        st.error(error_msg)
-                        st.session_state.chat_history.append({"role": "assistant", "content": error_msg})
+                    # 清空图片上传区域并强制重新渲染
+                    st.session_state.upload_counter += 1
+                    st.rerun()  # 强制重新渲染页面，清空所有UI元素
 
-                        # 即使出错也要保存对话历史
-                        if st.session_state.current_chat_id:
-                            save_chat_history(
-                                st.session_state.current_chat_id,
-                                st.session_state.chat_history,
-                                "对话出错"
-                            )
+                except Exception as e:
+                    error_msg = f"❌ 回答生成失败: {str(e)}"
+                    st.error(error_msg)
+                    st.session_state.chat_history.append({"role": "assistant", "content": error_msg})
+
+                    # 即使出错也要保存对话历史
+                    if st.session_state.current_chat_id:
+                        save_chat_history(
+                            st.session_state.current_chat_id,
+                            st.session_state.chat_history,
+                            "对话出错"
+                        )
 
-                        # 即使出错也要清空图片上传区域并强制重新渲染
-                        st.session_state.upload_counter += 1
-                        st.rerun()  # 强制重新渲染页面，清空所有UI元素
+                    # 即使出错也要清空图片上传区域并强制重新渲染
+                    st.session_state.upload_counter += 1
+                    st.rerun()  # 强制重新渲染页面，清空所有UI元素
 
 
 def display_quiz_section():
@@ -0,0 +1,316 @@
+"""
+异步 RAG Agent
+与 RAGAgent 提供相同的问答流程，接口均为协程，适合在一个事件循环中同时服务多个学生：
+- 查询改写、LLM 路由与回答生成使用共享的 AsyncOpenAI 客户端，等待模型时不占用线程；
+- 查询改写与原始查询的推测检索并发执行（asyncio.gather）；
+- ChromaDB / BM25 检索（混合检索内部两路并发）、工具调用、图片分析等同步操作通过 asyncio.to_thread 执行。
+提示词、上下文打包、对话历史处理等逻辑与 RAGAgent 共用。
+多个学生共用同一个对话摘要缓存，因此问答入口必须传入 chat_id 以区分各自的对话。
+"""
+
+import asyncio
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from client_factory import get_async_openai_client
+from rag_agent import RAGAgent
+from config import (
+    MODEL_NAME,
+    TOP_K,
+    MAX_TOKENS,
+    DEFAULT_RETRIEVAL_STRATEGY,
+    RETRIEVAL_PIPELINE_ENABLED,
+    REWRITE_SIMILARITY_THRESHOLD,
+)
+
+NO_CONTEXT = "（未检索到特别相关的课程材料）"
+
+
+class AsyncRAGAgent:
+    """RAGAgent 的异步版本，内部复用一个 RAGAgent 的向量库、路由器、工具与提示词"""
+
+    def __init__(self, model: str = MODEL_NAME, agent: Optional[RAGAgent] = None):
+        self.agent = agent or RAGAgent(model=model)
+        self.model = self.agent.model
+
+    @property
+    def client(self):
+        # 异步客户端按事件循环共享，每次使用时获取当前循环对应的实例
+        return get_async_openai_client()
+
+    # ---------- 检索 ----------
+
+    async def _construct_search_query(self, current_query: str, chat_history: Optional[List[Dict]] = None) -> str:
+        """使用对话历史改写检索查询，无需改写或失败时返回原始查询"""
+        prompt = self.agent._rewrite_prompt(current_query, chat_history)
+        if prompt is None:
+            return current_query
+        try:
+            response = await self.client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.0,
+                max_tokens=200
+            )
+            enhanced_query = response.choices[0].message.content.strip().replace('"', '')
+            print(f"🔄 多轮对话增强查询: {enhanced_query}")
+            return enhanced_query
+        except Exception as e:
+            print(f"❌ 多轮查询增强失败 ({e})，使用原始查询。")
+            return current_query
+
+    async def _route_query(self, query: str) -> str:
+        heuristic, features = self.agent.query_router.route(query)
+        if self.agent.router_mode != "llm":
+            self.agent.query_router.log_decision(query, heuristic, features, mode="heuristic", heuristic=heuristic)
+            return heuristic
+
+        try:
+            response = await self.client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "user", "content": self.agent._route_prompt(query)}],
+                temperature=0.0,
+                max_tokens=10
+            )
+            llm_decision = response.choices[0].message.content.strip().upper().replace('"', '')
+        except Exception:
+            llm_decision = DEFAULT_RETRIEVAL_STRATEGY
+        return self.agent._resolve_llm_route(query, heuristic, features, llm_decision)
+
+    async def _route_and_retrieve(self, search_query: str, top_k: int) -> List[Dict]:
+        """选择策略并检索；检索本身（Embedding、ChromaDB、BM25）在线程中执行"""
+        if not self.agent.enable_advanced_rag:
+            query_type = "DENSE"
+        else:
+            query_type = await self._route_query(search_query)
+            print(f"⚙️ 异步检索 | 路由模式: {self.agent.router_mode} | 检索策略: {query_type}")
+        return await asyncio.to_thread(self.agent._dispatch_retrieval, search_query, query_type, top_k)
+
+    async def retrieve_context(
+        self, query: str, chat_history: Optional[List[Dict]] = None, top_k: int = TOP_K
+    ) -> Tuple[str, List[Dict]]:
+        """检索并打包上下文，返回 (上下文, 实际放入的文档块)"""
+        context, docs, _ = await self.retrieve_context_with_stats(query, chat_history, top_k)
+        return context, docs
+
+    async def retrieve_context_with_stats(
+        self, query: str, chat_history: Optional[List[Dict]] = None, top_k: int = TOP_K
+    ) -> Tuple[str, List[Dict], Dict]:
+        """
+        检索并打包上下文，返回 (上下文, 实际放入的文档块, 打包统计信息)。
+        多个协程共用同一个 RAGAgent，统计信息随结果返回，不写入共享的 agent.last_context_stats。
+        """
+        if RETRIEVAL_PIPELINE_ENABLED and self.agent.enable_advanced_rag and chat_history and len(chat_history) >= 2:
+            # 查询改写与原始查询的推测检索并发执行
+            search_query, speculative_docs = await asyncio.gather(
+                self._construct_search_query(query, chat_history),
+                self._route_and_retrieve(query, top_k),
+            )
+            similarity = self.agent._query_similarity(query, search_query)
+            if similarity >= REWRITE_SIMILARITY_THRESHOLD:
+                print(f"⚡ 改写查询与原始查询相近 (相似度 {similarity:.2f})，直接使用推测检索结果")
+                retrieved_docs = speculative_docs
+            else:
+                print(f"🔁 改写查询差异较大 (相似度 {similarity:.2f})，使用改写查询补充检索: {search_query}")
+                rewritten_docs = await self._route_and_retrieve(search_query, top_k)
+                retrieved_docs = self.agent._merge_retrievals(rewritten_docs, speculative_docs, top_k)
+        else:
+            search_query = await self._construct_search_query(query, chat_history)
+            retrieved_docs = await self._route_and_retrieve(search_query, top_k)
+
+        return self.agent._pack_context_with_stats(retrieved_docs)
+
+    # ---------- 生成 ----------
+
+    async def _build_messages(
+        self, query: str, context: str, chat_history: Optional[List[Dict]], chat_id: Optional[str]
+    ) -> List[Dict]:
+        # 需要更新对话摘要时会调用模型，放到线程中执行
+        return await asyncio.to_thread(self.agent._build_messages, query, context, chat_history, chat_id)
+
+    async def generate_response(
+        self,
+        query: str,
+        context: str,
+        chat_history: Optional[List[Dict]] = None,
+        chat_id: Optional[str] = None,
+    ) -> str:
+        """生成回答"""
+        messages = await self._build_messages(query, context, chat_history, chat_id)
+        try:
+            response = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                tools=self.agent.tool_manager.get_tool_definitions(),
+                tool_choice="auto",
+                temperature=0.7,
+                max_tokens=MAX_TOKENS
+            )
+            response_message = response.choices[0].message
+            if not response_message.tool_calls:
+                return response_message.content
+
+            tool_results = await asyncio.to_thread(self.agent._execute_tool_calls, response_message.tool_calls)
+            messages.append(response_message)
+            messages.extend(tool_results)
+
+            final_response = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=MAX_TOKENS
+            )
+            return final_response.choices[0].message.content
+
+        except Exception as e:
+            return f"生成回答时出错: {str(e)}"
+
+    async def generate_response_stream(
+        self,
+        query: str,
+        context: str,
+        chat_history: Optional[List[Dict]] = None,
+        chat_id: Optional[str] = None,
+    ) -> AsyncIterator[str]:
+        """流式生成回答；模型发起工具调用时执行工具后继续流式输出后续回答"""
+        messages = await self._build_messages(query, context, chat_history, chat_id)
+        try:
+            stream = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                tools=self.agent.tool_manager.get_tool_definitions(),
+                tool_choice="auto",
+                temperature=0.7,
+                max_tokens=MAX_TOKENS,
+                stream=True
+            )
+
+            content_parts = []
+            tool_call_parts: Dict[int, Dict] = {}
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content_parts.append(delta.content)
+                    yield delta.content
+                self.agent._accumulate_tool_call_deltas(tool_call_parts, delta)
+
+            if not tool_call_parts:
+                return
+
+            tool_calls, assistant_message = self.agent._assemble_tool_calls(content_parts, tool_call_parts)
+            tool_results = await asyncio.to_thread(self.agent._execute_tool_calls, tool_calls)
+            messages.append(assistant_message)
+            messages.extend(tool_results)
+
+            final_stream = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=MAX_TOKENS,
+                stream=True
+            )
+            async for chunk in final_stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+        except Exception as e:
+            yield f"生成回答时出错: {str(e)}"
+
+    # ---------- 问答入口 ----------
+
+    @staticmethod
+    def _check_chat_id(chat_id: str) -> None:
+        if not chat_id:
+            raise ValueError("AsyncRAGAgent 的问答入口必须提供 chat_id，以免不同对话共用对话摘要")
+
+    async def answer_question(
+        self,
+        query: str,
+        chat_history: Optional[List[Dict]] = None,
+        top_k: int = TOP_K,
+        *,
+        chat_id: str,
+    ) -> str:
+        """回答问题"""
+        self._check_chat_id(chat_id)
+        # 对话摘要在后台线程中与检索并发更新
+        self.agent.history_manager.prefetch(chat_history, chat_id)
+        context, _ = await self.retrieve_context(query, chat_history=chat_history, top_k=top_k)
+        return await self.generate_response(query, context or NO_CONTEXT, chat_history, chat_id)
+
+    async def answer_question_stream(
+        self,
+        query: str,
+        chat_history: Optional[List[Dict]] = None,
+        top_k: int = TOP_K,
+        *,
+        chat_id: str,
+    ) -> AsyncIterator[str]:
+        """回答问题（流式）：检索完成后逐段产出回答文本"""
+        self._check_chat_id(chat_id)
+        self.agent.history_manager.prefetch(chat_history, chat_id)
+        context, _ = await self.retrieve_context(query, chat_history=chat_history, top_k=top_k)
+        async for text in self.generate_response_stream(query, context or NO_CONTEXT, chat_history, chat_id):
+            yield text
+
+    async def _prepare_image_query(self, query: str, image_base64: str) -> Optional[str]:
+        """分析图片并构造增强查询，分析失败时返回 None"""
+        print("🖼️ 正在分析图片...")
+        image_description = await asyncio.to_thread(self.agent._analyze_image_with_vl, image_base64)
+        if not image_description:
+            return None
+        return self.agent._image_query(query, image_description)
+
+    async def answer_image_question(
+        self,
+        query: str,
+        image_base64: str,
+        chat_history: Optional[List[Dict]] = None,
+        top_k: int = TOP_K,
+        *,
+        chat_id: str,
+    ) -> str:
+        """回答包含图片的问题"""
+        self._check_chat_id(chat_id)
+        try:
+            self.agent.history_manager.prefetch(chat_history, chat_id)
+            enhanced_query = await self._prepare_image_query(query, image_base64)
+            if enhanced_query is None:
+                return "❌ 图片分析失败，请检查图片格式或重试。"
+
+            context, _ = await self.retrieve_context(enhanced_query, chat_history=chat_history, top_k=top_k)
+            return await self.generate_response(enhanced_query, context or NO_CONTEXT, chat_history, chat_id)
+
+        except Exception as e:
+            error_msg = f"图片问答处理失败: {str(e)}"
+            print(f"❌ {error_msg}")
+            return f"❌ {error_msg}"
+
+    async def answer_image_question_stream(
+        self,
+        query: str,
+        image_base64: str,
+        chat_history: Optional[List[Dict]] = None,
+        top_k: int = TOP_K,
+        *,
+        chat_id: str,
+    ) -> AsyncIterator[str]:
+        """回答包含图片的问题（流式）"""
+        self._check_chat_id(chat_id)
+        try:
+            self.agent.history_manager.prefetch(chat_history, chat_id)
+            enhanced_query = await self._prepare_image_query(query, image_base64)
+            if enhanced_query is None:
+                yield "❌ 图片分析失败，请检查图片格式或重试。"
+                return
+
+            context, _ = await self.retrieve_context(enhanced_query, chat_history=chat_history, top_k=top_k)
+        except Exception as e:
+            error_msg = f"图片问答处理失败: {str(e)}"
+            print(f"❌ {error_msg}")
+            yield f"❌ {error_msg}"
+            return
+
+        async for text in self.generate_response_stream(enhanced_query, context or NO_CONTEXT, chat_history, chat_id):
+            yield text
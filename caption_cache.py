@@ -0,0 +1,58 @@
+"""
+图片描述缓存
+以 (图片内容 sha256, VL 模型, 提示词版本) 为键，将 VL 模型生成的图片描述追加保存在 JSONL 文件中，
+重复导入相同的 PDF/PPTX 时无需再次调用 VL 模型。
+"""
+
+import os
+import json
+import hashlib
+import threading
+from typing import Dict, Optional
+
+
+def image_hash(image_bytes: bytes) -> str:
+    """计算图片内容的 sha256"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class CaptionCache:
+    """追加写入的图片描述缓存（JSONL，每行一条记录，后写入的记录覆盖先前的同键记录）"""
+
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, str] = {}
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(digest: str, model: str, prompt_version: str) -> str:
+        return f"{model}|{prompt_version}|{digest}"
+
+    def _load(self) -> None:
+        if not os.path.exists(self.cache_path):
+            return
+        with open(self.cache_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    self._entries[record["key"]] = record["caption"]
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    # 进程中断时可能留下不完整的最后一行，跳过即可
+                    continue
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key: str, caption: str) -> None:
+        if not caption:
+            return
+        with self._lock:
+            self._entries[key] = caption
+            with open(self.cache_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, "caption": caption}, ensure_ascii=False) + "\n")
@@ -0,0 +1,142 @@
+"""
+共享客户端工厂
+进程内每个 (API Key, 接口地址) 只创建一个 OpenAI 客户端，RAGAgent、VectorStore、ImageProcessor、
+工具等组件共用其底层 httpx 连接池，保持长连接复用，避免重复建立 TLS 连接。
+安装了 h2 时启用 HTTP/2。客户端均为线程安全，可在线程池中并发使用。
+异步客户端的连接绑定在创建它的事件循环上，因此按事件循环分别共享。
+"""
+
+import asyncio
+import importlib.util
+import threading
+import weakref
+from typing import Dict, Optional, Tuple
+
+import httpx
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    AsyncOpenAI,
+    OpenAI,
+    RateLimitError,
+)
+
+try:
+    from tavily import TavilyClient
+except ImportError:
+    TavilyClient = None
+
+from config import (
+    OPENAI_API_KEY,
+    OPENAI_API_BASE,
+    TAVILY_API_KEY,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE,
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP2_ENABLED,
+    OPENAI_MAX_RETRIES,
+)
+
+HTTP2_AVAILABLE = HTTP2_ENABLED and importlib.util.find_spec("h2") is not None
+
+_OPENAI_CLIENTS: Dict[Tuple[str, str], OpenAI] = {}
+# 事件循环 -> {(API Key, 接口地址): 异步客户端}，事件循环结束后自动释放
+_ASYNC_OPENAI_CLIENTS: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_TAVILY_CLIENTS: Dict[str, object] = {}
+_LOCK = threading.Lock()
+
+
+def http_timeout() -> httpx.Timeout:
+    """连接超时较短；读取超时需覆盖大模型的长回答与流式输出间隔"""
+    return httpx.Timeout(
+        connect=HTTP_CONNECT_TIMEOUT,
+        read=HTTP_READ_TIMEOUT,
+        write=HTTP_READ_TIMEOUT,
+        pool=HTTP_CONNECT_TIMEOUT,
+    )
+
+
+def http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def is_transient_error(error: Exception) -> bool:
+    """
+    限流、超时、连接失败和服务端 5xx 错误视为暂时性错误，可以重试；
+    其他错误（如请求参数错误 400、鉴权失败 401）重试也不会成功。
+    """
+    if isinstance(error, (RateLimitError, APITimeoutError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+def get_openai_client(
+    api_key: str = OPENAI_API_KEY, base_url: str = OPENAI_API_BASE
+) -> OpenAI:
+    """返回共享的 OpenAI 兼容客户端（同一 Key 与接口地址只创建一次）"""
+    key = (api_key, base_url)
+    client = _OPENAI_CLIENTS.get(key)
+    if client is not None:
+        return client
+    with _LOCK:
+        client = _OPENAI_CLIENTS.get(key)
+        if client is None:
+            http_client = httpx.Client(
+                http2=HTTP2_AVAILABLE, limits=http_limits(), timeout=http_timeout()
+            )
+            client = OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=http_client,
+                timeout=http_timeout(),
+                max_retries=OPENAI_MAX_RETRIES,
+            )
+            _OPENAI_CLIENTS[key] = client
+            print(f"🔌 创建共享 OpenAI 客户端: {base_url} (HTTP/2: {'开启' if HTTP2_AVAILABLE else '关闭'})")
+    return client
+
+
+def get_async_openai_client(
+    api_key: str = OPENAI_API_KEY, base_url: str = OPENAI_API_BASE
+) -> AsyncOpenAI:
+    """返回当前事件循环共享的异步 OpenAI 兼容客户端，需在协程中调用"""
+    loop = asyncio.get_running_loop()
+    key = (api_key, base_url)
+    with _LOCK:
+        clients = _ASYNC_OPENAI_CLIENTS.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            http_client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE, limits=http_limits(), timeout=http_timeout()
+            )
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=http_client,
+                timeout=http_timeout(),
+                max_retries=OPENAI_MAX_RETRIES,
+            )
+            clients[key] = client
+    return client
+
+
+def get_tavily_client(api_key: str = TAVILY_API_KEY) -> Optional[object]:
+    """返回共享的 Tavily 客户端，未安装 tavily-python 时返回 None，初始化失败时抛出异常"""
+    if TavilyClient is None:
+        return None
+    client = _TAVILY_CLIENTS.get(api_key)
+    if client is not None:
+        return client
+    with _LOCK:
+        client = _TAVILY_CLIENTS.get(api_key)
+        if client is None:
+            client = TavilyClient(api_key=api_key)
+            _TAVILY_CLIENTS[api_key] = client
+    return client
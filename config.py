@@ -19,11 +19,97 @@ COLLECTION_NAME = "NLP_Project_Collection"
 ENABLE_ADVANCED_RAG = True
 DEFAULT_RETRIEVAL_STRATEGY = "HYBRID"
 RRF_K = 60
+HYBRID_CANDIDATE_MULTIPLIER = 2     # 混合检索每一路召回 top_k * 该倍数个候选
+HYBRID_LEG_TIMEOUT = 10.0           # 混合检索单路超时（秒），超时后退化为单路结果
+HYBRID_SEARCH_WORKERS = 8           # 混合检索共享线程池大小
+
+# BM25 稀疏索引配置
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_MERGE_SEGMENTS = 16            # 增量分段数超过该值时合并为一个基础分段
+BM25_TOKENIZER = "mixed"            # 分词模式：mixed（中日韩二元组 + 各字母文字单词）/ bigram / whitespace
+BM25_REMOVE_STOPWORDS = True        # 是否去除停用词
+
+# 检索策略路由配置
+RETRIEVAL_ROUTER_MODE = "heuristic"  # heuristic：本地特征路由；llm：使用 LLM 分类（本地路由作为对照记录）
+ROUTER_LOG_PATH = "./logs/router_decisions.jsonl"  # 路由决策日志（JSONL），设为 None 关闭
+ROUTER_RARE_IDF_RATIO = 0.8         # 归一化 IDF 不低于该值的词项视为稀有词
+ROUTER_LONG_QUERY_CHARS = 20        # 不少于该字符数的查询视为描述性长查询
+
+# 检索流水线配置
+RETRIEVAL_PIPELINE_ENABLED = True   # 查询改写与原始查询的推测检索并发执行
+REWRITE_SIMILARITY_THRESHOLD = 0.6  # 改写前后词项 Jaccard 相似度不低于该值时直接复用推测检索结果
+RETRIEVAL_PIPELINE_WORKERS = 8      # 检索流水线共享线程池大小
+
+# HTTP 客户端配置（各组件共享连接池，见 client_factory.py）
+HTTP_MAX_CONNECTIONS = 32           # 单个接口地址的最大连接数（需覆盖 Embedding、VL、检索流水线的并发）
+HTTP_MAX_KEEPALIVE = 16             # 保持空闲长连接的上限
+HTTP_KEEPALIVE_EXPIRY = 60.0        # 空闲长连接保留时间（秒）
+HTTP_CONNECT_TIMEOUT = 10.0         # 建立连接超时（秒）
+HTTP_READ_TIMEOUT = 120.0           # 读取超时（秒），需覆盖长回答与流式输出的间隔
+HTTP2_ENABLED = True                # 安装了 h2 时启用 HTTP/2
+OPENAI_MAX_RETRIES = 2              # OpenAI SDK 内置的请求重试次数
+
+# Embedding 批处理配置
+EMBEDDING_BATCH_SIZE = 10           # 单次请求最多输入条数（text-embedding-v4 上限为 10）
+EMBEDDING_BATCH_MAX_TOKENS = 8192   # 单次请求的估算 token 上限
+EMBEDDING_MAX_CONCURRENCY = 4       # 同时在途的批量请求数
+EMBEDDING_MAX_RETRIES = 3           # 单个批次失败后的重试次数
+
+# Embedding 持久化缓存配置（按模型 + 规范化文本哈希寻址）
+EMBEDDING_CACHE_ENABLED = True
+EMBEDDING_CACHE_DTYPE = "float16"   # 向量存储精度：float16 / float32
+EMBEDDING_CACHE_MAX_MB = 512        # 缓存文件大小上限，超出后按最近最少使用淘汰
+
+# 查询向量缓存配置
+QUERY_EMBEDDING_CACHE_SIZE = 1024   # 进程内 LRU 缓存条目上限
+QUERY_EMBEDDING_CACHE_TTL = 3600    # 条目有效期（秒）
+QUERY_EMBEDDING_CACHE_PERSIST = True  # 未命中时是否同时读写持久化 Embedding 缓存（新查询的向量延迟批量写入）
+
+# 图片描述（VL 模型）配置
+VL_MAX_WORKERS = 4                  # 并发描述图片的工作线程数
+VL_MAX_RETRIES = 3                  # 单张图片请求失败后的重试次数（限流时遵循 Retry-After）
+CAPTION_CACHE_ENABLED = True        # 按图片内容哈希缓存描述，重复导入时不再调用 VL 模型
+CAPTION_CACHE_PATH = "./vector_db/caption_cache.jsonl"
+CAPTION_PROMPT_VERSION = "v1"       # 修改描述提示词后需更新版本号，使旧缓存失效
+BATCH_CAPTION_PROMPT_VERSION = "batch-v1"  # 多图合并请求提示词的版本号，与单图描述分开缓存
+VL_IMAGE_MAX_SIDE = 1280            # 上传前将图片长边缩放到不超过该值（像素）
+VL_IMAGE_QUALITY = 85               # 重新编码为 JPEG 时的质量
+VL_BATCH_SIZE = 1                   # 同一页多张图片合并为一次请求的最大张数，1 表示逐张请求
+
+# 图片预过滤配置（在调用 VL 模型前剔除装饰性图片）
+IMAGE_FILTER_ENABLED = True
+IMAGE_FILTER_MIN_AREA = 100 * 100   # 像素面积低于该值的图标、项目符号直接跳过
+IMAGE_FILTER_MIN_COVERAGE = 0.002   # 前景（与背景色明显不同）像素占比低于该值的纯色、近空白图片直接跳过
+IMAGE_FILTER_DHASH_DISTANCE = 5     # dHash 汉明距离不超过该值视为近似重复，0 表示不检测
+
+# 文档加载配置
+LOADER_MAX_WORKERS = 4              # 并行解析文档的进程数，1 表示在当前进程中顺序加载
+PDF_PAGE_RANGE_SIZE = 20            # 页数超过该值的 PDF 按该页数拆分为多个任务并行解析
+
+# 流式入库配置
+INGEST_BATCH_SIZE = 64              # 每批向量化并写入的文档块数（也是每批切分的页数上限）
+INGEST_QUEUE_SIZE = 4               # 切分端与写入端之间最多缓冲的批次数
+INGEST_CHECKPOINT_PATH = "./vector_db/ingest_checkpoint.json"  # 已完成文件的检查点，用于中断后继续
+INGEST_MANIFEST_PATH = "./vector_db/ingest_manifest.json"  # 源文件清单（大小、修改时间、哈希、文档块 ID），用于增量重新入库
 
 # 文本处理配置
+CHUNK_UNIT = "char"                 # 切分单位：char 按字符数；token 按分词器 token 数（CHUNK_SIZE / CHUNK_OVERLAP 的单位随之改变）
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 50
-MAX_TOKENS = 1500
+CHUNK_MAX_TOKENS = 1024             # 任一文档块的 token 硬上限（两种单位下都生效，超出的 PDF/PPTX 页面会按 token 再切分）
+TOKENIZER_ENCODING = "cl100k_base"  # tiktoken 编码名称，无法加载时按字符数估算
+MAX_TOKENS = 1500                   # 回答生成的最大 token 数
+
+# 上下文打包配置
+CONTEXT_MAX_TOKENS = 3000           # 放入提示词的课程内容 token 预算
+CONTEXT_DEDUP_THRESHOLD = 0.8       # 字符 5-gram Jaccard 相似度不低于该值的文档块视为重复
+CONTEXT_MIN_TRUNCATE_TOKENS = 100   # 剩余预算低于该值时不再截断放入下一个文档块
+
+# 对话历史配置
+HISTORY_KEEP_TURNS = 3              # 原样发送的最近对话轮数（一问一答为一轮），更早的轮次折叠为摘要
+HISTORY_MAX_TOKENS = 2000           # 发送给模型的对话历史（含摘要）token 预算
+HISTORY_SUMMARY_MAX_TOKENS = 300    # 滚动摘要的最大 token 数
 
 # RAG配置
 TOP_K = 5
@@ -0,0 +1,122 @@
+"""
+上下文打包
+按检索排序（相关度从高到低）把文档块填入固定的 token 预算：
+- 同一 ID 或内容高度相似的文档块（如稠密检索与 BM25 检索命中的同一页）只保留排名最高的一个；
+- 放不下的文档块在句子边界处截断，预算用尽后不再加入；
+- 返回实际使用的 token 数，便于观察提示词规模。
+"""
+
+import re
+from typing import Callable, Dict, List, Optional, Set
+
+from token_counter import TokenCounter, get_token_counter
+from config import (
+    CONTEXT_MAX_TOKENS,
+    CONTEXT_DEDUP_THRESHOLD,
+    CONTEXT_MIN_TRUNCATE_TOKENS,
+)
+
+# 截断时优先停在这些句子结束符之后
+_SENTENCE_END = re.compile(r"[。！？；!?;]|\.\s|\n")
+_TRUNCATE_MARK = "……"
+
+
+class ContextPacker:
+    """按 token 预算打包检索结果"""
+
+    def __init__(
+        self,
+        max_tokens: int = CONTEXT_MAX_TOKENS,
+        dedup_threshold: float = CONTEXT_DEDUP_THRESHOLD,
+        min_truncate_tokens: int = CONTEXT_MIN_TRUNCATE_TOKENS,
+        token_counter: Optional[TokenCounter] = None,
+    ):
+        self.max_tokens = max_tokens
+        self.dedup_threshold = dedup_threshold
+        self.min_truncate_tokens = min_truncate_tokens
+        self.token_counter = token_counter or get_token_counter()
+
+    @staticmethod
+    def _shingles(text: str, size: int = 5) -> Set[str]:
+        """去除空白后的字符 n-gram 集合"""
+        normalized = re.sub(r"\s+", "", text)
+        if len(normalized) <= size:
+            return {normalized} if normalized else set()
+        return {normalized[i:i + size] for i in range(len(normalized) - size + 1)}
+
+    @staticmethod
+    def _jaccard(a: Set[str], b: Set[str]) -> float:
+        if not a or not b:
+            return 0.0
+        return len(a & b) / len(a | b)
+
+    def truncate_at_sentence(self, text: str, max_tokens: int) -> str:
+        """截取不超过 max_tokens 个 token 的前缀，尽量停在后半段的最后一个句子结束符处"""
+        truncated = self.token_counter.truncate(text, max_tokens)
+        if len(truncated) == len(text):
+            return text
+        last_end = None
+        for match in _SENTENCE_END.finditer(truncated):
+            last_end = match.end()
+        if last_end is not None and last_end >= len(truncated) // 2:
+            truncated = truncated[:last_end]
+        return truncated.rstrip() + _TRUNCATE_MARK
+
+    def pack(self, docs: List[Dict], label_fn: Callable[[Dict], str]) -> Dict:
+        """
+        按顺序打包文档块，每块格式为 "来源标签\\n内容\\n---"，块之间以换行分隔。
+        参数:
+            docs: 检索结果（已按相关度排序），每项包含 "id"、"content"、"metadata"
+            label_fn: 根据文档块生成来源标签
+        返回:
+            {
+                "context": 打包后的上下文字符串,
+                "docs": 实际放入上下文的文档块（截断的块 content 为截断后的内容）,
+                "tokens": 上下文实际 token 数,
+                "duplicates": 去重丢弃数, "truncated": 截断数, "omitted": 超出预算未放入数,
+            }
+        """
+        blocks: List[str] = []
+        packed_docs: List[Dict] = []
+        seen_ids: Set[str] = set()
+        kept_shingles: List[Set[str]] = []
+        used = 0
+        stats = {"duplicates": 0, "truncated": 0, "omitted": 0}
+
+        for position, doc in enumerate(docs):
+            content = doc.get("content", "")
+            doc_id = doc.get("id")
+            if doc_id and doc_id in seen_ids:
+                stats["duplicates"] += 1
+                continue
+            shingles = self._shingles(content)
+            if any(self._jaccard(shingles, kept) >= self.dedup_threshold for kept in kept_shingles):
+                stats["duplicates"] += 1
+                continue
+
+            label = label_fn(doc)
+            block = f"{label}\n{content}\n---"
+            # 加 1 计入块之间的换行
+            block_tokens = self.token_counter.count(block) + (1 if blocks else 0)
+            if used + block_tokens > self.max_tokens:
+                frame_tokens = self.token_counter.count(f"{label}\n{_TRUNCATE_MARK}\n---") + 1
+                remaining = self.max_tokens - used - frame_tokens
+                if remaining >= self.min_truncate_tokens:
+                    content = self.truncate_at_sentence(content, remaining)
+                    blocks.append(f"{label}\n{content}\n---")
+                    packed_docs.append(dict(doc, content=content))
+                    stats["truncated"] += 1
+                    position += 1
+                # 预算已满，后续文档块（相关度更低）不再加入
+                stats["omitted"] += len(docs) - position
+                break
+
+            blocks.append(block)
+            packed_docs.append(doc)
+            used += block_tokens
+            if doc_id:
+                seen_ids.add(doc_id)
+            kept_shingles.append(shingles)
+
+        context = "\n".join(blocks)
+        return dict(stats, context=context, docs=packed_docs, tokens=self.token_counter.count(context))
@@ -1,6 +1,10 @@
 import os
 import io
-from typing import List, Dict, Optional
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterator, List, Dict, Optional, Tuple
 
 import fitz
 import pdfplumber
@@ -8,7 +12,36 @@ import docx2txt
 from pptx import Presentation
 from PIL import Image
 
-from config import DATA_DIR
+from caption_cache import image_hash
+from config import DATA_DIR, LOADER_MAX_WORKERS, PDF_PAGE_RANGE_SIZE
+
+
+def _load_task(
+    data_dir: str,
+    image_output_dir: str,
+    file_path: str,
+    page_range: Optional[Tuple[int, int]] = None,
+) -> Tuple[List[Dict], Optional[str]]:
+    """
+    进程池工作函数（需定义在模块顶层以便序列化）：加载一个文件或 PDF 的一段页码。
+    返回 (文档块列表, 错误信息)，单个文件出错不会影响其他文件。
+    加载器以 raise_errors=True 创建，文件或页码段解析失败时返回错误信息，而不是当作空内容成功返回。
+    """
+    try:
+        loader = DocumentLoader(data_dir=data_dir, image_output_dir=image_output_dir, raise_errors=True)
+        return loader.load_document(file_path, page_range=page_range), None
+    except Exception as e:
+        return [], str(e)
+
+
+def _new_process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """
+    创建解析进程池。进程池可能由入库流水线的生产者线程创建，此时进程内还有写入线程、
+    Embedding 线程池和 HTTP 连接池在运行，fork 出的子进程可能卡在 fork 时被其他线程持有的锁上，
+    因此使用 forkserver（不支持时用 spawn）启动工作进程。
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method))
 
 
 class DocumentLoader:
@@ -17,53 +50,72 @@ class DocumentLoader:
         data_dir: str = DATA_DIR,
         # 新增一个参数用于存放提取出的图片
         image_output_dir: str = "./images_extracted", 
+        # 为 True 时各格式的加载方法在解析失败时抛出异常，而不是打印后返回空内容
+        raise_errors: bool = False,
     ):
         self.data_dir = data_dir
+        self.raise_errors = raise_errors
         self.supported_formats = [".pdf", ".pptx", ".docx", ".txt"]
         self.image_output_dir = image_output_dir
         os.makedirs(self.image_output_dir, exist_ok=True) # 确保图片输出目录存在
 
-    def load_pdf(self, file_path: str) -> List[Dict]:
+    def _store_image(self, image_bytes: bytes, ext: str) -> Optional[Dict[str, str]]:
         """
-        加载PDF文件，按页返回内容，并使用 PyMuPDF 提取图片和保存到本地。
-        最终返回的字典只包含 'text' 和 'images' 键，以供 load_document 统一封装元数据。
+        按内容哈希保存图片：同一张图片（如每页重复的 Logo、跨页复用的插图）只落盘一次，
+        路径为 images_extracted/by_hash/<哈希前两位>/<sha256>.<ext>。
+        返回 {"path": 保存路径, "hash": sha256}，失败时返回 None。
         """
-        pages = []
-        filename = os.path.basename(file_path)
-        filename_base = os.path.splitext(filename)[0]
+        if not image_bytes:
+            return None
 
-        # 封装图片保存逻辑作为内部辅助函数
-        def _save_image_from_bytes(image_bytes: bytes, page_num: int, xref: int, ext: str) -> str:
-            """将图片二进制数据保存到本地"""
-            if not image_bytes:
+        digest = image_hash(image_bytes)
+        ext = ext.lower()
+        if ext not in ['png', 'jpg', 'jpeg', 'bmp', 'tiff']:
+            # 其他格式（如 jpx、wmf）统一转为 PNG
+            try:
+                buffer = io.BytesIO()
+                Image.open(io.BytesIO(image_bytes)).save(buffer, format="PNG")
+                image_bytes = buffer.getvalue()
+                ext = 'png'
+            except Exception:
                 return None
-            
-            ext = ext.lower() if ext.lower() in ['png', 'jpg', 'jpeg', 'bmp', 'tiff'] else 'png'
-            
-            # 使用 PyMuPDF 的 xref 作为标识符
-            img_filename = f"{filename_base}_p{page_num}_xref_{xref}.{ext}"
-            img_save_path = os.path.join(self.image_output_dir, img_filename)
-            
+
+        img_dir = os.path.join(self.image_output_dir, "by_hash", digest[:2])
+        img_save_path = os.path.join(img_dir, f"{digest}.{ext}")
+        if not os.path.exists(img_save_path):
             try:
-                # 使用 PIL 从字节流中加载并保存图片
-                img = Image.open(io.BytesIO(image_bytes))
-                img.save(img_save_path)
-                return img_save_path
+                os.makedirs(img_dir, exist_ok=True)
+                # 先写临时文件再原子替换，并发加载时不会读到写了一半的图片
+                tmp_path = f"{img_save_path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(image_bytes)
+                os.replace(tmp_path, img_save_path)
             except Exception:
-                # 提取或保存失败
                 return None
+        return {"path": img_save_path, "hash": digest}
+
+    def load_pdf(self, file_path: str, page_range: Optional[Tuple[int, int]] = None) -> List[Dict]:
+        """
+        加载PDF文件，按页返回内容，并使用 PyMuPDF 提取图片和保存到本地。
+        page_range 为 (起始页下标, 结束页下标)（从 0 开始、左闭右开），为 None 时加载全部页面。
+        最终返回的字典包含 'text'、'images' 和 'page_number' 键，以供 load_document 统一封装元数据。
+        """
+        pages = []
 
         try:
             # 1. 使用 PyMuPDF (fitz) 打开 PDF 文件
             with fitz.open(file_path) as pdf_document:
-                for i, page in enumerate(pdf_document):
+                start, end = page_range or (0, pdf_document.page_count)
+                for i in range(start, min(end, pdf_document.page_count)):
+                    page = pdf_document[i]
                     image_info = []
                     page_num = i + 1
                     
                     # 2. 提取文本内容
                     text = page.get_text() or ""
                     
-                    # 3. 提取和保存图片
+                    # 3. 提取和保存图片（按内容哈希去重，同一页内重复引用的图片只记录一次）
+                    page_hashes = set()
                     for img_tuple in page.get_images(full=True):
                         xref = img_tuple[0]
                         img_ext = img_tuple[7]
@@ -73,18 +125,13 @@ class DocumentLoader:
                             if image_data and image_data['image']:
                                 image_bytes = image_data['image']
                                 
-                                # 调用内部函数保存图片
-                                img_save_path = _save_image_from_bytes(
-                                    image_bytes, 
-                                    page_num, 
-                                    xref, 
-                                    img_ext
-                                )
+                                stored = self._store_image(image_bytes, img_ext)
                                 
-                                if img_save_path:
+                                if stored and stored["hash"] not in page_hashes:
+                                    page_hashes.add(stored["hash"])
                                     # 记录图片路径信息
                                     # 注意：原 load_pdf 结构中没有 'name' 字段，但为了可追溯性保留
-                                    image_info.append({"path": img_save_path, "name": f"xref_{xref}"})
+                                    image_info.append({"path": stored["path"], "name": f"xref_{xref}", "hash": stored["hash"]})
                                     
                         except Exception:
                             continue
@@ -95,10 +142,13 @@ class DocumentLoader:
                     # 5. 存储结果：只返回 load_document 需要的核心数据
                     pages.append({
                         "text": formatted_text,
-                        "images": image_info  
+                        "images": image_info,
+                        "page_number": page_num,
                     })
                     
         except Exception as e:
+            if self.raise_errors:
+                raise
             print(f"加载PDF文件失败 {file_path}: {e}")
             return []
             
@@ -118,12 +168,12 @@ class DocumentLoader:
         try:
             # 1. 使用Presentation读取PPT文件
             prs = Presentation(file_path)
-            filename_base = os.path.basename(file_path).replace(os.path.splitext(file_path)[1], "")
             
             # 2. 遍历每一页，提取文本内容
             for i, slide in enumerate(prs.slides):
                 slide_text = []
                 image_info = []
+                slide_hashes = set()
                 
                 for shape in slide.shapes:
                     # 提取文本内容
@@ -141,14 +191,12 @@ class DocumentLoader:
                                 image_bytes = image_part.blob
                                 image_ext = image_part.ext
 
-                                # 保存图片
-                                img_filename = f"{filename_base}_s{i+1}_{shape.name}.{image_ext}"
-                                img_save_path = os.path.join(self.image_output_dir, img_filename)
-
-                                with open(img_save_path, 'wb') as f:
-                                    f.write(image_bytes)
+                                # 按内容哈希保存图片
+                                stored = self._store_image(image_bytes, image_ext)
 
-                                image_info.append({"path": img_save_path, "name": shape.name})
+                                if stored and stored["hash"] not in slide_hashes:
+                                    slide_hashes.add(stored["hash"])
+                                    image_info.append({"path": stored["path"], "name": shape.name, "hash": stored["hash"]})
                         except (AttributeError, Exception) as img_e:
                             # 有些形状被误识别为图片，跳过这些错误
                             continue
@@ -161,6 +209,8 @@ class DocumentLoader:
                     "images": image_info # 新增图片信息字段
                 })
         except Exception as e:
+            if self.raise_errors:
+                raise
             print(f"加载PPTX文件失败 {file_path}: {e}")
         return slides_content
 
@@ -177,6 +227,8 @@ class DocumentLoader:
             # 2. 返回文本内容
             return text.strip()
         except Exception as e:
+            if self.raise_errors:
+                raise
             print(f"加载DOCX文件失败 {file_path}: {e}")
             return ""
 
@@ -194,25 +246,27 @@ class DocumentLoader:
             # 2. 返回文本内容
             return text.strip()
         except Exception as e:
+            if self.raise_errors:
+                raise
             print(f"加载TXT文件失败 {file_path}: {e}")
             return ""
 
-    def load_document(self, file_path: str) -> List[Dict[str, any]]:
-        """加载单个文档，PDF和PPT按页/幻灯片分割，返回文档块列表"""
+    def load_document(self, file_path: str, page_range: Optional[Tuple[int, int]] = None) -> List[Dict[str, any]]:
+        """加载单个文档，PDF和PPT按页/幻灯片分割，返回文档块列表（page_range 仅对 PDF 生效）"""
         ext = os.path.splitext(file_path)[1].lower()
         filename = os.path.basename(file_path)
         documents = []
 
         if ext == ".pdf":
-            pages = self.load_pdf(file_path)
-            for page_idx, page_data in enumerate(pages, 1):
+            pages = self.load_pdf(file_path, page_range=page_range)
+            for page_data in pages:
                 documents.append(
                     {
                         "content": page_data["text"],
                         "filename": filename,
                         "filepath": file_path,
                         "filetype": ext,
-                        "page_number": page_idx,
+                        "page_number": page_data["page_number"],
                         "images": page_data["images"], # 传入图片信息
                     }
                 )
@@ -258,25 +312,159 @@ class DocumentLoader:
 
         return documents
 
-    def load_all_documents(self) -> List[Dict[str, any]]:
+    def list_files(self) -> List[str]:
+        """按路径排序列出数据目录下所有支持的文件，保证加载顺序确定"""
+        file_paths = []
+        for root, dirs, files in os.walk(self.data_dir):
+            dirs.sort()
+            for file in sorted(files):
+                ext = os.path.splitext(file)[1].lower()
+                if ext in self.supported_formats:
+                    file_paths.append(os.path.join(root, file))
+        return file_paths
+
+    def _plan_tasks(self, file_paths: List[str]) -> List[Tuple[str, Optional[Tuple[int, int]]]]:
+        """将文件拆分为加载任务：页数较多的 PDF 按 PDF_PAGE_RANGE_SIZE 页一段拆开"""
+        tasks = []
+        for file_path in file_paths:
+            if file_path.lower().endswith(".pdf") and PDF_PAGE_RANGE_SIZE > 0:
+                try:
+                    with fitz.open(file_path) as pdf_document:
+                        page_count = pdf_document.page_count
+                except Exception:
+                    page_count = 0
+                if page_count > PDF_PAGE_RANGE_SIZE:
+                    for start in range(0, page_count, PDF_PAGE_RANGE_SIZE):
+                        tasks.append((file_path, (start, min(start + PDF_PAGE_RANGE_SIZE, page_count))))
+                    continue
+            tasks.append((file_path, None))
+        return tasks
+
+    def _iter_serial_results(
+        self, tasks: List[Tuple[str, Optional[Tuple[int, int]]]]
+    ) -> Iterator[Tuple[str, Optional[Tuple[int, int]], List[Dict], Optional[str]]]:
+        """在当前进程中依次执行加载任务"""
+        for file_path, page_range in tasks:
+            print(f"正在加载: {file_path}")
+            documents, error = _load_task(self.data_dir, self.image_output_dir, file_path, page_range)
+            yield file_path, page_range, documents, error
+
+    def _iter_pool_results(
+        self, tasks: List[Tuple[str, Optional[Tuple[int, int]]]], max_workers: int
+    ) -> Iterator[Tuple[str, Optional[Tuple[int, int]], List[Dict], Optional[str]]]:
+        """
+        在进程池中执行加载任务，按任务顺序产出 (文件路径, 页码范围, 文档块列表, 错误信息)。
+        同时在途的任务数有上限，消费端处理较慢时不会无限制地堆积结果。
+        工作进程崩溃（BrokenProcessPool）时重建进程池，崩溃时在途的任务在新进程池中逐个重新执行：
+        单独执行仍导致崩溃的任务记为失败，其余任务正常完成。
+        """
+        remaining = deque(tasks)
+        in_flight = deque()
+        suspects = deque()
+        executor = _new_process_pool(max_workers)
+
+        def _submit(task):
+            return executor.submit(_load_task, self.data_dir, self.image_output_dir, *task)
+
+        try:
+            while in_flight or suspects or remaining:
+                if suspects and not in_flight:
+                    task = suspects.popleft()
+                    try:
+                        documents, error = _submit(task).result()
+                    except BrokenProcessPool:
+                        documents, error = [], "解析进程异常退出"
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        executor = _new_process_pool(max_workers)
+                    except Exception as e:
+                        documents, error = [], str(e)
+                    yield task[0], task[1], documents, error
+                    continue
+
+                try:
+                    while remaining and len(in_flight) < max_workers * 2:
+                        in_flight.append((remaining[0], _submit(remaining[0])))
+                        remaining.popleft()
+                    task, future = in_flight[0]
+                    documents, error = future.result()
+                except BrokenProcessPool:
+                    print(f"⚠️ 文档解析进程异常退出，重建进程池并逐个重试 {len(in_flight)} 个受影响的任务")
+                    suspects.extend(task for task, _ in in_flight)
+                    in_flight.clear()
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor = _new_process_pool(max_workers)
+                    continue
+                except Exception as e:
+                    documents, error = [], str(e)
+                in_flight.popleft()
+                yield task[0], task[1], documents, error
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _finish_file(
+        file_path: Optional[str], documents: List[Dict], errors: List[str], yield_errors: bool
+    ) -> Iterator[Dict]:
+        """一个文件的全部任务完成后产出其文档块；有任务失败时整个文件都不产出"""
+        if file_path is None:
+            return
+        if not errors:
+            yield from documents
+            return
+        print(f"⏭️ 跳过 {file_path}：{len(errors)} 个加载任务失败，该文件的页面均不产出")
+        if yield_errors:
+            yield {
+                "filepath": file_path,
+                "filename": os.path.basename(file_path),
+                "load_error": "; ".join(errors),
+            }
+
+    def iter_documents(
+        self,
+        file_paths: Optional[List[str]] = None,
+        max_workers: int = LOADER_MAX_WORKERS,
+        yield_errors: bool = False,
+    ) -> Iterator[Dict[str, any]]:
+        """
+        逐个产出文档块（按文件路径、页码的确定顺序）。
+        max_workers 大于 1 时，文件（以及大 PDF 的页码段）分发到进程池并行解析。
+        以文件为单位产出：大 PDF 的所有页码段都解析成功后才产出该文件的页面，任一段失败时整个文件都不产出，
+        避免只写入部分页面；代价是产出前需缓存当前文件的全部页面文本（图片只记录路径）。yield_errors 为 True 时，失败的文件改为产出一个错误标记
+        {"filepath": 文件路径, "filename": 文件名, "load_error": 错误信息}，调用方据此跳过整个文件。
+        """
+        if file_paths is None:
+            file_paths = self.list_files()
+        tasks = self._plan_tasks(file_paths)
+
+        if max_workers <= 1 or len(tasks) <= 1:
+            results = self._iter_serial_results(tasks)
+        else:
+            results = self._iter_pool_results(tasks, max_workers)
+
+        current_path: Optional[str] = None
+        documents: List[Dict] = []
+        errors: List[str] = []
+        for file_path, page_range, task_documents, error in results:
+            if file_path != current_path:
+                yield from self._finish_file(current_path, documents, errors, yield_errors)
+                current_path, documents, errors = file_path, [], []
+
+            label = f"{file_path} (第 {page_range[0] + 1}-{page_range[1]} 页)" if page_range else file_path
+            if error:
+                print(f"❌ 加载失败 {label}: {error}")
+                errors.append(error)
+            else:
+                print(f"已加载: {label}")
+                documents.extend(task_documents)
+        yield from self._finish_file(current_path, documents, errors, yield_errors)
+
+    def load_all_documents(self, max_workers: int = LOADER_MAX_WORKERS) -> List[Dict[str, any]]:
         """加载数据目录下的所有文档"""
         if not os.path.exists(self.data_dir):
             print(f"数据目录不存在: {self.data_dir}")
             return None
 
-        documents = []
-
-        for root, dirs, files in os.walk(self.data_dir):
-            for file in files:
-                ext = os.path.splitext(file)[1].lower()
-                if ext in self.supported_formats:
-                    file_path = os.path.join(root, file)
-                    print(f"正在加载: {file_path}")
-                    doc_chunks = self.load_document(file_path)
-                    if doc_chunks:
-                        documents.extend(doc_chunks)
-
-        return documents
+        return list(self.iter_documents(max_workers=max_workers))
 
     def process_uploaded_file(self, uploaded_file) -> List[Dict]:
         """处理单个上传的文件（来自Streamlit），复用现有的load方法
@@ -336,12 +524,12 @@ class DocumentLoader:
                 elif file_ext == ".docx":
                     # DOCX文件直接返回文本内容
                     text = self.load_docx(tmp_file_path)
-                    return [{"content": text, "filename": file_name, "filetype": file_ext, "page_number": 0}]
+                    return [{"content": text, "filename": file_name, "filepath": f"uploaded://{file_name}", "filetype": file_ext, "page_number": 0}]
 
                 elif file_ext == ".txt":
                     # TXT文件直接返回文本内容
                     text = self.load_txt(tmp_file_path)
-                    return [{"content": text, "filename": file_name, "filetype": file_ext, "page_number": 0}]
+                    return [{"content": text, "filename": file_name, "filepath": f"uploaded://{file_name}", "filetype": file_ext, "page_number": 0}]
 
                 else:
                     raise ValueError(f"不支持的文件类型: {file_ext}")
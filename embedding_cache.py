@@ -0,0 +1,495 @@
+"""
+Embedding 缓存
+- EmbeddingCache：以 (embedding 模型, 规范化文本哈希) 为键，将向量保存在内存映射文件中，
+  避免重复索引未变化的语料时再次调用 Embedding API。多个进程可安全共用同一缓存目录。
+- QueryEmbeddingCache：进程内的查询向量 LRU + TTL 缓存，重复提问无需再次请求 API。
+"""
+
+import os
+import re
+import json
+import time
+import atexit
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, List, Dict, Optional, Tuple
+
+import numpy as np
+
+from file_lock import FileLock
+
+KEY_BYTES = 16  # blake2b 摘要长度
+INITIAL_CAPACITY = 1024
+FLUSH_EVERY = 64  # 累计多少次未落盘的使用记录后自动保存 LRU 序号
+DEFERRED_BATCH = 32  # put_deferred 累计多少条后在后台线程批量写入
+DEFERRED_DELAY = 30.0  # put_deferred 的条目最多延迟多少秒写入
+
+_GENERATION_FILE = re.compile(r"^(vectors|keys|used)-(\d+)\.(bin|npy)$")
+
+
+def normalize_text(text: str) -> str:
+    """规范化文本：Unicode NFKC、合并连续空白、去除首尾空白"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def text_key(text: str) -> bytes:
+    """计算规范化文本的内容哈希"""
+    return hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=KEY_BYTES).digest()
+
+
+def _model_dir(cache_dir: str, model: str) -> str:
+    return os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", model))
+
+
+class EmbeddingCache:
+    """基于内容寻址的磁盘向量缓存
+
+    目录结构（每个模型一个子目录）：
+        meta.json            维度、数据类型、当前代号、条目数；原子替换，是写入的提交点
+        vectors-<代号>.bin    内存映射的向量矩阵 (capacity, dim)，新条目追加写入
+        keys-<代号>.bin       与向量行一一对应的 16 字节键，追加写入
+        used-<代号>.npy       各条目的最近使用序号，定期落盘，用于淘汰
+        .lock                跨进程文件锁
+    多个进程（如 Streamlit 应用与 process_data.py）可以共用同一目录：分配槽位、写入向量和更新
+    meta.json 都在文件锁内完成，meta.json 变化时其他进程增量读取新条目。
+    超出容量上限时按最近最少使用淘汰：保留的条目压缩写入下一代文件，再替换 meta.json 切换代号，
+    中途崩溃时当前一代不受影响。进程内请通过 get_embedding_cache 共享同一实例。
+    """
+
+    def __init__(self, cache_dir: str, model: str, dtype: str = "float16", max_size_mb: int = 512):
+        self.cache_dir = _model_dir(cache_dir, model)
+        self.dtype = np.dtype(dtype)
+        self.max_bytes = max_size_mb * 1024 * 1024
+        self._meta_path = os.path.join(self.cache_dir, "meta.json")
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(os.path.join(self.cache_dir, ".lock"))
+        self._clear_state()
+        # put_deferred 写入的待落盘条目：键 -> 向量
+        self._deferred: Dict[bytes, List[float]] = {}
+        self._deferred_lock = threading.Lock()
+        self._deferred_timer: Optional[threading.Timer] = None
+
+        try:
+            with self._file_lock:
+                self._sync(force=True)
+                self._remove_stale_files()
+        except Exception as e:
+            print(f"⚠️ Embedding 缓存加载失败，将重建缓存: {e}")
+            with self._file_lock:
+                self._reset()
+        atexit.register(self.flush)
+        # atexit 后注册的先执行：退出时先写入延迟条目，再保存使用记录
+        atexit.register(self.flush_deferred)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _clear_state(self) -> None:
+        self._generation = 0
+        self._dim = 0
+        self._count = 0
+        self._capacity = 0
+        self._clock = 0
+        self._touched = 0
+        self._vectors: Optional[np.memmap] = None
+        self._keys: List[bytes] = []
+        self._used = np.zeros(0, dtype=np.int64)
+        self._slots: Dict[bytes, int] = {}
+        self._meta_stamp: Optional[Tuple[int, int, int]] = None
+
+    def _path(self, kind: str, generation: int) -> str:
+        suffix = "npy" if kind == "used" else "bin"
+        return os.path.join(self.cache_dir, f"{kind}-{generation}.{suffix}")
+
+    def _stat_meta(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(self._meta_path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    # ---------- 加载与同步 ----------
+
+    def _sync(self, force: bool = False) -> None:
+        """meta.json 被其他进程更新时，重新加载或增量读取新条目（调用方需持有 self._lock）"""
+        if not force and self._stat_meta() == self._meta_stamp:
+            return
+        with self._file_lock:
+            stamp = self._stat_meta()
+            if stamp is None:
+                self._clear_state()
+                return
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("dtype") != self.dtype.name:
+                raise ValueError(f"缓存数据类型 {meta.get('dtype')} 与配置 {self.dtype.name} 不一致")
+            if "generation" not in meta:
+                raise ValueError("缓存为旧版格式")
+
+            generation, dim, count = int(meta["generation"]), int(meta["dim"]), int(meta["count"])
+            if force or generation != self._generation or dim != self._dim or count < self._count:
+                self._load_generation(generation, dim, count)
+            elif count > self._count:
+                self._read_new_entries(count)
+            self._meta_stamp = stamp
+
+    def _load_generation(self, generation: int, dim: int, count: int) -> None:
+        self._clear_state()
+        self._generation, self._dim = generation, dim
+        with open(self._path("keys", generation), "rb") as f:
+            raw = f.read(count * KEY_BYTES)
+        if len(raw) < count * KEY_BYTES:
+            raise ValueError("键文件不完整")
+        self._open_vectors(count)
+        self._keys = [raw[i * KEY_BYTES:(i + 1) * KEY_BYTES] for i in range(count)]
+        self._slots = {key: i for i, key in enumerate(self._keys)}
+        used = self._load_used(generation)[:count]
+        self._used[:len(used)] = used
+        self._count = count
+        self._clock = int(self._used[:count].max(initial=0))
+
+    def _read_new_entries(self, count: int) -> None:
+        """读取其他进程追加的条目"""
+        with open(self._path("keys", self._generation), "rb") as f:
+            f.seek(self._count * KEY_BYTES)
+            raw = f.read((count - self._count) * KEY_BYTES)
+        if len(raw) < (count - self._count) * KEY_BYTES:
+            raise ValueError("键文件不完整")
+        self._open_vectors(count)
+        for i in range(0, len(raw), KEY_BYTES):
+            key = raw[i:i + KEY_BYTES]
+            self._slots[key] = len(self._keys)
+            self._keys.append(key)
+        self._count = count
+
+    def _load_used(self, generation: int) -> np.ndarray:
+        try:
+            return np.load(self._path("used", generation)).astype(np.int64)
+        except (OSError, ValueError):
+            return np.zeros(0, dtype=np.int64)
+
+    def _open_vectors(self, needed: int) -> None:
+        """打开当前一代的向量内存映射，文件不足 needed 行时扩展文件"""
+        row_bytes = self._dim * self.dtype.itemsize
+        path = self._path("vectors", self._generation)
+        with open(path, "r+b" if os.path.exists(path) else "w+b") as f:
+            size = f.seek(0, os.SEEK_END)
+            if size < needed * row_bytes:
+                f.truncate(needed * row_bytes)
+                size = needed * row_bytes
+        capacity = size // row_bytes if row_bytes else 0
+        if capacity == self._capacity and self._vectors is not None:
+            return
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        if capacity:
+            self._vectors = np.memmap(path, dtype=self.dtype, mode="r+", shape=(capacity, self._dim))
+        if capacity > len(self._used):
+            self._used = np.concatenate([self._used, np.zeros(capacity - len(self._used), dtype=np.int64)])
+        self._capacity = capacity
+
+    def _ensure_capacity(self, needed: int) -> None:
+        if needed <= self._capacity:
+            return
+        new_capacity = max(INITIAL_CAPACITY, self._capacity)
+        while new_capacity < needed:
+            new_capacity *= 2
+        self._open_vectors(new_capacity)
+
+    # ---------- 写入（需持有文件锁） ----------
+
+    def _write_meta(self) -> None:
+        tmp_meta = self._meta_path + ".tmp"
+        with open(tmp_meta, "w", encoding="utf-8") as f:
+            json.dump({
+                "dim": self._dim,
+                "dtype": self.dtype.name,
+                "generation": self._generation,
+                "count": self._count,
+            }, f)
+        os.replace(tmp_meta, self._meta_path)
+        self._meta_stamp = self._stat_meta()
+
+    def _merged_used(self) -> np.ndarray:
+        """本进程与磁盘上记录的最近使用序号取较大值"""
+        used = self._used[: self._count].copy()
+        saved = self._load_used(self._generation)[: self._count]
+        used[: len(saved)] = np.maximum(used[: len(saved)], saved)
+        return used
+
+    def _save_used(self, used: np.ndarray, generation: int) -> None:
+        path = self._path("used", generation)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, used)
+        os.replace(tmp_path, path)
+
+    def _remove_stale_files(self) -> None:
+        """清理旧版格式文件、非当前一代的文件和写到一半的临时文件（其他进程仍在映射时可能删除失败，下次再清理）"""
+        for name in os.listdir(self.cache_dir):
+            match = _GENERATION_FILE.match(name)
+            stale = (
+                name in ("vectors.bin", "index.npy")
+                or name.endswith(".tmp")
+                or (match is not None and int(match.group(2)) != self._generation)
+            )
+            if stale:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+    def _reset(self) -> None:
+        self._vectors = None
+        for name in os.listdir(self.cache_dir):
+            if name != ".lock":
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+        self._clear_state()
+
+    def _evict_if_needed(self) -> bool:
+        """
+        超出容量上限时，仅保留最近使用的条目（约为上限的 80%）。
+        保留的条目写入下一代文件，替换 meta.json 后才切换，返回是否发生了淘汰。
+        """
+        row_bytes = self._dim * self.dtype.itemsize
+        if not row_bytes or self._count * row_bytes <= self.max_bytes:
+            return False
+        keep = int(self.max_bytes * 0.8) // row_bytes
+        used = self._merged_used()
+        order = np.argsort(used)[::-1][:keep]
+        order.sort()  # 保持原有相对顺序，便于顺序读写
+
+        old_generation, new_generation = self._generation, self._generation + 1
+        vectors = np.memmap(
+            self._path("vectors", new_generation), dtype=self.dtype, mode="w+",
+            shape=(max(keep, INITIAL_CAPACITY), self._dim),
+        )
+        vectors[:keep] = np.asarray(self._vectors[order])
+        vectors.flush()
+        del vectors
+        with open(self._path("keys", new_generation), "wb") as f:
+            f.write(b"".join(self._keys[i] for i in order))
+        self._save_used(used[order], new_generation)
+
+        evicted = self._count - keep
+        self._generation, self._count = new_generation, keep
+        self._write_meta()
+        self._load_generation(new_generation, self._dim, keep)
+        self._meta_stamp = self._stat_meta()
+        self._remove_stale_files()
+        print(f"🧹 Embedding 缓存淘汰 {evicted} 条旧向量（第 {old_generation} 代 -> 第 {new_generation} 代）")
+        return True
+
+    # ---------- 读写接口 ----------
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """批量查询缓存，未命中的位置返回 None"""
+        keys = [text_key(text) for text in texts]
+        results: List[Optional[List[float]]] = []
+        with self._deferred_lock:
+            deferred = [self._deferred.get(key) for key in keys] if self._deferred else [None] * len(keys)
+        with self._lock:
+            try:
+                self._sync()
+            except Exception as e:
+                print(f"⚠️ Embedding 缓存同步失败，本次按未命中处理: {e}")
+                return [None] * len(keys)
+            for key, pending in zip(keys, deferred):
+                if pending is not None:
+                    results.append(pending)
+                    continue
+                slot = self._slots.get(key)
+                if slot is None:
+                    results.append(None)
+                    continue
+                self._clock += 1
+                self._used[slot] = self._clock
+                self._touched += 1
+                results.append(np.asarray(self._vectors[slot], dtype=np.float32).tolist())
+        return results
+
+    def get(self, text: str) -> Optional[List[float]]:
+        return self.get_many([text])[0]
+
+    def put_many(self, texts: List[str], vectors: List[List[float]]) -> None:
+        """写入一批向量，空向量会被忽略；写入失败只打印警告，不影响调用方"""
+        items = [(text_key(t), v) for t, v in zip(texts, vectors) if v]
+        if not items:
+            return
+        with self._lock:
+            try:
+                with self._file_lock:
+                    self._put_locked(items)
+            except Exception as e:
+                print(f"⚠️ Embedding 缓存写入失败: {e}")
+                return
+            should_flush = self._touched >= FLUSH_EVERY
+        if should_flush:
+            self.flush()
+
+    def _put_locked(self, items: List[Tuple[bytes, List[float]]]) -> None:
+        self._sync()
+        if not self._dim:
+            self._dim = len(items[0][1])
+        rows = {key: vector for key, vector in items if len(vector) == self._dim}
+        if not rows:
+            return
+
+        # 先写向量与键，最后替换 meta.json 提交，其他进程只会看到完整写入的条目
+        new_keys = [key for key in rows if key not in self._slots]
+        self._ensure_capacity(self._count + len(new_keys))
+        for key in new_keys:
+            self._slots[key] = len(self._keys)
+            self._keys.append(key)
+        for key, vector in rows.items():
+            slot = self._slots[key]
+            self._vectors[slot] = np.asarray(vector, dtype=self.dtype)
+            self._clock += 1
+            self._used[slot] = self._clock
+        self._vectors.flush()
+
+        if new_keys:
+            keys_path = self._path("keys", self._generation)
+            with open(keys_path, "r+b" if os.path.exists(keys_path) else "w+b") as f:
+                f.seek(self._count * KEY_BYTES)
+                f.write(b"".join(new_keys))
+            self._count += len(new_keys)
+        self._touched += len(rows)
+        if not self._evict_if_needed():
+            self._write_meta()
+
+    def put(self, text: str, vector: List[float]) -> None:
+        self.put_many([text], [vector])
+
+    def put_deferred(self, text: str, vector: List[float]) -> None:
+        """
+        延迟写入（write-behind）：条目先保存在内存中（get 可立即命中），累计 DEFERRED_BATCH 条
+        或等待 DEFERRED_DELAY 秒后在后台线程批量写入，进程退出时写入剩余条目。
+        用于检索路径上的查询向量，避免每个新查询都同步加锁写盘。
+        """
+        if not vector:
+            return
+        with self._deferred_lock:
+            self._deferred[text_key(text)] = vector
+            if len(self._deferred) >= DEFERRED_BATCH:
+                if self._deferred_timer is not None:
+                    self._deferred_timer.cancel()
+                    self._deferred_timer = None
+                threading.Thread(target=self.flush_deferred, daemon=True).start()
+            elif self._deferred_timer is None:
+                self._deferred_timer = threading.Timer(DEFERRED_DELAY, self.flush_deferred)
+                self._deferred_timer.daemon = True
+                self._deferred_timer.start()
+
+    def flush_deferred(self) -> None:
+        """立即写入 put_deferred 暂存的条目"""
+        with self._deferred_lock:
+            items, self._deferred = list(self._deferred.items()), {}
+            if self._deferred_timer is not None:
+                self._deferred_timer.cancel()
+                self._deferred_timer = None
+        if not items:
+            return
+        with self._lock:
+            try:
+                with self._file_lock:
+                    self._put_locked(items)
+            except Exception as e:
+                print(f"⚠️ Embedding 缓存写入失败: {e}")
+
+    def flush(self) -> None:
+        """将向量落盘，并保存最近使用序号（与其他进程记录的序号合并）"""
+        with self._lock:
+            if self._vectors is None:
+                return
+            self._vectors.flush()
+            if not self._touched:
+                return
+            try:
+                with self._file_lock:
+                    self._sync()
+                    if self._count:
+                        used = self._merged_used()
+                        self._used[: self._count] = used
+                        self._save_used(used, self._generation)
+                    self._touched = 0
+            except Exception as e:
+                print(f"⚠️ Embedding 缓存使用记录保存失败: {e}")
+
+
+_CACHES: Dict[str, EmbeddingCache] = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def get_embedding_cache(
+    cache_dir: str, model: str, dtype: str = "float16", max_size_mb: int = 512
+) -> EmbeddingCache:
+    """进程内每个缓存目录只创建一个实例，各会话的 VectorStore 共用"""
+    key = os.path.abspath(_model_dir(cache_dir, model))
+    with _CACHES_LOCK:
+        cache = _CACHES.get(key)
+        if cache is None:
+            cache = EmbeddingCache(cache_dir, model, dtype=dtype, max_size_mb=max_size_mb)
+            _CACHES[key] = cache
+    return cache
+
+
+class QueryEmbeddingCache:
+    """查询向量的进程内 LRU + TTL 缓存
+
+    以规范化后的查询文本为键，超过 max_entries 时淘汰最久未使用的条目，
+    超过 ttl_seconds 的条目视为过期。hits / misses 记录命中情况。
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, List[float]]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, query: str) -> Optional[List[float]]:
+        key = normalize_text(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, query: str, embedding: List[float]) -> None:
+        if not embedding:
+            return
+        key = normalize_text(query)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        """命中统计"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,78 @@
+"""
+跨进程文件锁
+Streamlit 应用（每个会话一个 VectorStore）与 process_data.py 可能同时写入 vector_db 下的缓存和索引，
+写入前需持有对应目录的文件锁。POSIX 使用 fcntl.flock，Windows 使用 msvcrt.locking。
+同一个 FileLock 对象在进程内可重入，并同时起到线程锁的作用。
+"""
+
+import os
+import time
+import threading
+from typing import IO, Optional
+
+if os.name == "nt":
+    import msvcrt
+
+    def _lock_file(f: IO) -> None:
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                return
+            except OSError:
+                time.sleep(0.05)
+
+    def _unlock_file(f: IO) -> None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _lock_file(f: IO) -> None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def _unlock_file(f: IO) -> None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class FileLock:
+    """以锁文件实现的排他锁，支持 with 语句"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file: Optional[IO] = None
+
+    def acquire(self) -> None:
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                f = open(self.path, "a+b")
+                try:
+                    _lock_file(f)
+                except BaseException:
+                    f.close()
+                    raise
+            except BaseException:
+                self._thread_lock.release()
+                raise
+            self._file = f
+        self._depth += 1
+
+    def release(self) -> None:
+        self._depth -= 1
+        if self._depth == 0:
+            try:
+                _unlock_file(self._file)
+            finally:
+                self._file.close()
+                self._file = None
+        self._thread_lock.release()
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.release()
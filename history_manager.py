@@ -0,0 +1,186 @@
+"""
+对话历史管理
+发送给模型的对话历史保持在固定的 token 预算内：
+- 只保留 role / content，去掉 image_data、quiz_display、quiz_answer 等仅供界面展示的字段；
+- 最近 N 轮原样保留，更早的轮次折叠进按对话缓存的滚动摘要，每次只把新滑出窗口的消息并入摘要；
+- 摘要可以在检索期间提前在后台生成（prefetch），生成回答时直接取用。
+"""
+
+import json
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from openai import OpenAI
+
+from token_counter import TokenCounter, get_token_counter
+from config import (
+    HISTORY_KEEP_TURNS,
+    HISTORY_MAX_TOKENS,
+    HISTORY_SUMMARY_MAX_TOKENS,
+)
+
+# 摘要生成线程池（与检索流水线分开，避免互相占满）
+_HISTORY_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
+
+# 折叠进摘要时单条消息的最大 token 数
+_MESSAGE_MAX_TOKENS = 500
+
+SUMMARY_PROMPT = """你是一个对话摘要助手。下面是智能课程助教与学生之前的对话摘要，以及之后新增的对话。
+请将新增对话合并进摘要，输出更新后的完整摘要：
+- 保留学生问过的知识点、助教给出的关键结论、学生的答题情况和尚未解决的疑问；
+- 省略寒暄和重复内容，使用简洁的中文要点；
+- 只输出摘要本身。
+
+【已有摘要】
+{summary}
+
+【新增对话】
+{transcript}
+"""
+
+
+class HistoryManager:
+    """对话历史窗口与滚动摘要"""
+
+    def __init__(
+        self,
+        client: OpenAI,
+        model: str,
+        keep_turns: int = HISTORY_KEEP_TURNS,
+        max_tokens: int = HISTORY_MAX_TOKENS,
+        summary_max_tokens: int = HISTORY_SUMMARY_MAX_TOKENS,
+        token_counter: Optional[TokenCounter] = None,
+    ):
+        self.client = client
+        self.model = model
+        self.keep_turns = keep_turns
+        self.max_tokens = max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.token_counter = token_counter or get_token_counter()
+
+        # 对话 ID -> {"count": 已折叠的消息数, "fingerprint": 已折叠消息的哈希, "summary": 摘要}
+        self._summaries: Dict[str, Dict] = {}
+        # 对话 ID -> (预取时 older 的哈希, 摘要任务)
+        self._pending: Dict[str, Tuple[str, Future]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def sanitize(chat_history: Optional[List[Dict]]) -> List[Dict]:
+        """只保留 user / assistant 的文本内容，去掉界面展示用的字段"""
+        messages = []
+        for msg in chat_history or []:
+            content = msg.get("content")
+            if msg.get("role") in ("user", "assistant") and isinstance(content, str) and content.strip():
+                messages.append({"role": msg["role"], "content": content})
+        return messages
+
+    def _split(self, messages: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """分为 (需要折叠进摘要的较早消息, 原样保留的最近消息)，一问一答为一轮"""
+        keep = self.keep_turns * 2
+        if len(messages) <= keep:
+            return [], messages
+        if keep == 0:
+            return messages, []
+        return messages[:-keep], messages[-keep:]
+
+    @staticmethod
+    def _fingerprint(messages: List[Dict]) -> str:
+        return hashlib.sha1(json.dumps(messages, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _chat_key(chat_id: Optional[str]) -> str:
+        return chat_id or "default"
+
+    def _fold(self, summary: str, messages: List[Dict]) -> Optional[str]:
+        """调用模型把新消息并入摘要，失败时返回 None"""
+        transcript = "\n".join(
+            f"{'学生' if msg['role'] == 'user' else '助教'}："
+            f"{self.token_counter.truncate(msg['content'], _MESSAGE_MAX_TOKENS)}"
+            for msg in messages
+        )
+        prompt = SUMMARY_PROMPT.format(summary=summary or "（无）", transcript=transcript)
+        try:
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.0,
+                max_tokens=self.summary_max_tokens,
+            )
+            updated = (response.choices[0].message.content or "").strip()
+            return self.token_counter.truncate(updated, self.summary_max_tokens)
+        except Exception as e:
+            print(f"⚠️ 对话摘要更新失败，沿用已有摘要: {e}")
+            return None
+
+    def _summarize(self, chat_key: str, older: List[Dict]) -> str:
+        """返回覆盖 older 的摘要：缓存的摘要仍是 older 的前缀时只折叠新增部分，否则重新生成"""
+        with self._lock:
+            entry = self._summaries.get(chat_key)
+        summary, new_messages = "", older
+        if entry and entry["count"] <= len(older) and entry["fingerprint"] == self._fingerprint(older[:entry["count"]]):
+            summary, new_messages = entry["summary"], older[entry["count"]:]
+        if not new_messages:
+            return summary
+
+        updated = self._fold(summary, new_messages)
+        if updated is None:
+            return summary
+        with self._lock:
+            self._summaries[chat_key] = {
+                "count": len(older),
+                "fingerprint": self._fingerprint(older),
+                "summary": updated,
+            }
+        print(f"🗜️ 对话历史已折叠 {len(older)} 条消息为摘要 ({self.token_counter.count(updated)} tokens)")
+        return updated
+
+    def prefetch(self, chat_history: Optional[List[Dict]], chat_id: Optional[str] = None) -> None:
+        """
+        在后台提前更新摘要（如与检索并发），prepare 时直接取用结果。
+        没有 chat_id 时不预取，避免不同对话共用同一个待取结果。
+        """
+        if not chat_id:
+            return
+        older, _ = self._split(self.sanitize(chat_history))
+        if not older:
+            return
+        future = _HISTORY_EXECUTOR.submit(self._summarize, chat_id, older)
+        with self._lock:
+            self._pending[chat_id] = (self._fingerprint(older), future)
+
+    def prepare(
+        self, chat_history: Optional[List[Dict]], chat_id: Optional[str] = None
+    ) -> Tuple[str, List[Dict]]:
+        """
+        返回 (较早对话的摘要, 原样保留的最近消息)，两者合计不超过 max_tokens。
+        超出预算时从最早的保留消息开始丢弃，只剩一条仍超出时截断该条。
+        """
+        older, recent = self._split(self.sanitize(chat_history))
+        chat_key = self._chat_key(chat_id)
+
+        with self._lock:
+            pending = self._pending.pop(chat_key, None) if chat_id else None
+        summary = ""
+        if older:
+            # 预取结果只在覆盖的正是这段 older 时使用，否则重新计算
+            if pending is not None and pending[0] == self._fingerprint(older):
+                summary = pending[1].result()
+            else:
+                summary = self._summarize(chat_key, older)
+
+        budget = self.max_tokens - self.token_counter.count(summary)
+        tokens = [self.token_counter.count(msg["content"]) for msg in recent]
+        while len(recent) > 1 and sum(tokens) > budget:
+            recent.pop(0)
+            tokens.pop(0)
+        if recent and sum(tokens) > budget:
+            recent[0] = dict(recent[0], content=self.token_counter.truncate(recent[0]["content"], max(budget, 0)))
+        return summary, recent
+
+    def forget(self, chat_id: Optional[str]) -> None:
+        """删除对话时清除其摘要缓存"""
+        with self._lock:
+            self._summaries.pop(self._chat_key(chat_id), None)
+            self._pending.pop(self._chat_key(chat_id), None)
@@ -0,0 +1,122 @@
+"""
+图片预过滤
+在调用 VL 模型之前，用本地规则剔除装饰性图片：
+- 面积过小的图标、项目符号；
+- 前景像素（与背景色明显不同的像素）极少的纯色、近空白图片；白底的线条图、文字页不受影响；
+- 感知哈希（dHash）汉明距离很小的近似重复图片，只保留第一张。
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from config import (
+    IMAGE_FILTER_MIN_AREA,
+    IMAGE_FILTER_MIN_COVERAGE,
+    IMAGE_FILTER_DHASH_DISTANCE,
+)
+
+
+def dhash(image: Image.Image, hash_size: int = 8) -> int:
+    """差值哈希：缩放为 (hash_size+1) x hash_size 的灰度图，比较相邻像素得到 64 位指纹"""
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = np.asarray(gray)
+    value = 0
+    for bit in (pixels[:, :-1] > pixels[:, 1:]).ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def to_gray(image: Image.Image) -> Image.Image:
+    """转为灰度图；带透明通道的图片先合成到白色背景上，透明区域按背景处理"""
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        rgba = image.convert("RGBA")
+        background = Image.new("RGBA", rgba.size, (255, 255, 255, 255))
+        background.alpha_composite(rgba)
+        return background.convert("L")
+    return image.convert("L")
+
+
+def foreground_coverage(image: Image.Image, tolerance: int = 24) -> float:
+    """
+    前景像素占比：以出现最多的灰度为背景色，与之相差超过 tolerance 的像素视为前景。
+    纯色、近空白图片接近 0；白底线条图、公式、文字页的前景虽少，也有数个百分点。
+    （灰度直方图熵对这类只有黑白两色的图片同样很低，不能用来区分。）
+    """
+    histogram = to_gray(image).histogram()
+    total = sum(histogram)
+    if not total:
+        return 0.0
+    background = max(range(256), key=histogram.__getitem__)
+    foreground = sum(count for level, count in enumerate(histogram) if abs(level - background) > tolerance)
+    return foreground / total
+
+
+class ImageFilter:
+    """装饰性 / 微小 / 近似重复图片过滤器"""
+
+    def __init__(
+        self,
+        min_area: int = IMAGE_FILTER_MIN_AREA,
+        min_coverage: float = IMAGE_FILTER_MIN_COVERAGE,
+        dhash_distance: int = IMAGE_FILTER_DHASH_DISTANCE,
+    ):
+        self.min_area = min_area
+        self.min_coverage = min_coverage
+        self.dhash_distance = dhash_distance
+
+    def inspect(self, image_path: str) -> Tuple[Optional[str], Optional[int]]:
+        """检查单张图片，返回 (跳过原因, dHash)；原因为 None 表示保留"""
+        try:
+            with Image.open(image_path) as image:
+                width, height = image.size
+                if width * height < self.min_area:
+                    return "too_small", None
+                # 前景占比与哈希只需要低分辨率版本，先缩小以降低开销
+                image.thumbnail((256, 256))
+                if foreground_coverage(image) < self.min_coverage:
+                    return "blank", None
+                return None, dhash(image)
+        except Exception:
+            return "unreadable", None
+
+    def filter(self, image_paths: List[str]) -> Dict[str, Dict]:
+        """
+        过滤图片路径列表（保持原顺序，重复路径只检查一次）。
+        返回:
+            {
+                "kept": [保留的图片路径],
+                "duplicates": {近似重复图片路径: 保留的相似图片路径},
+                "skipped": {被跳过的图片路径: 原因},
+                "stats": {"total": 总数, "too_small": n, "blank": n, "unreadable": n, "near_duplicate": n},
+            }
+        """
+        kept: List[str] = []
+        kept_hashes: List[Tuple[int, str]] = []
+        duplicates: Dict[str, str] = {}
+        skipped: Dict[str, str] = {}
+        stats = {"total": 0, "too_small": 0, "blank": 0, "unreadable": 0, "near_duplicate": 0}
+
+        for path in dict.fromkeys(image_paths):
+            stats["total"] += 1
+            reason, fingerprint = self.inspect(path)
+            if reason:
+                skipped[path] = reason
+                stats[reason] += 1
+                continue
+
+            if self.dhash_distance > 0:
+                match = next(
+                    (kept_path for kept_hash, kept_path in kept_hashes
+                     if bin(kept_hash ^ fingerprint).count("1") <= self.dhash_distance),
+                    None,
+                )
+                if match is not None:
+                    duplicates[path] = match
+                    stats["near_duplicate"] += 1
+                    continue
+                kept_hashes.append((fingerprint, path))
+            kept.append(path)
+
+        return {"kept": kept, "duplicates": duplicates, "skipped": skipped, "stats": stats}
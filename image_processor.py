@@ -1,36 +1,353 @@
 # image_processor.py
 
+import io
 import os
+import re
+import json
+import time
+import random
 import base64
-from typing import List
-from openai import OpenAI
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+from tqdm import tqdm
+from PIL import Image
+from openai import RateLimitError
 
+from caption_cache import CaptionCache, image_hash
+from client_factory import get_openai_client, is_transient_error
 from config import (
-    OPENAI_API_KEY, 
-    OPENAI_API_BASE, 
-    OPENAI_VL_MODEL
+    OPENAI_VL_MODEL,
+    VL_MAX_WORKERS,
+    VL_MAX_RETRIES,
+    CAPTION_CACHE_ENABLED,
+    CAPTION_CACHE_PATH,
+    CAPTION_PROMPT_VERSION,
+    BATCH_CAPTION_PROMPT_VERSION,
+    VL_IMAGE_MAX_SIDE,
+    VL_IMAGE_QUALITY,
+    VL_BATCH_SIZE,
 )
 
+# 文档图片描述提示词（与图片序号无关，便于按图片内容缓存；修改后需同步更新 CAPTION_PROMPT_VERSION）
+CAPTION_PROMPT = (
+    "请对这张图片进行详细分析，并输出一段综合描述。描述应包含图中的**所有文字内容（OCR结果）**，以及对**图表、流程图或示意图的语义分析（如趋势、步骤、结论）**。请用中文回答，并保持描述专业、客观。"
+)
+
+# 同一页多张图片合并请求时的提示词，要求按图片编号返回 JSON 数组（修改后需同步更新 BATCH_CAPTION_PROMPT_VERSION）
+BATCH_CAPTION_PROMPT = (
+    "下面依次给出同一页文档中的 {count} 张图片，编号为 1 到 {count}。请对每张图片分别进行详细分析，"
+    "每段描述应包含图中的**所有文字内容（OCR结果）**，以及对**图表、流程图或示意图的语义分析（如趋势、步骤、结论）**。"
+    "请用中文回答，并保持描述专业、客观。\n"
+    "请严格只输出一个 JSON 数组，不要输出其他内容，格式为："
+    '[{{"index": 1, "description": "..."}}, {{"index": 2, "description": "..."}}]'
+)
+
+
 class ImageProcessor:
     def __init__(self):
         # 初始化 LLM 客户端，用于调用 Qwen-VL
-        self.client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_API_BASE)
+        self.client = get_openai_client()
+        # _call_vl 自行按 Retry-After 与指数退避重试，关闭 SDK 内置重试以免两层重试叠加
+        self.vl_client = self.client.with_options(max_retries=0)
         self.model = OPENAI_VL_MODEL
 
-    def _image_to_base64(self, image_path: str) -> str:
-        """将图片文件转换为 Base64 编码"""
-        if not os.path.exists(image_path):
-            print(f"警告：图片文件不存在: {image_path}")
-            return None
-        
+        # 图片描述持久化缓存：按图片内容哈希 + 模型 + 提示词版本寻址
+        self.caption_cache: Optional[CaptionCache] = None
+        if CAPTION_CACHE_ENABLED:
+            self.caption_cache = CaptionCache(CAPTION_CACHE_PATH)
+
+        # 触发限流后，所有工作线程共同等待到该时间点再发送请求
+        self._cooldown_until = 0.0
+        self._cooldown_lock = threading.Lock()
+
+    @staticmethod
+    def _prepare_image(image_bytes: bytes) -> Optional[str]:
+        """
+        上传前预处理图片，返回 data URL：
+        - 尺寸已符合要求的 JPEG/PNG 直接使用原始字节，避免重复压缩（截图、公式、线条图保持无损）；
+        - 长边超过 VL_IMAGE_MAX_SIDE 时等比缩小：PNG 及带透明通道的图片仍编码为 PNG，
+          其余编码为 JPEG（质量 VL_IMAGE_QUALITY），MIME 类型与实际编码一致。
+        """
         try:
-            with open(image_path, "rb") as image_file:
-                # Base64 编码并转换为字符串
-                return base64.b64encode(image_file.read()).decode('utf-8')
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                if max(image.size) <= VL_IMAGE_MAX_SIDE and image.format in ("JPEG", "PNG"):
+                    encoded = base64.b64encode(image_bytes).decode('ascii')
+                    return f"data:image/{image.format.lower()};base64,{encoded}"
+
+                has_alpha = image.mode in ("RGBA", "LA") or (
+                    image.mode == "P" and "transparency" in image.info
+                )
+                target_format = "PNG" if has_alpha or image.format == "PNG" else "JPEG"
+
+                image.thumbnail((VL_IMAGE_MAX_SIDE, VL_IMAGE_MAX_SIDE), Image.LANCZOS)
+                buffer = io.BytesIO()
+                if target_format == "PNG":
+                    mode = "RGBA" if has_alpha else ("L" if image.mode in ("1", "L") else "RGB")
+                    image.convert(mode).save(buffer, format="PNG", optimize=True)
+                else:
+                    image.convert("RGB").save(buffer, format="JPEG", quality=VL_IMAGE_QUALITY, optimize=True)
+
+            # 直接对缓冲区做 Base64，不再额外复制一份编码后的字节
+            with buffer.getbuffer() as view:
+                encoded = base64.b64encode(view).decode('ascii')
+            return f"data:image/{target_format.lower()};base64,{encoded}"
         except Exception as e:
-            print(f"转换图片为 Base64 失败 {image_path}: {e}")
+            print(f"图片预处理失败: {e}")
             return None
 
+    def _wait_for_cooldown(self) -> None:
+        with self._cooldown_lock:
+            delay = self._cooldown_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _set_cooldown(self, seconds: float) -> None:
+        with self._cooldown_lock:
+            self._cooldown_until = max(self._cooldown_until, time.monotonic() + seconds)
+
+    @staticmethod
+    def _retry_after(error: Exception) -> Optional[float]:
+        """读取限流响应中的 Retry-After 头（秒）"""
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
+
+    def _call_vl(self, messages: List[Dict], temperature: float = 0.0, max_tokens: int = 1000) -> str:
+        """
+        调用 VL 模型，暂时性错误（限流、超时、连接失败、5xx）指数退避重试，
+        其他错误（如内容审核拒绝的 400、鉴权失败的 401）直接抛出，不再重试。
+        遇到限流（429）时优先遵循 Retry-After，并让所有工作线程一起暂停，避免持续触发限流。
+        """
+        for attempt in range(VL_MAX_RETRIES + 1):
+            self._wait_for_cooldown()
+            try:
+                response = self.vl_client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens
+                )
+                return response.choices[0].message.content
+            except Exception as e:
+                if not is_transient_error(e) or attempt >= VL_MAX_RETRIES:
+                    raise
+                delay = 2 ** attempt + random.uniform(0, 1)
+                if isinstance(e, RateLimitError):
+                    delay = self._retry_after(e) or delay * 2
+                    self._set_cooldown(delay)
+                    print(f"⏳ VL 接口限流，{delay:.1f} 秒后重试")
+                time.sleep(delay)
+
+    def _read_image(self, image_path: str, prompt_version: str = CAPTION_PROMPT_VERSION) -> Tuple[bytes, str]:
+        """读取图片字节并计算描述缓存键（不同提示词生成的描述使用不同的版本号，互不混用）"""
+        with open(image_path, "rb") as image_file:
+            image_bytes = image_file.read()
+        cache_key = CaptionCache.make_key(image_hash(image_bytes), self.model, prompt_version)
+        return image_bytes, cache_key
+
+    def _cached_caption(self, cache_key: str) -> Optional[str]:
+        if self.caption_cache is None:
+            return None
+        return self.caption_cache.get(cache_key)
+
+    def _store_caption(self, cache_key: str, caption: str) -> None:
+        if self.caption_cache is not None:
+            self.caption_cache.put(cache_key, caption)
+
+    def caption_image(self, image_path: str) -> str:
+        """为单张文档图片生成描述（优先读取缓存），失败时抛出异常"""
+        image_bytes, cache_key = self._read_image(image_path)
+        cached = self._cached_caption(cache_key)
+        if cached is not None:
+            return cached
+
+        image_url = self._prepare_image(image_bytes)
+        if image_url is None:
+            raise ValueError("无法解码图片")
+        messages = [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": CAPTION_PROMPT},
+                {"type": "image_url", "image_url": {"url": image_url}}
+            ]
+        }]
+
+        caption = self._call_vl(messages, temperature=0.0, max_tokens=1000)
+        self._store_caption(cache_key, caption)
+        return caption
+
+    @staticmethod
+    def _parse_batch_captions(text: str, count: int) -> Dict[int, str]:
+        """解析多图请求返回的 JSON 数组，返回 {图片编号: 描述}；无法解析时返回空字典"""
+        match = re.search(r"\[.*\]", text or "", re.S)
+        if not match:
+            return {}
+        try:
+            items = json.loads(match.group())
+        except json.JSONDecodeError:
+            return {}
+
+        parsed = {}
+        for item in items if isinstance(items, list) else []:
+            if not isinstance(item, dict):
+                continue
+            try:
+                index = int(item.get("index"))
+            except (TypeError, ValueError):
+                continue
+            description = str(item.get("description") or "").strip()
+            if 1 <= index <= count and description:
+                parsed[index] = description
+        return parsed
+
+    def caption_image_batch(self, image_paths: List[str]) -> Dict[str, str]:
+        """
+        将同一页的多张图片放在一次多模态请求中描述，返回 {图片路径: 描述}。
+        已缓存（单图或多图描述）的图片不再发送，多图描述以 BATCH_CAPTION_PROMPT_VERSION 单独缓存；
+        请求失败、图片无法预处理或某张图片未能从返回结果中解析出描述时，退回单图请求。
+        单张图片的失败以“处理失败”开头的说明返回。
+        """
+        captions: Dict[str, str] = {}
+        pending: List[Tuple[str, bytes, str]] = []
+        for path in image_paths:
+            try:
+                image_bytes, cache_key = self._read_image(path, BATCH_CAPTION_PROMPT_VERSION)
+            except Exception as e:
+                captions[path] = f"处理失败: {e}"
+                continue
+            # 已有单图描述或多图描述时都直接复用
+            single_key = CaptionCache.make_key(image_hash(image_bytes), self.model, CAPTION_PROMPT_VERSION)
+            cached = self._cached_caption(single_key)
+            if cached is None:
+                cached = self._cached_caption(cache_key)
+            if cached is not None:
+                captions[path] = cached
+            else:
+                pending.append((path, image_bytes, cache_key))
+
+        # 只对预处理成功的图片编号，提示词中的张数、max_tokens 与解析范围都以实际放入请求的张数为准
+        attached: List[Tuple[str, str, str]] = []
+        for path, image_bytes, cache_key in pending:
+            image_url = self._prepare_image(image_bytes)
+            if image_url is not None:
+                attached.append((path, cache_key, image_url))
+
+        if len(attached) > 1:
+            content_parts = [{"type": "text", "text": BATCH_CAPTION_PROMPT.format(count=len(attached))}]
+            for index, (_, _, image_url) in enumerate(attached, 1):
+                content_parts.append({"type": "text", "text": f"图片 {index}："})
+                content_parts.append({"type": "image_url", "image_url": {"url": image_url}})
+
+            try:
+                answer = self._call_vl(
+                    [{"role": "user", "content": content_parts}],
+                    temperature=0.0,
+                    max_tokens=1000 * len(attached)
+                )
+                parsed = self._parse_batch_captions(answer, len(attached))
+            except Exception as e:
+                print(f"⚠️ 多图请求失败，退回单图请求: {e}")
+                parsed = {}
+
+            for index, (path, cache_key, _) in enumerate(attached, 1):
+                if index in parsed:
+                    captions[path] = parsed[index]
+                    self._store_caption(cache_key, parsed[index])
+
+        # 兜底：未能通过多图请求得到描述的图片逐张处理
+        for path, _, _ in pending:
+            if path in captions:
+                continue
+            try:
+                captions[path] = self.caption_image(path)
+            except Exception as e:
+                captions[path] = f"处理失败: {e}"
+        return captions
+
+    def _run_caption_task(self, task: List[str]) -> Dict[str, str]:
+        if len(task) > 1:
+            return self.caption_image_batch(task)
+        return {task[0]: self.caption_image(task[0])}
+
+    def caption_images(
+        self,
+        image_paths: List[str],
+        show_progress: bool = False,
+        page_groups: Optional[List[List[str]]] = None,
+    ) -> Dict[str, str]:
+        """
+        并发为多张图片生成描述，返回 {图片路径: 描述}。
+        工作线程数由 VL_MAX_WORKERS 限定；不存在的图片会被跳过，处理失败的图片返回以“处理失败”开头的说明。
+        VL_BATCH_SIZE 大于 1 且提供了 page_groups（按页分组的图片路径）时，
+        同一页的图片每 VL_BATCH_SIZE 张合并为一次请求。
+        """
+        unique_paths = []
+        for path in dict.fromkeys(image_paths):
+            if os.path.exists(path):
+                unique_paths.append(path)
+            else:
+                print(f"警告：图片文件不存在: {path}")
+        captions: Dict[str, str] = {}
+        if not unique_paths:
+            return captions
+
+        # 组织请求任务：每个任务是一组图片路径，单张图片走单图请求
+        tasks: List[List[str]] = []
+        if VL_BATCH_SIZE > 1 and page_groups:
+            remaining = dict.fromkeys(unique_paths)
+            for group in page_groups:
+                group_paths = [path for path in dict.fromkeys(group) if path in remaining]
+                for path in group_paths:
+                    del remaining[path]
+                for start in range(0, len(group_paths), VL_BATCH_SIZE):
+                    tasks.append(group_paths[start:start + VL_BATCH_SIZE])
+            tasks.extend([path] for path in remaining)
+        else:
+            tasks = [[path] for path in unique_paths]
+
+        with ThreadPoolExecutor(max_workers=VL_MAX_WORKERS) as executor:
+            futures = {executor.submit(self._run_caption_task, task): task for task in tasks}
+            progress = tqdm(total=len(unique_paths), desc="图片描述", unit="张", disable=not show_progress)
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    captions.update(future.result())
+                except Exception as e:
+                    for path in task:
+                        captions[path] = f"处理失败: {e}"
+                progress.update(len(task))
+            progress.close()
+        return captions
+
+    @staticmethod
+    def format_captions(
+        image_paths: List[str],
+        captions: Dict[str, str],
+        references: Optional[Dict[str, str]] = None,
+    ) -> str:
+        """
+        将图片描述整理为追加到页面内容中的文本。
+        references 为 {图片路径: 首次出现位置}，其中的图片已在前面的页面给出完整描述，这里只输出引用说明。
+        """
+        references = references or {}
+        full_description = []
+        for i, path in enumerate(image_paths):
+            if path in references:
+                full_description.append(f"--- 图片 {i+1} ({os.path.basename(path)}) 与{references[path]}的图片相同，描述见该页 ---\n")
+                continue
+            caption = captions.get(path)
+            if caption is None:
+                continue
+            if caption.startswith("处理失败"):
+                full_description.append(f"图片 {i+1} {caption}\n")
+            else:
+                full_description.append(f"--- 图片 {i+1} ({os.path.basename(path)}) 分析结果 ---\n{caption}\n")
+        return "\n".join(full_description)
+
     def process_images_to_text(self, image_paths: List[str]) -> str:
         """
         处理图片路径列表，调用 MLLM 或 OCR 转换为文本描述。
@@ -43,44 +360,8 @@ class ImageProcessor:
         if not image_paths:
             return ""
 
-        full_description = []
-        
-        for i, path in enumerate(image_paths):
-            base64_image = self._image_to_base64(path)
-            
-            if base64_image:
-                # 1. 构建多模态输入内容
-                # 使用 data:image/jpeg;base64, 作为前缀
-                image_url = f"data:image/jpeg;base64,{base64_image}"
-                
-                # 提示词要求模型同时进行 OCR 和语义分析
-                prompt_text = (
-                    f"请对图片 {i+1} 进行详细分析，并输出一段综合描述。描述应包含图中的**所有文字内容（OCR结果）**，以及对**图表、流程图或示意图的语义分析（如趋势、步骤、结论）**。请用中文回答，并保持描述专业、客观。"
-                )
-                
-                content_parts = [
-                    {"type": "text", "text": prompt_text},
-                    {"type": "image_url", "image_url": {"url": image_url}}
-                ]
-                
-                messages = [{"role": "user", "content": content_parts}]
-
-                # 2. 调用 Qwen-VL API
-                try:
-                    response = self.client.chat.completions.create(
-                        model=self.model,
-                        messages=messages,
-                        temperature=0.0, # 低温度保证客观描述
-                        max_tokens=1000
-                    )
-                    
-                    analysis_text = response.choices[0].message.content
-                    full_description.append(f"--- 图片 {i+1} ({os.path.basename(path)}) 分析结果 ---\n{analysis_text}\n")
-                    
-                except Exception as e:
-                    full_description.append(f"图片 {i+1} 处理失败: {e}\n")
-
-        return "\n".join(full_description)
+        captions = self.caption_images(image_paths, page_groups=[image_paths])
+        return self.format_captions(image_paths, captions)
 
     def analyze_single_image(self, image_base64: str, image_name: str = "图片") -> str:
         """
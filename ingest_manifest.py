@@ -0,0 +1,92 @@
+"""
+入库清单
+记录每个源文件的 (路径, 大小, 修改时间, sha256) 及其写入向量库的文档块 ID，
+重新入库时据此只处理新增或修改过的文件，并删除已移除文件的文档块。
+"""
+
+import os
+import json
+import hashlib
+from typing import Any, Dict, List
+
+
+def file_sha256(file_path: str, block_size: int = 1024 * 1024) -> str:
+    """分块计算文件内容的 sha256"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IngestManifest:
+    """源文件清单：{文件路径: {"size", "mtime", "sha256", "chunk_ids"}}"""
+
+    def __init__(self, manifest_path: str):
+        self.manifest_path = manifest_path
+        self.files: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    self.files = json.load(f).get("files", {})
+            except Exception as e:
+                print(f"⚠️ 入库清单读取失败，将视为全部文件未入库: {e}")
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def save(self) -> None:
+        """先写临时文件再原子替换"""
+        os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"files": self.files}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def clear(self) -> None:
+        self.files = {}
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+    def plan(self, file_paths: List[str]) -> Dict[str, List[str]]:
+        """
+        对比当前文件与清单，返回 {"added", "changed", "removed", "unchanged"} 四类文件路径。
+        大小与修改时间都未变的文件直接视为未修改；否则再比较内容哈希，
+        内容未变（如仅被 touch 过）时只更新清单中的修改时间。
+        """
+        result = {"added": [], "changed": [], "removed": [], "unchanged": []}
+        current = set(file_paths)
+
+        for file_path in file_paths:
+            entry = self.files.get(file_path)
+            if entry is None:
+                result["added"].append(file_path)
+                continue
+            stat = os.stat(file_path)
+            if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                result["unchanged"].append(file_path)
+            elif entry["sha256"] == file_sha256(file_path):
+                entry["mtime"] = stat.st_mtime
+                result["unchanged"].append(file_path)
+            else:
+                result["changed"].append(file_path)
+
+        result["removed"] = [path for path in self.files if path not in current]
+        return result
+
+    def chunk_ids(self, file_path: str) -> List[str]:
+        return list(self.files.get(file_path, {}).get("chunk_ids", []))
+
+    def record(self, file_path: str, chunk_ids: List[str]) -> None:
+        """记录文件已完成入库（立即落盘）"""
+        stat = os.stat(file_path)
+        self.files[file_path] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256": file_sha256(file_path),
+            "chunk_ids": list(chunk_ids),
+        }
+        self.save()
+
+    def remove(self, file_path: str) -> None:
+        self.files.pop(file_path, None)
@@ -0,0 +1,227 @@
+"""
+流式入库流水线
+加载 → 图片描述 → 切分 → 向量化 → 写入，按有界批次逐段流转：
+- 加载与切分在生产者线程中进行，通过有界队列交给写入端，写入端跟不上时生产者自动阻塞（背压），
+  峰值内存取决于批次大小与最大单个文件的页面文本，而不是语料规模
+  （加载端按文件整体产出页面，保证文件的所有页码段都解析成功后才写入，因此会缓存当前文件的全部页面）；
+- 每个文件的全部文档块写入后记录到检查点文件，运行中断后可从未完成的文件继续。
+"""
+
+import os
+import json
+import queue
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from document_loader import DocumentLoader
+from text_splitter import TextSplitter
+from vector_store import VectorStore
+from config import (
+    INGEST_BATCH_SIZE,
+    INGEST_QUEUE_SIZE,
+    INGEST_CHECKPOINT_PATH,
+)
+
+_DONE = object()
+
+
+class IngestionPipeline:
+    """流式入库流水线"""
+
+    def __init__(
+        self,
+        loader: DocumentLoader,
+        splitter: TextSplitter,
+        vector_store: VectorStore,
+        batch_size: int = INGEST_BATCH_SIZE,
+        queue_size: int = INGEST_QUEUE_SIZE,
+        checkpoint_path: str = INGEST_CHECKPOINT_PATH,
+    ):
+        self.loader = loader
+        self.splitter = splitter
+        self.vector_store = vector_store
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.checkpoint_path = checkpoint_path
+
+    # ---------- 检查点 ----------
+
+    @staticmethod
+    def _file_signature(file_path: str) -> Dict[str, Any]:
+        stat = os.stat(file_path)
+        return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    def has_checkpoint(self) -> bool:
+        """是否存在上次未完成的运行"""
+        return os.path.exists(self.checkpoint_path)
+
+    def _load_checkpoint(self) -> Dict[str, Dict[str, Any]]:
+        if not self.has_checkpoint():
+            return {}
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                return json.load(f).get("completed", {})
+        except Exception as e:
+            print(f"⚠️ 检查点文件读取失败，将重新处理全部文件: {e}")
+            return {}
+
+    def _save_checkpoint(self, completed: Dict[str, Dict[str, Any]]) -> None:
+        """先写临时文件再原子替换，中断时不会留下损坏的检查点"""
+        os.makedirs(os.path.dirname(self.checkpoint_path) or ".", exist_ok=True)
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"completed": completed}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def clear_checkpoint(self) -> None:
+        if self.has_checkpoint():
+            os.remove(self.checkpoint_path)
+
+    # ---------- 生产者：加载 + 图片描述 + 切分 ----------
+
+    def _iter_page_batches(
+        self, file_paths: List[str]
+    ) -> Iterator[Tuple[str, List[Dict], bool, Optional[str]]]:
+        """
+        将按顺序产出的页面按文件分组、每 batch_size 页一批，
+        产出 (文件路径, 页面列表, 是否为该文件的最后一批, 加载错误)。
+        加载失败的文件不会产出任何页面，只产出一项 (文件路径, [], True, 错误信息)。
+        """
+        current_path: Optional[str] = None
+        batch: List[Dict] = []
+        for doc in self.loader.iter_documents(file_paths, yield_errors=True):
+            path = doc.get("filepath", "")
+            if current_path is not None and path != current_path:
+                yield current_path, batch, True, None
+                current_path, batch = None, []
+            if "load_error" in doc:
+                yield path, [], True, doc["load_error"]
+                continue
+            if len(batch) >= self.batch_size:
+                yield current_path, batch, False, None
+                batch = []
+            current_path = path
+            batch.append(doc)
+        if current_path is not None:
+            yield current_path, batch, True, None
+
+    def _produce(self, file_paths: List[str], out_queue: "queue.Queue") -> None:
+        try:
+            for file_path, pages, is_last, error in self._iter_page_batches(file_paths):
+                chunks = self.splitter.split_documents(pages, show_progress=False) if pages else []
+                # 队列已满时在此阻塞，直到写入端消费
+                out_queue.put((file_path, chunks, is_last, error))
+        except Exception as e:
+            out_queue.put(e)
+        finally:
+            out_queue.put(_DONE)
+
+    # ---------- 消费者：向量化 + 写入 ----------
+
+    def run(
+        self,
+        file_paths: Optional[List[str]] = None,
+        on_file_complete: Optional[Callable[[str, List[str]], None]] = None,
+    ) -> Dict[str, int]:
+        """
+        执行流式入库。存在检查点时跳过已完成（且未修改）的文件。
+        每个文件的文档块全部写入后调用 on_file_complete(文件路径, 该文件本次的文档块 ID 列表)，
+        调用方可据此删除该文件不在列表中的旧文档块（文件修改前的内容、上次中断时写入的部分内容）。
+        文档块 ID 由内容确定，中断后重新写入同一文件不会产生重复块，因此继续运行时不再预先删除已写入的部分。
+        加载失败的文件整体跳过，不写入任何文档块，也不记入检查点，下次运行时重新处理。
+        有文档块未能写入（如向量获取失败）的文件同样不记入检查点，也不会调用 on_file_complete。
+        全部完成后删除检查点，返回统计信息。
+        """
+        if file_paths is None:
+            file_paths = self.loader.list_files()
+
+        # 重复图片的“见第 X 页”引用只在本次运行内有效（本次会重新处理这些文件的全部页面）
+        self.splitter.image_first_seen.clear()
+        completed = self._load_checkpoint()
+        resuming = bool(completed) or self.has_checkpoint()
+        pending_files = [
+            path for path in file_paths
+            if completed.get(path) != self._file_signature(path)
+        ]
+        if resuming:
+            print(f"♻️ 从检查点继续：已完成 {len(file_paths) - len(pending_files)} 个文件，剩余 {len(pending_files)} 个")
+        # 首批写入前即创建检查点，标记本次运行尚未完成
+        self._save_checkpoint(completed)
+
+        stats = {"files": 0, "chunks": 0, "batches": 0, "failed": 0}
+        if not pending_files:
+            self.clear_checkpoint()
+            return stats
+
+        chunk_queue: "queue.Queue" = queue.Queue(maxsize=self.queue_size)
+        producer = threading.Thread(
+            target=self._produce, args=(pending_files, chunk_queue), daemon=True
+        )
+        producer.start()
+
+        buffer: List[Dict] = []
+        finished_files: List[str] = []
+        # 文件路径 -> 本次为该文件写入的文档块 ID
+        file_chunk_ids: Dict[str, Set[str]] = {}
+        # 有文档块未能写入的文件，不记入检查点
+        incomplete_files: Set[str] = set()
+
+        def _flush() -> None:
+            if buffer:
+                failed_ids = set(self.vector_store.upsert_documents(buffer))
+                if failed_ids:
+                    failed_chunks = [
+                        chunk for chunk in buffer if self.vector_store.make_chunk_id(chunk) in failed_ids
+                    ]
+                    if len(failed_chunks) == len(buffer):
+                        raise RuntimeError("文档块写入失败，已完成的文件保留在检查点中，可重新运行继续")
+                    incomplete_files.update(chunk.get("filepath", "") for chunk in failed_chunks)
+                stats["chunks"] += len(buffer) - len(failed_ids)
+                stats["batches"] += 1
+                buffer.clear()
+            # 文件的全部文档块都已写入后才记入检查点
+            done = [path for path in finished_files if path not in incomplete_files]
+            for path in done:
+                completed[path] = self._file_signature(path)
+                stats["files"] += 1
+            if done:
+                self._save_checkpoint(completed)
+                if on_file_complete is not None:
+                    for path in done:
+                        on_file_complete(path, sorted(file_chunk_ids.get(path, ())))
+            for path in finished_files:
+                file_chunk_ids.pop(path, None)
+            finished_files.clear()
+
+        while True:
+            item = chunk_queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                producer.join()
+                raise item
+
+            file_path, chunks, is_last, error = item
+            if error:
+                print(f"⏭️ 文件加载失败，整体跳过: {file_path}")
+                stats["failed"] += 1
+                continue
+            buffer.extend(chunks)
+            file_chunk_ids.setdefault(file_path, set()).update(
+                self.vector_store.make_chunk_id(chunk) for chunk in chunks if chunk.get("content", "").strip()
+            )
+            if is_last:
+                finished_files.append(file_path)
+            if len(buffer) >= self.batch_size:
+                _flush()
+
+        _flush()
+        producer.join()
+        self.clear_checkpoint()
+        print(f"✅ 流式入库完成：{stats['files']} 个文件，{stats['chunks']} 个文档块，{stats['batches']} 个批次")
+        if stats["failed"]:
+            print(f"⚠️ {stats['failed']} 个文件加载失败未入库，下次运行时会重新处理")
+        if incomplete_files:
+            stats["failed"] += len(incomplete_files)
+            print(f"⚠️ {len(incomplete_files)} 个文件有文档块未能写入，未标记为完成，下次运行时会补齐: {sorted(incomplete_files)}")
+        return stats
@@ -1,12 +1,16 @@
 import os
+import sys
+from typing import List
 from document_loader import DocumentLoader
 from text_splitter import TextSplitter
 from vector_store import VectorStore
+from ingest_pipeline import IngestionPipeline
+from ingest_manifest import IngestManifest
 
-from config import DATA_DIR, CHUNK_SIZE, CHUNK_OVERLAP, VECTOR_DB_PATH
+from config import DATA_DIR, CHUNK_SIZE, CHUNK_OVERLAP, VECTOR_DB_PATH, INGEST_MANIFEST_PATH
 
 
-def main():
+def main(full_rebuild: bool = False):
     if not os.path.exists(DATA_DIR):
         print(f"数据目录不存在: {DATA_DIR}")
         print("请创建数据目录并放入PDF、PPTX、DOCX或TXT文件")
@@ -18,22 +22,51 @@ def main():
     )
     splitter = TextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
     vector_store = VectorStore(db_path=VECTOR_DB_PATH)
-    vector_store.clear_collection()
+    pipeline = IngestionPipeline(loader, splitter, vector_store)
+    manifest = IngestManifest(INGEST_MANIFEST_PATH)
 
-    # 加载文档
-    documents = loader.load_all_documents()
-    if not documents:
-        print("未找到任何文档")
+    # 没有清单的旧向量库无法判断哪些内容已入库，按全量重建处理
+    if full_rebuild or (not len(manifest) and not pipeline.has_checkpoint()):
+        print("执行全量重建...")
+        vector_store.clear_collection()
+        manifest.clear()
+        pipeline.clear_checkpoint()
+    elif pipeline.has_checkpoint():
+        print("检测到未完成的入库任务，将从检查点继续")
+
+    file_paths = loader.list_files()
+
+    # 增量同步：只处理新增或修改过的文件，删除已移除文件的文档块
+    plan = manifest.plan(file_paths)
+    print(
+        f"📋 文件变更：新增 {len(plan['added'])}，修改 {len(plan['changed'])}，"
+        f"删除 {len(plan['removed'])}，未变 {len(plan['unchanged'])}"
+    )
+    # 修改过的文件保留旧文档块，新内容写入后再删除（见 _on_file_complete），入库中断时不会丢失整个文件
+    for file_path in plan["removed"]:
+        vector_store.delete_documents(manifest.chunk_ids(file_path))
+        manifest.remove(file_path)
+    manifest.save()
+
+    to_ingest = plan["added"] + plan["changed"]
+    if not to_ingest:
+        print("没有需要更新的文档")
+        pipeline.clear_checkpoint()
         return
 
-    # 切分文档
-    chunks = splitter.split_documents(documents)
+    def _on_file_complete(file_path: str, chunk_ids: List[str]) -> None:
+        """文件的新文档块全部写入后，删除其不再出现的旧文档块并更新清单"""
+        current = set(chunk_ids)
+        stale = [doc_id for doc_id in vector_store.get_ids_by_filepath(file_path) if doc_id not in current]
+        if stale:
+            print(f"🧹 删除 {file_path} 中已过期的 {len(stale)} 个文档块")
+            vector_store.delete_documents(stale)
+        manifest.record(file_path, chunk_ids)
 
-    # 存储到向量数据库
-    vector_store.add_documents(chunks)
+    pipeline.run(to_ingest, on_file_complete=_on_file_complete)
     
     print("\n数据处理完成！可以运行main.py开始对话")
 
 
 if __name__ == "__main__":
-    main()
+    main(full_rebuild="--full" in sys.argv)
@@ -0,0 +1,132 @@
+"""
+检索策略路由器
+根据查询的本地特征（长度、BM25 词项稀有度、数字/代码、代词指代）确定性地
+选择 'DENSE' / 'BM25' / 'HYBRID' 策略，替代每轮一次的 LLM 分类调用。
+每次路由决策都会追加写入 JSONL 日志，便于与 LLM 分类结果离线对比。
+"""
+
+import os
+import re
+import json
+import math
+import threading
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+from sparse_tokenizer import SparseTokenizer
+from config import (
+    ROUTER_LOG_PATH,
+    ROUTER_RARE_IDF_RATIO,
+    ROUTER_LONG_QUERY_CHARS,
+)
+
+_PRONOUNS = re.compile(
+    r"它们|它|这个|那个|这些|那些|这种|那种|上述|前面|刚才|"
+    r"\b(?:it|this|that|these|those|they|them)\b",
+    re.IGNORECASE,
+)
+_CONCEPTUAL = re.compile(
+    r"什么是|是什么|为什么|原理|区别|比较|关系|如何理解|怎么理解|含义|意义|优缺点|"
+    r"\b(?:what is|why|how does|explain|difference|compare)\b",
+    re.IGNORECASE,
+)
+# 文件名需以标识符开头并带有常见扩展名，避免把“3.1 词向量”这类章节号或“e.g.”误判为代码
+_CODE_EXTENSIONS = (
+    "py|ipynb|js|ts|java|c|cc|cpp|h|hpp|cs|go|rs|rb|php|sh|sql|html|css|"
+    "json|jsonl|yaml|yml|toml|csv|tsv|txt|md|pdf|pptx|docx|npy|pkl|pt|pth"
+)
+# 不把驼峰写法当作代码：GloVe、BiLSTM、WordPiece 等模型名在课程问答中很常见
+_CODE = re.compile(
+    r"[A-Za-z_]\w*\(|::|->|==|[A-Za-z]+_[A-Za-z0-9_]+|"
+    rf"\b[A-Za-z_][\w-]*\.(?:{_CODE_EXTENSIONS})\b|`",
+    re.ASCII,
+)
+# 章节编号（“第3章”“3.1 词向量”）只是定位课程内容，不算需要字面匹配的数字
+_SECTION = re.compile(
+    r"第\s*\d+\s*[章节讲课篇部页]|(?<![\w.])\d+(?:\.\d+)+(?=\s*[\u4e00-\u9fff])"
+)
+# 只统计独立的数字，BM25、word2vec 等标识符中的数字不算
+_DIGITS = re.compile(r"(?<![A-Za-z\d.])\d+(?:\.\d+)?(?![A-Za-z\d])")
+
+
+class QueryRouter:
+    """基于查询特征的本地检索策略路由器"""
+
+    def __init__(self, bm25_index=None, tokenizer: Optional[SparseTokenizer] = None,
+                 log_path: Optional[str] = ROUTER_LOG_PATH):
+        self.bm25_index = bm25_index
+        self.tokenizer = tokenizer or (bm25_index.tokenizer if bm25_index is not None else SparseTokenizer())
+        self.log_path = log_path
+        self._log_lock = threading.Lock()
+
+    def extract_features(self, query: str) -> Dict[str, Any]:
+        """提取路由特征"""
+        tokens = self.tokenizer.tokenize(query)
+        n_docs = len(self.bm25_index) if self.bm25_index is not None else 0
+
+        # 稀有词：在语料中出现过、且 IDF 接近最大值（df 很小）的词项
+        rare = known = 0
+        if n_docs and tokens:
+            max_idf = math.log1p((n_docs - 1 + 0.5) / 1.5)
+            for token in set(tokens):
+                if self.bm25_index.document_frequency(token) == 0:
+                    continue
+                known += 1
+                if max_idf and self.bm25_index.idf(token) / max_idf >= ROUTER_RARE_IDF_RATIO:
+                    rare += 1
+
+        return {
+            "chars": len(query.strip()),
+            "tokens": len(tokens),
+            "known_terms": known,
+            "rare_ratio": rare / known if known else 0.0,
+            "digits": len(_DIGITS.findall(_SECTION.sub(" ", query))),
+            "has_code": bool(_CODE.search(query)),
+            "has_pronoun": bool(_PRONOUNS.search(query)),
+            "conceptual": bool(_CONCEPTUAL.search(query)),
+        }
+
+    def route(self, query: str) -> Tuple[str, Dict[str, Any]]:
+        """返回 (策略, 特征)"""
+        features = self.extract_features(query)
+
+        if features["has_pronoun"]:
+            # 指代不明，语义和关键词两路都需要
+            decision = "HYBRID"
+        elif features["conceptual"]:
+            # 概念性问题需要语义检索；含稀有专业词（如“什么是BM25”）时保留关键词一路
+            decision = "DENSE" if features["rare_ratio"] < 0.3 else "HYBRID"
+        elif features["has_code"] or (features["digits"] and features["tokens"] <= 6):
+            # 代码片段、特定数字需要字面匹配
+            decision = "BM25"
+        elif features["tokens"] <= 4 and features["rare_ratio"] >= 0.5:
+            # 短查询且以稀有专业词为主
+            decision = "BM25"
+        elif features["rare_ratio"] < 0.3 and features["chars"] >= ROUTER_LONG_QUERY_CHARS:
+            # 较长的描述性查询，关键词不稀有
+            decision = "DENSE"
+        else:
+            decision = "HYBRID"
+        return decision, features
+
+    def log_decision(self, query: str, decision: str, features: Dict[str, Any],
+                     mode: str, heuristic: Optional[str] = None, llm: Optional[str] = None) -> None:
+        """追加一条路由日志（JSONL），写入失败不影响检索"""
+        if not self.log_path:
+            return
+        record = {
+            "time": datetime.now().isoformat(),
+            "mode": mode,
+            "query": query,
+            "decision": decision,
+            "heuristic": heuristic,
+            "llm": llm,
+            "features": features,
+        }
+        try:
+            with self._log_lock:
+                os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except Exception as e:
+            print(f"⚠️ 路由日志写入失败: {e}")
@@ -1,21 +1,34 @@
 import json
-from typing import List, Dict, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Iterator, List, Dict, Optional, Tuple, Union
 from datetime import datetime
 
-from openai import OpenAI
-
+from client_factory import get_openai_client
 from config import (
-    OPENAI_API_KEY,
-    OPENAI_API_BASE,
     MODEL_NAME,
     TOP_K,
+    MAX_TOKENS,
     DEFAULT_RETRIEVAL_STRATEGY, 
     ENABLE_ADVANCED_RAG,
+    RETRIEVAL_ROUTER_MODE,
+    RETRIEVAL_PIPELINE_ENABLED,
+    REWRITE_SIMILARITY_THRESHOLD,
+    RETRIEVAL_PIPELINE_WORKERS,
+    RRF_K,
 )
 from vector_store import VectorStore
+from query_router import QueryRouter
+from context_packer import ContextPacker
+from history_manager import HistoryManager
 from tools import ToolManager
 from image_processor import ImageProcessor
 
+# 检索流水线线程池：查询改写与推测检索并发执行（与 VectorStore 混合检索的线程池分开，避免嵌套提交时互相占满）
+_PIPELINE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=RETRIEVAL_PIPELINE_WORKERS, thread_name_prefix="rag-pipeline"
+)
+
 
 class RAGAgent:
     def __init__(
@@ -24,9 +37,18 @@ class RAGAgent:
     ):
         self.model = model
 
-        self.client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_API_BASE)
+        self.client = get_openai_client()
 
         self.vector_store = VectorStore()
+        self.query_router = QueryRouter(
+            bm25_index=self.vector_store.bm25_index,
+            tokenizer=self.vector_store.sparse_tokenizer,
+        )
+        self.router_mode = RETRIEVAL_ROUTER_MODE
+        self.context_packer = ContextPacker()
+        self.history_manager = HistoryManager(client=self.client, model=self.model)
+        # 最近一次 retrieve_context 的上下文打包统计（token 数、去重 / 截断 / 未放入数）
+        self.last_context_stats: Dict = {}
         
         # 初始化图片处理器和工具管理器
         self.image_processor = ImageProcessor()
@@ -84,20 +106,18 @@ class RAGAgent:
     #     # 构造用于 RAG 检索的最终查询
     #     recent_context = f"最近的问题：{last_exchange[0]['content']}，最近的回答：{last_exchange[1]['content']}。"
     #     return f"{recent_context} 学生的新问题是：{current_query}"
-    def _construct_search_query(self, current_query: str, chat_history: Optional[List[Dict]] = None) -> str:
-        """
-        【修正】使用对话历史来提炼搜索关键词，提升多轮检索精度。
-        """
+    def _rewrite_prompt(self, current_query: str, chat_history: Optional[List[Dict]] = None) -> Optional[str]:
+        """构造多轮查询改写的提示词；不需要改写时返回 None（同步与异步版本共用）"""
         if not self.enable_advanced_rag:
-            return current_query
+            return None
             
         # 排除包含图片描述的增强查询，避免重复嵌套
         if current_query.startswith("【用户提交的图片分析结果】"):
-             return current_query
+             return None
 
         # 检查是否有足够的历史记录
         if not chat_history or len(chat_history) < 2:
-            return current_query
+            return None
         
         # 提取最近的问答对
         # 遍历历史记录，找到最新的 User 和 Assistant 消息
@@ -113,9 +133,9 @@ class RAGAgent:
             if len(relevant_history) >= 2:
                 break
         
-        # 如果找不到最新的问答对，则返回原始查询
+        # 如果找不到最新的问答对，则不改写
         if len(relevant_history) < 2:
-            return current_query
+            return None
         
         # 格式化上下文
         # relevant_history[0] 是最新的消息
@@ -133,7 +153,16 @@ class RAGAgent:
         任务：请提取或重写一个**精确且独立**的检索查询（用于搜索知识库），该查询应结合对话历史中的指代关系或省略信息。
         例如，如果最新提问是"它有什么缺点?"，而上一次提问是"什么是Transformer模型"，那么你应返回"Transformer模型的缺点"。
         """
-        
+        return context_for_llm
+
+    def _construct_search_query(self, current_query: str, chat_history: Optional[List[Dict]] = None) -> str:
+        """
+        【修正】使用对话历史来提炼搜索关键词，提升多轮检索精度。
+        """
+        context_for_llm = self._rewrite_prompt(current_query, chat_history)
+        if context_for_llm is None:
+            return current_query
+
         try:
             response = self.client.chat.completions.create(
                 model=self.model,
@@ -151,11 +180,10 @@ class RAGAgent:
             print(f"❌ 多轮查询增强失败 ({e})，使用原始查询。")
             return current_query
 
-    def _analyze_query_type(self, query: str) -> str:
-        """
-        【新增】使用 LLM 分析查询意图和类型，以决定最佳检索策略。
-        """
-        prompt = f"""
+    @staticmethod
+    def _route_prompt(query: str) -> str:
+        """LLM 检索策略分类的提示词（同步与异步版本共用）"""
+        return f"""
         你是一个专业的检索策略分析器。你的任务是根据用户查询的性质和意图，
         在严格限定的三种检索策略中，选择并返回最优化检索结果的那一个。
         分析时请同时考虑查询的**关键词稀有度**和**语义抽象度**。
@@ -180,6 +208,12 @@ class RAGAgent:
 
         请严格仅返回以下三种字符串之一，不添加任何解释、标点或其他文本：'HYBRID', 'BM25', 'DENSE'
         """
+
+    def _analyze_query_type(self, query: str) -> str:
+        """
+        【新增】使用 LLM 分析查询意图和类型，以决定最佳检索策略。
+        """
+        prompt = self._route_prompt(query)
         try:
             response = self.client.chat.completions.create(
                 model=self.model,
@@ -193,32 +227,29 @@ class RAGAgent:
             # 失败时默认使用 config 中的策略
             return DEFAULT_RETRIEVAL_STRATEGY
 
-    def retrieve_context(
-        self, query: str, chat_history: Optional[List[Dict]] = None, top_k: int = TOP_K
-    ) -> Tuple[str, List[Dict]]:
+    def _route_query(self, query: str) -> str:
         """
-        【重构】实现检索策略分派器 (Strategy Dispatcher)。
-        新增逻辑：如果 self.enable_advanced_rag 为 False，则强制使用 DENSE 策略。
+        选择检索策略：默认使用本地特征路由；router_mode 为 'llm' 时使用 LLM 分类，
+        本地路由结果同时写入日志以便离线对比。
         """
-        # 1. 构造用于检索的增强查询 (该函数内部会根据开关返回原始或增强查询)
-        # 注意：这里将 chat_history 传递给 _construct_search_query
-        search_query = self._construct_search_query(query, chat_history)
-
-        retrieved_docs = []
-        
-        # --- 策略决策开始 ---
-        if not self.enable_advanced_rag:
-            # 【退化逻辑】如果高级RAG开关关闭，强制退化到纯向量（DENSE）策略。
-            query_type = "DENSE"
-            print("⚙️ 高级RAG增强已关闭，强制退化到纯向量密集检索 (DENSE) 策略。")
-            
-        else:
-            # 启用高级策略：执行 LLM 策略分析
-            query_type = self._analyze_query_type(search_query)
-            print(f"⚙️ 高级RAG增强已启用 | LLM分析策略: {query_type}")
-            # 
-
-        # 2. 策略分派器 (Dispatching logic based on query_type)
+        heuristic, features = self.query_router.route(query)
+        if self.router_mode != "llm":
+            self.query_router.log_decision(query, heuristic, features, mode="heuristic", heuristic=heuristic)
+            return heuristic
+
+        llm_decision = self._analyze_query_type(query)
+        return self._resolve_llm_route(query, heuristic, features, llm_decision)
+
+    def _resolve_llm_route(self, query: str, heuristic: str, features: Dict, llm_decision: str) -> str:
+        """LLM 分类结果无效时回退到本地路由结果，并记录决策日志"""
+        decision = llm_decision if llm_decision in ("DENSE", "BM25", "HYBRID") else heuristic
+        self.query_router.log_decision(
+            query, decision, features, mode="llm", heuristic=heuristic, llm=llm_decision
+        )
+        return decision
+
+    def _dispatch_retrieval(self, search_query: str, query_type: str, top_k: int) -> List[Dict]:
+        """策略分派器：按检索策略执行对应的检索"""
         if query_type == 'DENSE':
             # 概念主导或退化策略：纯向量检索
             retrieved_docs = self.vector_store.search_dense(search_query, top_k=top_k)
@@ -243,62 +274,119 @@ class RAGAgent:
             else:
                  retrieved_docs = self.vector_store.search(search_query, top_k=top_k)
             print(f"⚠️ LLM 分析失败，回退到 DEFAULT 策略: {DEFAULT_RETRIEVAL_STRATEGY}")
-            
-        # --- 策略决策结束 ---
+        return retrieved_docs
 
-        # 3. 格式化检索结果（保持原逻辑不变）
-        context_parts = []
-        source_set = set()
-        
-        for doc in retrieved_docs:
-            content = doc["content"]
-            metadata = doc["metadata"]
-            
-            filename = metadata.get("filename", "未知文件")
-            page_number = metadata.get("page_number", 0)
-            
-            if page_number and page_number > 0:
-                source_label = "页码" if metadata.get("filetype") == ".pdf" else "幻灯片"
-                source_info = f"[来源：{filename}, {source_label} {page_number}]"
-                source_set.add(f"{filename}, {source_label} {page_number}")
-            else:
-                source_info = f"[来源：{filename}]"
-                source_set.add(filename)
-                
-            context_parts.append(f"{source_info}\n{content}\n---")
+    def _route_and_retrieve(self, search_query: str, top_k: int) -> List[Dict]:
+        """选择策略并检索；高级RAG关闭时强制使用 DENSE"""
+        if not self.enable_advanced_rag:
+            # 【退化逻辑】如果高级RAG开关关闭，强制退化到纯向量（DENSE）策略。
+            query_type = "DENSE"
+            print("⚙️ 高级RAG增强已关闭，强制退化到纯向量密集检索 (DENSE) 策略。")
+        else:
+            # 启用高级策略：本地路由（或 LLM 分类）选择策略
+            query_type = self._route_query(search_query)
+            print(f"⚙️ 高级RAG增强已启用 | 路由模式: {self.router_mode} | 检索策略: {query_type}")
+        return self._dispatch_retrieval(search_query, query_type, top_k)
+
+    def _query_similarity(self, a: str, b: str) -> float:
+        """改写前后查询的词项 Jaccard 相似度"""
+        tokens_a = set(self.vector_store.sparse_tokenizer.tokenize(a))
+        tokens_b = set(self.vector_store.sparse_tokenizer.tokenize(b))
+        if not tokens_a and not tokens_b:
+            return 1.0 if a.strip() == b.strip() else 0.0
+        return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
+    @staticmethod
+    def _merge_retrievals(primary: List[Dict], secondary: List[Dict], top_k: int) -> List[Dict]:
+        """RRF 合并两次检索结果；同分时改写查询（primary）的结果优先"""
+        fused_scores: Dict[str, float] = {}
+        doc_map: Dict[str, Dict] = {}
+        for docs in (primary, secondary):
+            for rank, doc in enumerate(docs, 1):
+                key = doc.get("id") or doc["content"]
+                fused_scores[key] = fused_scores.get(key, 0) + 1 / (RRF_K + rank)
+                doc_map.setdefault(key, doc)
+        ranked = sorted(fused_scores, key=fused_scores.get, reverse=True)
+        return [doc_map[key] for key in ranked[:top_k]]
+
+    def _pipelined_retrieve(self, query: str, chat_history: Optional[List[Dict]], top_k: int) -> List[Dict]:
+        """
+        流水线检索：查询改写在后台执行的同时，先用原始查询推测性地检索；
+        改写结果与原始查询差异明显时才进行第二次检索，并与推测结果 RRF 合并。
+        """
+        rewrite_future = _PIPELINE_EXECUTOR.submit(self._construct_search_query, query, chat_history)
+        speculative_future = _PIPELINE_EXECUTOR.submit(self._route_and_retrieve, query, top_k)
 
-        context_string = "\n".join(context_parts)
-        
-        return context_string, retrieved_docs
+        search_query = rewrite_future.result()
+        speculative_docs = speculative_future.result()
+
+        similarity = self._query_similarity(query, search_query)
+        if similarity >= REWRITE_SIMILARITY_THRESHOLD:
+            print(f"⚡ 改写查询与原始查询相近 (相似度 {similarity:.2f})，直接使用推测检索结果")
+            return speculative_docs
+
+        print(f"🔁 改写查询差异较大 (相似度 {similarity:.2f})，使用改写查询补充检索: {search_query}")
+        rewritten_docs = self._route_and_retrieve(search_query, top_k)
+        return self._merge_retrievals(rewritten_docs, speculative_docs, top_k)
+
+    def retrieve_context(
+        self, query: str, chat_history: Optional[List[Dict]] = None, top_k: int = TOP_K
+    ) -> Tuple[str, List[Dict]]:
+        """
+        【重构】实现检索策略分派器 (Strategy Dispatcher)。
+        新增逻辑：如果 self.enable_advanced_rag 为 False，则强制使用 DENSE 策略。
+        启用检索流水线时，查询改写与原始查询的推测检索并发执行。
+        """
+        if RETRIEVAL_PIPELINE_ENABLED and self.enable_advanced_rag and chat_history and len(chat_history) >= 2:
+            retrieved_docs = self._pipelined_retrieve(query, chat_history, top_k)
+        else:
+            # 1. 构造用于检索的增强查询 (该函数内部会根据开关返回原始或增强查询)
+            # 注意：这里将 chat_history 传递给 _construct_search_query
+            search_query = self._construct_search_query(query, chat_history)
+            # 2. 策略决策与分派
+            retrieved_docs = self._route_and_retrieve(search_query, top_k)
+
+        # 3. 按 token 预算打包检索结果：去除重复文档块，超出预算的在句子边界处截断
+        return self._pack_context(retrieved_docs)
+
+    def _pack_context(self, retrieved_docs: List[Dict]) -> Tuple[str, List[Dict]]:
+        """打包检索结果为上下文字符串，返回 (上下文, 实际放入的文档块)，统计信息记入 last_context_stats"""
+        context, docs, self.last_context_stats = self._pack_context_with_stats(retrieved_docs)
+        return context, docs
+
+    def _pack_context_with_stats(self, retrieved_docs: List[Dict]) -> Tuple[str, List[Dict], Dict]:
+        """打包检索结果，返回 (上下文, 实际放入的文档块, 统计信息)，不修改实例状态，可并发调用"""
+        packed = self.context_packer.pack(retrieved_docs, self._source_label)
+        stats = {key: packed[key] for key in ("tokens", "duplicates", "truncated", "omitted")}
+        print(
+            f"📦 上下文打包：{len(packed['docs'])}/{len(retrieved_docs)} 个文档块，"
+            f"{packed['tokens']}/{self.context_packer.max_tokens} tokens，"
+            f"去重 {packed['duplicates']}，截断 {packed['truncated']}，未放入 {packed['omitted']}"
+        )
+
+        return packed["context"], packed["docs"], stats
+
+    @staticmethod
+    def _source_label(doc: Dict) -> str:
+        """文档块的来源标签，如 [来源：文件名, 页码 X]"""
+        metadata = doc["metadata"]
+        filename = metadata.get("filename", "未知文件")
+        page_number = metadata.get("page_number", 0)
+
+        if page_number and page_number > 0:
+            source_label = "页码" if metadata.get("filetype") == ".pdf" else "幻灯片"
+            return f"[来源：{filename}, {source_label} {page_number}]"
+        return f"[来源：{filename}]"
 
     def generate_response(
         self,
         query: str,
         context: str,
         chat_history: Optional[List[Dict]] = None,
+        chat_id: Optional[str] = None,
     ) -> str:
         """生成回答"""
-        messages = [{"role": "system", "content": self.system_prompt}]
-
-        if chat_history:
-            messages.extend(chat_history)
-
-        user_text = f"""
-        请基于下面的【课程内容】来回答学生的问题。请严格遵循系统提示词中的所有要求。
-
-        **优先级策略：**
-        1. 首先基于【课程内容】回答问题
-        2. 只有在【课程内容】信息不足时，才使用工具获取补充信息
-
-        【课程内容】
-        {context}
-
-        {query}
-
-        如果【课程内容】无法提供足够的信息，你可以选择使用提供的工具搜索网络信息、进行计算或获取当前时间。
-        """
-
-        messages.append({"role": "user", "content": user_text})
+        messages = self._build_messages(query, context, chat_history, chat_id)
         
         try:
             response = self.client.chat.completions.create(
@@ -307,7 +395,7 @@ class RAGAgent:
                 tools=self.tool_manager.get_tool_definitions(),
                 tool_choice="auto",
                 temperature=0.7,
-                max_tokens=1500
+                max_tokens=MAX_TOKENS
             )
 
             response_message = response.choices[0].message
@@ -323,7 +411,7 @@ class RAGAgent:
                     model=self.model,
                     messages=messages,
                     temperature=0.7,
-                    max_tokens=1500
+                    max_tokens=MAX_TOKENS
                 )
 
                 return final_response.choices[0].message.content
@@ -333,6 +421,140 @@ class RAGAgent:
         except Exception as e:
             return f"生成回答时出错: {str(e)}"
 
+    def generate_response_stream(
+        self,
+        query: str,
+        context: str,
+        chat_history: Optional[List[Dict]] = None,
+        chat_id: Optional[str] = None,
+    ) -> Iterator[str]:
+        """
+        流式生成回答，逐段产出文本增量。
+        模型发起工具调用时，先按 index 拼接流式返回的 tool_call 片段，执行工具后继续流式输出后续回答。
+        """
+        messages = self._build_messages(query, context, chat_history, chat_id)
+
+        try:
+            stream = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                tools=self.tool_manager.get_tool_definitions(),
+                tool_choice="auto",
+                temperature=0.7,
+                max_tokens=MAX_TOKENS,
+                stream=True
+            )
+
+            content_parts = []
+            tool_call_parts: Dict[int, Dict] = {}
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content_parts.append(delta.content)
+                    yield delta.content
+                self._accumulate_tool_call_deltas(tool_call_parts, delta)
+
+            if not tool_call_parts:
+                return
+
+            tool_calls, assistant_message = self._assemble_tool_calls(content_parts, tool_call_parts)
+            tool_results = self._execute_tool_calls(tool_calls)
+
+            messages.append(assistant_message)
+            messages.extend(tool_results)
+
+            final_stream = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=MAX_TOKENS,
+                stream=True
+            )
+            for chunk in final_stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+        except Exception as e:
+            yield f"生成回答时出错: {str(e)}"
+
+    @staticmethod
+    def _accumulate_tool_call_deltas(tool_call_parts: Dict[int, Dict], delta) -> None:
+        """按 index 拼接流式返回的 tool_call 片段"""
+        for tool_call_delta in delta.tool_calls or []:
+            part = tool_call_parts.setdefault(
+                tool_call_delta.index, {"id": "", "name": "", "arguments": ""}
+            )
+            if tool_call_delta.id:
+                part["id"] = tool_call_delta.id
+            if tool_call_delta.function:
+                part["name"] += tool_call_delta.function.name or ""
+                part["arguments"] += tool_call_delta.function.arguments or ""
+
+    @staticmethod
+    def _assemble_tool_calls(content_parts: List[str], tool_call_parts: Dict[int, Dict]) -> Tuple[List, Dict]:
+        """由拼接完成的片段构造工具调用对象，以及追加到消息列表中的 assistant 消息"""
+        tool_calls = [
+            SimpleNamespace(
+                id=part["id"],
+                function=SimpleNamespace(name=part["name"], arguments=part["arguments"]),
+            )
+            for _, part in sorted(tool_call_parts.items())
+        ]
+        assistant_message = {
+            "role": "assistant",
+            "content": "".join(content_parts) or None,
+            "tool_calls": [
+                {
+                    "id": tool_call.id,
+                    "type": "function",
+                    "function": {
+                        "name": tool_call.function.name,
+                        "arguments": tool_call.function.arguments,
+                    },
+                }
+                for tool_call in tool_calls
+            ],
+        }
+        return tool_calls, assistant_message
+
+    def _build_messages(
+        self,
+        query: str,
+        context: str,
+        chat_history: Optional[List[Dict]] = None,
+        chat_id: Optional[str] = None,
+    ) -> List[Dict]:
+        """
+        构造发送给模型的消息列表。
+        对话历史经 HistoryManager 处理：最近几轮原样保留，更早的轮次以摘要形式附在系统提示词后。
+        """
+        summary, history = self.history_manager.prepare(chat_history, chat_id)
+        system_prompt = self.system_prompt
+        if summary:
+            system_prompt = f"{system_prompt}\n\n【之前对话的摘要】\n{summary}"
+        messages = [{"role": "system", "content": system_prompt}]
+        messages.extend(history)
+
+        user_text = f"""
+        请基于下面的【课程内容】来回答学生的问题。请严格遵循系统提示词中的所有要求。
+
+        **优先级策略：**
+        1. 首先基于【课程内容】回答问题
+        2. 只有在【课程内容】信息不足时，才使用工具获取补充信息
+
+        【课程内容】
+        {context}
+
+        {query}
+
+        如果【课程内容】无法提供足够的信息，你可以选择使用提供的工具搜索网络信息、进行计算或获取当前时间。
+        """
+
+        messages.append({"role": "user", "content": user_text})
+        return messages
+
     def _execute_tool_calls(self, tool_calls) -> List[Dict]:
         """执行工具调用并返回结果 (保持原逻辑不变)"""
         tool_results = []
@@ -399,26 +621,49 @@ class RAGAgent:
         return tool_results
 
     def answer_question(
-        self, query: str, chat_history: Optional[List[Dict]] = None, top_k: int = TOP_K
+        self,
+        query: str,
+        chat_history: Optional[List[Dict]] = None,
+        top_k: int = TOP_K,
+        chat_id: Optional[str] = None,
     ) -> str:
         """回答问题"""
-        
+        # 对话摘要与检索并发更新
+        self.history_manager.prefetch(chat_history, chat_id)
+
         # 【修改】传入 chat_history 以支持多轮检索增强和策略分派
         context, retrieved_docs = self.retrieve_context(query, chat_history=chat_history, top_k=top_k)
 
         if not context:
             context = "（未检索到特别相关的课程材料）"
 
-        answer = self.generate_response(query, context, chat_history)
+        answer = self.generate_response(query, context, chat_history, chat_id)
 
         return answer
 
+    def answer_question_stream(
+        self,
+        query: str,
+        chat_history: Optional[List[Dict]] = None,
+        top_k: int = TOP_K,
+        chat_id: Optional[str] = None,
+    ) -> Iterator[str]:
+        """回答问题（流式）：检索在调用时完成，返回回答文本增量的生成器"""
+        self.history_manager.prefetch(chat_history, chat_id)
+        context, retrieved_docs = self.retrieve_context(query, chat_history=chat_history, top_k=top_k)
+
+        if not context:
+            context = "（未检索到特别相关的课程材料）"
+
+        return self.generate_response_stream(query, context, chat_history, chat_id)
+
     def answer_image_question(
         self,
         query: str,
         image_base64: str,
         chat_history: Optional[List[Dict]] = None,
-        top_k: int = TOP_K
+        top_k: int = TOP_K,
+        chat_id: Optional[str] = None,
     ) -> str:
         """回答包含图片的问题"""
         try:
@@ -430,17 +675,10 @@ class RAGAgent:
                 return "❌ 图片分析失败，请检查图片格式或重试。"
 
             # 2. 将图片描述和用户问题合并，构造新的查询
-            enhanced_query = f"""
-            【用户提交的图片分析结果】
-            {image_description}
-
-            【用户问题】
-            {query}
-
-            请基于用户提交的图片分析结果和相关课程资料，专业地回答用户的问题。
-            """
+            enhanced_query = self._image_query(query, image_description)
 
-            # 3. 使用RAG流程回答问题
+            # 3. 使用RAG流程回答问题（对话摘要与检索并发更新）
+            self.history_manager.prefetch(chat_history, chat_id)
             print("🔍 正在检索相关课程内容...")
             # 【修改】传入 chat_history 以支持多轮检索增强和策略分派
             context, retrieved_docs = self.retrieve_context(enhanced_query, chat_history=chat_history, top_k=top_k)
@@ -450,7 +688,7 @@ class RAGAgent:
 
             # 4. 生成最终回答
             print("🤔 正在生成回答...")
-            answer = self.generate_response(enhanced_query, context, chat_history)
+            answer = self.generate_response(enhanced_query, context, chat_history, chat_id)
 
             return answer
 
@@ -459,6 +697,52 @@ class RAGAgent:
             print(f"❌ {error_msg}")
             return f"❌ {error_msg}"
 
+    def answer_image_question_stream(
+        self,
+        query: str,
+        image_base64: str,
+        chat_history: Optional[List[Dict]] = None,
+        top_k: int = TOP_K,
+        chat_id: Optional[str] = None,
+    ) -> Iterator[str]:
+        """回答包含图片的问题（流式）：图片分析与检索在调用时完成，返回回答文本增量的生成器"""
+        try:
+            print("🖼️ 正在分析图片...")
+            image_description = self._analyze_image_with_vl(image_base64)
+
+            if not image_description:
+                return iter(["❌ 图片分析失败，请检查图片格式或重试。"])
+
+            enhanced_query = self._image_query(query, image_description)
+
+            self.history_manager.prefetch(chat_history, chat_id)
+            print("🔍 正在检索相关课程内容...")
+            context, retrieved_docs = self.retrieve_context(enhanced_query, chat_history=chat_history, top_k=top_k)
+
+            if not context:
+                context = "（未检索到特别相关的课程材料）"
+
+            print("🤔 正在生成回答...")
+            return self.generate_response_stream(enhanced_query, context, chat_history, chat_id)
+
+        except Exception as e:
+            error_msg = f"图片问答处理失败: {str(e)}"
+            print(f"❌ {error_msg}")
+            return iter([f"❌ {error_msg}"])
+
+    @staticmethod
+    def _image_query(query: str, image_description: str) -> str:
+        """将图片描述和用户问题合并为新的查询"""
+        return f"""
+            【用户提交的图片分析结果】
+            {image_description}
+
+            【用户问题】
+            {query}
+
+            请基于用户提交的图片分析结果和相关课程资料，专业地回答用户的问题。
+            """
+
     def _analyze_image_with_vl(self, image_base64: str) -> str:
         """使用Qwen-VL分析图片，返回文字描述 (保持原逻辑不变)"""
         try:
@@ -0,0 +1,121 @@
+"""
+稀疏检索分词器
+为 BM25 索引提供可插拔的分词流程：中文按字二元组（bigram）切分，日文假名与韩文同样按字二元组，
+英文、数字及希腊文、西里尔文等其他字母文字按词切分，可选去除停用词。入库文档与查询使用同一个分词器。
+"""
+
+import re
+import unicodedata
+from typing import List, Optional, Set
+
+# CJK 统一汉字（含扩展 A 与兼容汉字）
+_CJK_RANGES = "㐀-䶿一-鿿豈-﫿"
+# 日文假名与韩文（谚文音节及字母），词间无空格或以字母拼写，同样按字二元组切分
+_KANA_HANGUL_RANGES = "぀-ヿㇰ-ㇿᄀ-ᇿ㄰-㆏가-힯"
+_CJK_RUN = re.compile(f"[{_CJK_RANGES}]+")
+# 词：除汉字、假名、韩文外的字母与数字（英文、希腊文、西里尔文等），允许以 . _ + - 连接
+_WORD_CHARS = f"[^\\W_{_CJK_RANGES}{_KANA_HANGUL_RANGES}]"
+_TOKEN_PATTERN = re.compile(
+    f"(?P<cjk>[{_CJK_RANGES}]+)|(?P<kana_hangul>[{_KANA_HANGUL_RANGES}]+)"
+    f"|(?P<word>{_WORD_CHARS}+(?:[._+-]{_WORD_CHARS}+)*)"
+)
+
+DEFAULT_CJK_STOPWORDS = {
+    # 单字虚词
+    "的", "了", "着", "是", "在", "和", "与", "及", "或", "等", "也", "就", "都", "而",
+    "被", "把", "这", "那", "之", "其", "为", "对", "个", "我", "你", "他", "她", "它",
+    "们", "吗", "呢", "吧", "啊", "呀", "么", "则", "即", "又", "并", "且", "从", "向",
+    # 常见双字虚词
+    "我们", "你们", "他们", "它们", "什么", "这个", "那个", "这些", "那些", "一个",
+    "可以", "以及", "因为", "所以", "如果", "但是", "而且", "或者", "还是", "就是",
+    "是否", "怎么", "如何", "为什",
+}
+
+DEFAULT_LATIN_STOPWORDS = {
+    "a", "an", "the", "of", "to", "in", "on", "at", "for", "with", "by", "from", "as",
+    "is", "are", "was", "were", "be", "been", "and", "or", "not", "this", "that",
+    "these", "those", "it", "its", "what", "which", "how", "do", "does",
+}
+
+
+class SparseTokenizer:
+    """稀疏检索分词器
+
+    mode:
+        "whitespace"  按空白切分（旧版行为）
+        "bigram"      对所有非空白字符串按字切二元组
+        "mixed"       中文、日文假名、韩文按字二元组，英文、数字与其他字母文字按词（默认）
+    """
+
+    MODES = ("whitespace", "bigram", "mixed")
+    # 分词规则变化时递增，使按旧规则统计词频的索引重建
+    MIXED_VERSION = 2
+
+    def __init__(
+        self,
+        mode: str = "mixed",
+        remove_stopwords: bool = True,
+        stopwords: Optional[Set[str]] = None,
+    ):
+        if mode not in self.MODES:
+            raise ValueError(f"不支持的分词模式: {mode}，可选: {self.MODES}")
+        self.mode = mode
+        self.remove_stopwords = remove_stopwords
+        self.stopwords = stopwords if stopwords is not None else (
+            DEFAULT_CJK_STOPWORDS | DEFAULT_LATIN_STOPWORDS
+        )
+
+    @property
+    def signature(self) -> str:
+        """分词配置签名，写入索引元数据；配置变化时索引需要重建"""
+        if self.mode == "whitespace":
+            return self.mode
+        mode = f"mixed-v{self.MIXED_VERSION}" if self.mode == "mixed" else self.mode
+        return f"{mode}{'+stopwords' if self.remove_stopwords else ''}"
+
+    def __call__(self, text: str) -> List[str]:
+        return self.tokenize(text)
+
+    def tokenize(self, text: str) -> List[str]:
+        if not text:
+            return []
+        if self.mode == "whitespace":
+            return text.split()
+
+        # 全角转半角、统一小写
+        text = unicodedata.normalize("NFKC", text).lower()
+        if self.mode == "bigram":
+            tokens = []
+            for run in text.split():
+                tokens.extend(self._bigrams(run))
+        else:
+            tokens = []
+            for match in _TOKEN_PATTERN.finditer(text):
+                if match.group("cjk"):
+                    tokens.extend(self._bigrams(match.group("cjk")))
+                elif match.group("kana_hangul"):
+                    tokens.extend(self._bigrams(match.group("kana_hangul")))
+                else:
+                    tokens.append(match.group("word"))
+
+        if self.remove_stopwords:
+            tokens = [token for token in tokens if not self._is_stopword(token)]
+        return tokens
+
+    @staticmethod
+    def _bigrams(run: str) -> List[str]:
+        """字二元组；长度为 1 的片段保留单字"""
+        if len(run) == 1:
+            return [run]
+        return [run[i:i + 2] for i in range(len(run) - 1)]
+
+    def _is_stopword(self, token: str) -> bool:
+        if token in self.stopwords:
+            return True
+        # 两个字都是停用字的中文二元组（如“是在”“的一”）同样视为停用词
+        return (
+            len(token) == 2
+            and _CJK_RUN.fullmatch(token) is not None
+            and token[0] in self.stopwords
+            and token[1] in self.stopwords
+        )
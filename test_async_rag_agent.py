@@ -0,0 +1,80 @@
+"""异步问答并发回归测试：不同对话的摘要不能串到彼此的系统提示词中"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from async_rag_agent import AsyncRAGAgent
+from history_manager import HistoryManager
+from rag_agent import RAGAgent
+
+
+class _SummaryClient:
+    """同步客户端：摘要请求返回 "SUMMARY OF: " + 提示词中的新增对话"""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, messages, **kwargs):
+        transcript = messages[0]["content"].split("【新增对话】", 1)[1].strip()
+        message = SimpleNamespace(content=f"SUMMARY OF: {transcript}")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class _EchoAsyncClient:
+    """异步客户端：回答内容为收到的系统提示词，便于检查其中的摘要"""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, messages, **kwargs):
+        await asyncio.sleep(0.01)
+        message = SimpleNamespace(content=messages[0]["content"], tool_calls=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def _history(student: str, turns: int = 4):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"{student} secret question {i}"})
+        messages.append({"role": "assistant", "content": f"answer for {student} {i}"})
+    return messages
+
+
+@pytest.fixture
+def async_agent(monkeypatch):
+    agent = RAGAgent.__new__(RAGAgent)
+    agent.model = "test-model"
+    agent.system_prompt = "SYSTEM"
+    agent.enable_advanced_rag = False
+    agent.tool_manager = SimpleNamespace(get_tool_definitions=lambda: [])
+    agent.history_manager = HistoryManager(client=_SummaryClient(), model="test-model", keep_turns=1)
+
+    async_agent = AsyncRAGAgent(agent=agent)
+    monkeypatch.setattr(AsyncRAGAgent, "client", property(lambda self: _EchoAsyncClient()))
+
+    async def retrieve_context(query, chat_history=None, top_k=None):
+        await asyncio.sleep(0.01)
+        return "", []
+
+    monkeypatch.setattr(async_agent, "retrieve_context", retrieve_context)
+    return async_agent
+
+
+def test_concurrent_chats_keep_their_own_summary(async_agent):
+    async def run():
+        return await asyncio.gather(*[
+            async_agent.answer_question("next", _history(student), chat_id=f"chat-{student}")
+            for student in ("ALICE", "BOB") * 3
+        ])
+
+    for student, system_prompt in zip(("ALICE", "BOB") * 3, asyncio.run(run())):
+        other = "BOB" if student == "ALICE" else "ALICE"
+        assert f"{student} secret question 0" in system_prompt
+        assert other not in system_prompt
+
+
+def test_answer_question_requires_chat_id(async_agent):
+    with pytest.raises(ValueError):
+        asyncio.run(async_agent.answer_question("next", _history("ALICE"), chat_id=""))
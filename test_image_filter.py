@@ -0,0 +1,48 @@
+"""图片预过滤回归测试：白底线条图、文字页不能被当作近空白图片跳过"""
+
+import os
+
+import pytest
+from PIL import Image, ImageDraw
+
+from image_filter import ImageFilter
+
+WORD2VEC_DIAGRAM = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "images_extracted", "3.1 词向量 2025_s27_Picture 2.png"
+)
+
+
+def _line_diagram(path: str) -> str:
+    """白底细线示意图：几个方框、连线与箭头，前景像素只占很小一部分"""
+    image = Image.new("RGB", (1568, 539), "white")
+    draw = ImageDraw.Draw(image)
+    for x in (100, 600, 1100):
+        draw.rectangle((x, 200, x + 300, 320), outline="black", width=2)
+    draw.line((400, 260, 600, 260), fill="black", width=2)
+    draw.line((900, 260, 1100, 260), fill="black", width=2)
+    draw.polygon([(1100, 260), (1085, 252), (1085, 268)], fill="black")
+    image.save(path)
+    return path
+
+
+def test_white_background_line_diagram_is_kept(tmp_path):
+    path = _line_diagram(str(tmp_path / "diagram.png"))
+    reason, fingerprint = ImageFilter().inspect(path)
+    assert reason is None
+    assert fingerprint is not None
+
+
+@pytest.mark.skipif(not os.path.exists(WORD2VEC_DIAGRAM), reason="课程图片不存在")
+def test_course_word2vec_diagram_is_kept():
+    assert ImageFilter().inspect(WORD2VEC_DIAGRAM)[0] is None
+
+
+def test_blank_and_solid_images_are_skipped(tmp_path):
+    solid = tmp_path / "solid.png"
+    Image.new("RGB", (400, 300), (30, 30, 30)).save(solid)
+    transparent = tmp_path / "transparent.png"
+    Image.new("RGBA", (400, 300), (0, 0, 0, 0)).save(transparent)
+
+    image_filter = ImageFilter()
+    assert image_filter.inspect(str(solid))[0] == "blank"
+    assert image_filter.inspect(str(transparent))[0] == "blank"
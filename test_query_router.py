@@ -0,0 +1,34 @@
+"""检索策略路由回归测试：概念性问题、章节编号与模型名不能被路由为纯 BM25"""
+
+import pytest
+
+from query_router import QueryRouter
+
+
+@pytest.fixture
+def router():
+    return QueryRouter(log_path=None)
+
+
+@pytest.mark.parametrize("query", [
+    "什么是BM25",
+    "GloVe和word2vec的区别是什么",
+    "3.1 词向量",
+    "第3章讲了什么",
+])
+def test_conceptual_and_section_queries_keep_dense_retrieval(router, query):
+    decision, _ = router.route(query)
+    assert decision != "BM25"
+
+
+@pytest.mark.parametrize("query", [
+    "load_pdf 函数",
+    "BERT 有 12 层吗",
+])
+def test_code_and_standalone_numbers_use_bm25(router, query):
+    decision, _ = router.route(query)
+    assert decision == "BM25"
+
+
+def test_digits_inside_identifiers_are_not_counted(router):
+    assert router.extract_features("word2vec 和 BM25")["digits"] == 0
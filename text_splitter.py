@@ -1,15 +1,43 @@
 import re
-from typing import List, Dict
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from operator import add
+from typing import List, Dict, Optional, Sequence, Tuple
 from tqdm import tqdm
 from image_processor import ImageProcessor 
+from image_filter import ImageFilter
+from token_counter import get_token_counter
+from config import IMAGE_FILTER_ENABLED, CHUNK_UNIT, CHUNK_MAX_TOKENS
 
 class TextSplitter:
-    def __init__(self, chunk_size: int, chunk_overlap: int):
+    # 分隔符位置按块增量扫描，每块的字符数
+    INDEX_BLOCK_SIZE = 64 * 1024
+
+    def __init__(
+        self,
+        chunk_size: int,
+        chunk_overlap: int,
+        chunk_unit: str = CHUNK_UNIT,
+        max_tokens: int = CHUNK_MAX_TOKENS,
+    ):
+        """
+        chunk_unit 为 "char" 时 chunk_size / chunk_overlap 按字符计，为 "token" 时按分词器 token 计；
+        两种单位下每个文档块都不超过 max_tokens 个 token。
+        """
+        if chunk_unit not in ("char", "token"):
+            raise ValueError(f"不支持的切分单位: {chunk_unit}")
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.chunk_unit = chunk_unit
+        self.max_tokens = max_tokens
+        self.token_counter = get_token_counter()
 
         # 初始化图像处理器
         self.image_processor = ImageProcessor() 
+        self.image_filter = ImageFilter() if IMAGE_FILTER_ENABLED else None
+        # (文件路径, 图片路径) -> 首次附完整描述的页面，跨多次 split_documents 调用保留
+        # （入库流水线按批次调用），同一文件中重复出现的图片只描述一次
+        self.image_first_seen: Dict[tuple, str] = {}
 
         self.separators = [
             "\n\n",  # 两个换行符（段落）
@@ -20,6 +48,129 @@ class TextSplitter:
             "",      # 任意字符（最后的兜底策略）
         ]
 
+        # 预编译分隔符（不含最后的 "" 兜底），分为三类：
+        # - literal：单个普通字符（如 " "、"\n"），直接用 str.split 定位；
+        # - run：同一字符重复组成（如 "\n\n"），会与自身重叠，按连续字符段记录；
+        # - pattern：其余正则，各次出现互不重叠。
+        self._separator_specs: List[Tuple[str, object]] = []
+        for sep in self.separators[:-1]:
+            plain = all(ch not in ".^$*+?{}[]\\|()" for ch in sep)
+            if plain and len(sep) == 1:
+                self._separator_specs.append(("literal", sep))
+            elif plain and len(set(sep)) == 1:
+                self._separator_specs.append(("run", (re.compile(f"({re.escape(sep[0])}{{{len(sep)},}})"), len(sep))))
+            else:
+                try:
+                    pattern = re.compile(f"({sep})")
+                except re.error:
+                    # 正则表达式解析失败时跳过该分隔符
+                    continue
+                self._separator_specs.append(("pattern", pattern))
+
+    def _scan_boundaries(self, text: str, level: int, start: int, end: int) -> Tuple[List[int], List[int]]:
+        """
+        扫描 text[start:end]，返回第 level 个分隔符各次出现的 (起点列表, 终点列表)，均为全文坐标且递增。
+        split 的结果为 [文本, 分隔符, 文本, ..., 文本]，长度的前缀和依次就是各分隔符的起点与终点，
+        整个过程在 C 层完成，不需要为每个匹配创建 Match 对象。
+        """
+        kind, spec = self._separator_specs[level]
+        if kind == "literal":
+            # 第 i 个分隔符之前有 i 个分隔符字符，加上前面各段文本的长度即为其起点
+            lengths = list(accumulate(map(len, text[start:end].split(spec)), initial=start))
+            starts = list(map(add, lengths[1:-1], range(len(lengths) - 2)))
+            return starts, [offset + 1 for offset in starts]
+        if kind == "run":
+            spec = spec[0]
+        if spec.groups == 1:
+            offsets = list(accumulate(map(len, spec.split(text[start:end])), initial=start))
+            return offsets[1:-1:2], offsets[2::2]
+        spans = [match.span() for match in spec.finditer(text[start:end])]
+        return [span[0] + start for span in spans], [span[1] + start for span in spans]
+
+    def _extend_index(self, text: str, index: Dict[int, list], level: int, search_start: int, end_index: int) -> None:
+        """
+        保证 index[level] 覆盖窗口 [search_start, end_index]，每次向后多扫描一个数据块以减少调用次数。
+        窗口只会单调右移：与已扫描区域不相交时丢弃旧结果重新扫描，相交时只扫描新增部分，
+        因此每个字符只被扫描常数次；某个分隔符从未被用到的区域不会被扫描。
+        """
+        entry = index.get(level)
+        if entry is not None and entry[2] >= end_index:
+            return
+        if entry is None or search_start >= entry[2]:
+            scan_to = min(len(text), max(end_index, search_start + self.INDEX_BLOCK_SIZE))
+            starts, ends = self._scan_boundaries(text, level, search_start, scan_to)
+            index[level] = [starts, ends, scan_to]
+            return
+
+        starts, ends, scanned_to = entry
+        scan_to = min(len(text), max(end_index, scanned_to + self.INDEX_BLOCK_SIZE))
+        scan_from = search_start
+        if ends and ends[-1] > scan_from:
+            if self._separator_specs[level][0] == "run" and ends[-1] == scanned_to:
+                # 末尾的连续字符段可能被上次的扫描边界截断，去掉后从其起点重新扫描
+                ends.pop()
+                scan_from = max(starts.pop(), search_start)
+            else:
+                # 上一个匹配之后到已扫描边界之间没有完整的匹配，但可能有跨越边界的匹配
+                scan_from = ends[-1]
+        new_starts, new_ends = self._scan_boundaries(text, level, scan_from, scan_to)
+        starts.extend(new_starts)
+        ends.extend(new_ends)
+        entry[2] = scan_to
+
+    def _find_split(self, text: str, index: Dict[int, list], search_start: int, end_index: int) -> Optional[int]:
+        """
+        按分隔符优先级，在 [search_start, end_index] 内找最靠后的分隔符并返回其结束位置，
+        结果与在该窗口上逐个分隔符执行 re.finditer、取最后一个匹配一致。
+        """
+        for level, (kind, spec) in enumerate(self._separator_specs):
+            self._extend_index(text, index, level, search_start, end_index)
+            starts, ends, _ = index[level]
+
+            if kind != "run":
+                # 最后一个完整落在窗口内的匹配
+                j = bisect_right(ends, end_index) - 1
+                if j >= 0 and starts[j] >= search_start:
+                    return ends[j]
+                continue
+
+            # run 类型：窗口内从每段的起点开始以步长 step 不重叠地匹配
+            step = spec[1]
+            j = bisect_left(starts, end_index) - 1
+            while j >= 0 and ends[j] > search_start:
+                seg_start = max(starts[j], search_start)
+                seg_end = min(ends[j], end_index)
+                if seg_end - seg_start >= step:
+                    return seg_start + (seg_end - seg_start) // step * step
+                j -= 1
+        return None
+
+    def _find_split_in_window(self, text: str, search_start: int, end_index: int) -> Optional[int]:
+        """
+        只在窗口 [search_start, end_index] 内查找切分点，结果与 _find_split 一致。
+        相邻窗口互不重叠时每个字符最多被扫描一次，比维护分隔符索引更省。
+        """
+        for kind, spec in self._separator_specs:
+            if kind == "literal":
+                position = text.rfind(spec, search_start, end_index)
+                if position >= 0:
+                    return position + 1
+                continue
+
+            pattern = spec[0] if kind == "run" else spec
+            last = None
+            for match in pattern.finditer(text[search_start:end_index]):
+                if kind != "run" or match.end() - match.start() >= spec[1]:
+                    last = match
+            if last is None:
+                continue
+            if kind != "run":
+                return search_start + last.end()
+            # run 类型：与 finditer 从段起点开始以步长 step 不重叠匹配的最后一个结束位置一致
+            step = spec[1]
+            return search_start + last.start() + (last.end() - last.start()) // step * step
+        return None
+
     def split_text(self, text: str) -> List[str]:
         """将文本切分为块
 
@@ -33,85 +184,148 @@ class TextSplitter:
         if not text:
             return []
 
+        if self.chunk_unit == "token":
+            return self._split_by_tokens(text, min(self.chunk_size, self.max_tokens), self.chunk_overlap)
+
+        chunks = self._split_units(text, self.chunk_size, self.chunk_overlap, range(len(text) + 1))
+        # 按字符切分的块（尤其是中文）仍可能超过 token 上限，超限的块再按 token 切分
+        limited = []
+        for chunk in chunks:
+            if self.token_counter.count(chunk) > self.max_tokens:
+                limited.extend(self._split_by_tokens(chunk, self.max_tokens, self.chunk_overlap))
+            else:
+                limited.append(chunk)
+        return limited
+
+    def _split_by_tokens(self, text: str, size: int, overlap: int) -> List[str]:
+        """按 token 切分，size / overlap 为 token 数，每块不超过 max_tokens 个 token"""
         chunks = []
-        current_index = 0
+        for chunk in self._split_units(text, size, overlap, self.token_counter.token_offsets(text)):
+            # 块按全文编码的 token 边界截取，单独编码时边界处的合并结果可能略有不同，超限时截断
+            if self.token_counter.count(chunk) > self.max_tokens:
+                chunk = self.token_counter.truncate(chunk, self.max_tokens)
+            chunks.append(chunk)
+        return chunks
+
+    def _split_units(self, text: str, size: int, overlap: int, offsets: Sequence[int]) -> List[str]:
+        """
+        按长度单位切分文本，offsets[k] 为第 k 个单位的起始字符位置（末尾为 len(text)）：
+        按字符切分时为 range(len(text) + 1)，按 token 切分时为各 token 的起始位置。
+        块的大小、重叠与分隔符搜索范围都按单位计算，分隔符的查找仍在字符上进行。
+        """
+        chunks = []
+        total = len(offsets) - 1
+        # 按字符切分时单位下标就是字符位置，不需要二分查找
+        char_units = isinstance(offsets, range)
+        current_unit = 0
+        # 搜索窗口长 overlap * 2 个单位，相邻块约前进 size - overlap 个单位。
+        # 窗口比步长短时（如默认的 500 / 50）相邻窗口互不重叠，直接扫描每个窗口最省；
+        # 否则各分隔符的位置随窗口右移增量扫描、复用，切分点通过二分查找确定
+        boundary_index: Optional[Dict[int, list]] = {} if overlap * 3 >= size else None
 
         # 1 & 2. 迭代进行切分，直到文本结束
-        while current_index < len(text):
+        while current_unit < total:
+            current_index = offsets[current_unit]
             # 计算当前块的理论结束位置 (不考虑重叠)
-            end_index = current_index + self.chunk_size
+            end_unit = current_unit + size
             
             # 确保当前块不超过文本长度
-            if end_index >= len(text):
+            if end_unit >= total:
                 chunks.append(text[current_index:])
                 break
+            end_index = offsets[end_unit]
 
             # 3. 寻找最佳切分点 (尽量在句子边界处)
-            # 我们在 [current_index, end_index] 区间内寻找切分点
-            
-            # 搜索范围：从当前块的末尾向前搜索
-            search_start = max(current_index, end_index - self.chunk_overlap * 2) 
-            
-            # 使用最高优先级的分隔符 (如 "\n\n", "\n", 句号)
-            best_split = -1
-            
-            for sep in self.separators[:-1]: # 排除最后的 "" 分隔符
-                # 使用正则表达式查找分隔符
-                try:
-                    match_iter = re.finditer(sep, text[search_start:end_index])
-                except Exception:
-                    # 如果正则表达式解析失败（例如遇到转义问题），跳过
-                    continue
-                
-                # 找到最靠后的一个分隔符，确保 chunk size 接近目标
-                last_match = None
-                for match in match_iter:
-                    last_match = match
-                
-                if last_match:
-                    # 计算实际切分位置：搜索起点 + 匹配到的位置 + 分隔符长度
-                    split_position = search_start + last_match.start() + len(last_match.group())
-                    
-                    if split_position <= end_index:
-                        best_split = split_position
-                        # 找到一个句边界分隔符后，就可以确定切分位置，跳出分隔符搜索
-                        break
+            # 搜索范围：从当前块的末尾向前 chunk_overlap * 2 个单位
+            search_start = offsets[max(current_unit, end_unit - overlap * 2)]
+            if boundary_index is None:
+                best_split = self._find_split_in_window(text, search_start, end_index)
+            else:
+                best_split = self._find_split(text, boundary_index, search_start, end_index)
             
             # 确定切分位置
-            if best_split != -1:
+            if best_split is not None:
                 chunk = text[current_index:best_split]
-                next_start_index = max(best_split - self.chunk_overlap, current_index + 1)
+                split_unit = best_split if char_units else bisect_left(offsets, best_split)
+                next_unit = max(split_unit - overlap, current_unit + 1)
             else:
                 # 如果在搜索范围内没有找到句子边界，则直接硬切到 chunk_size 处
                 chunk = text[current_index:end_index]
-                next_start_index = end_index - self.chunk_overlap
+                # chunk_overlap 不小于 chunk_size 时至少前进一个单位，避免死循环
+                next_unit = max(end_unit - overlap, current_unit + 1)
             
             # 确保切分出的块不为空
             if chunk.strip():
                 chunks.append(chunk.strip())
             
             # 更新下一个块的起始位置 (考虑重叠)
-            current_index = next_start_index
+            current_unit = next_unit
 
         return chunks
 
-    def split_documents(self, documents: List[Dict[str, any]]) -> List[Dict[str, any]]:
-        """切分多个文档，并对 PDF/PPTX 中的图片进行文本化处理。"""
+    def split_documents(self, documents: List[Dict[str, any]], show_progress: bool = True) -> List[Dict[str, any]]:
+        """切分多个文档，并对 PDF/PPTX 中的图片进行文本化处理。show_progress 控制进度条与汇总输出。"""
         chunks_with_metadata = []
 
-        # 新增一个进度条，用于处理图片（这可能是最耗时的部分）
+        # 图片描述是最耗时的部分：先收集所有页面的图片，一次性并发处理（已缓存的图片直接复用）
+        image_docs = [
+            doc for doc in documents
+            if doc.get("filetype", "") in [".pdf", ".pptx"] and doc.get("images")
+        ]
+        all_image_paths = [img['path'] for doc in image_docs for img in doc['images']]
+
+        # 预过滤：跳过微小、近空白图片，近似重复的图片复用保留图片的描述
+        skipped: Dict[str, str] = {}
+        duplicates: Dict[str, str] = {}
+        if self.image_filter is not None and all_image_paths:
+            filtered = self.image_filter.filter(all_image_paths)
+            skipped, duplicates = filtered["skipped"], filtered["duplicates"]
+            stats = filtered["stats"]
+            if show_progress or stats["total"] > len(filtered["kept"]):
+                print(
+                    f"🧹 图片预过滤：共 {stats['total']} 张，保留 {len(filtered['kept'])} 张，"
+                    f"跳过小图 {stats['too_small']} / 近空白 {stats['blank']} / "
+                    f"无法读取 {stats['unreadable']} / 近似重复 {stats['near_duplicate']}"
+                )
+            all_image_paths = filtered["kept"]
+
+        # 同一文件中重复出现的图片（按内容哈希存储，路径相同）只在首次出现的页面附完整描述，
+        # 之前批次已描述过的图片不再请求描述
+        first_seen = self.image_first_seen
+        needed = {
+            duplicates.get(img['path'], img['path'])
+            for doc in image_docs for img in doc['images']
+            if (doc.get("filepath", ""), duplicates.get(img['path'], img['path'])) not in first_seen
+        }
+        all_image_paths = [path for path in all_image_paths if path in needed]
+        page_groups = [[img['path'] for img in doc['images'] if img['path'] in needed] for doc in image_docs]
+        captions = self.image_processor.caption_images(
+            all_image_paths, show_progress=show_progress, page_groups=page_groups
+        )
+
         processed_docs = []
-        for doc in tqdm(documents, desc="图像和文本预处理", unit="文档"):
+        for doc in tqdm(documents, desc="图像和文本预处理", unit="文档", disable=not show_progress):
             filetype = doc.get("filetype", "")
             
             # --- 多模态 RAG 升级核心逻辑 ---
             if filetype in [".pdf", ".pptx"] and doc.get("images"):
                 original_content = doc.get("content", "")
-                image_paths = [img['path'] for img in doc['images']]
+                image_paths = list(dict.fromkeys(
+                    duplicates.get(img['path'], img['path'])
+                    for img in doc['images'] if img['path'] not in skipped
+                ))
+                page_label = f"第 {doc.get('page_number', 0)} 页" if filetype == ".pdf" else f"幻灯片 {doc.get('page_number', 0)}"
+
+                references = {}
+                for path in image_paths:
+                    key = (doc.get("filepath", ""), path)
+                    if key in first_seen:
+                        references[path] = first_seen[key]
+                    elif not captions.get(path, "处理失败").startswith("处理失败"):
+                        first_seen[key] = page_label
                 
-                # 调用图像处理器，将图片路径列表转换为描述文本
-                # 图像处理器会返回一个描述所有图片的单个长字符串
-                image_text = self.image_processor.process_images_to_text(image_paths)
+                # 将本页图片的描述整理为单个长字符串
+                image_text = self.image_processor.format_captions(image_paths, captions, references)
                 
                 if image_text:
                     # 将图片描述文本追加到原始内容中，使用清晰的分隔符
@@ -122,24 +336,29 @@ class TextSplitter:
         
         # --------------------------------
 
-        for doc in tqdm(processed_docs, desc="文档切分", unit="文档块"):
+        for doc in tqdm(processed_docs, desc="文档切分", unit="文档块", disable=not show_progress):
             content = doc.get("content", "")
             filetype = doc.get("filetype", "")
             
             # PDF 和 PPTX 已经包含了文本化的图片信息，且我们仍然按页/幻灯片切分
             if filetype in [".pdf", ".pptx"]:
-                # PDF/PPTX 的 content 可能包含了图片分析文本
-                chunk_data = {
-                    "content": content, 
-                    "filename": doc.get("filename", "unknown"),
-                    "filepath": doc.get("filepath", ""),
-                    "filetype": filetype,
-                    "page_number": doc.get("page_number", 0),
-                    "chunk_id": 0,
-                    # 注意：此时的 images 字段仍然保留，但内容已体现在 content 中
-                    "images": doc.get("images", []), 
-                }
-                chunks_with_metadata.append(chunk_data)
+                # PDF/PPTX 的 content 可能包含了图片分析文本，超过 token 上限的页面再按 token 切分
+                if self.token_counter.count(content) > self.max_tokens:
+                    page_chunks = self._split_by_tokens(content, self.max_tokens, self.chunk_overlap)
+                else:
+                    page_chunks = [content]
+                for i, chunk in enumerate(page_chunks):
+                    chunk_data = {
+                        "content": chunk, 
+                        "filename": doc.get("filename", "unknown"),
+                        "filepath": doc.get("filepath", ""),
+                        "filetype": filetype,
+                        "page_number": doc.get("page_number", 0),
+                        "chunk_id": i,
+                        # 注意：此时的 images 字段仍然保留，但内容已体现在 content 中
+                        "images": doc.get("images", []), 
+                    }
+                    chunks_with_metadata.append(chunk_data)
 
             elif filetype in [".docx", ".txt"]:
                 # DOCX/TXT 进行二次文本切分
@@ -156,5 +375,6 @@ class TextSplitter:
                     }
                     chunks_with_metadata.append(chunk_data)
 
-        print(f"\n文档处理完成，共 {len(chunks_with_metadata)} 个块")
+        if show_progress:
+            print(f"\n文档处理完成，共 {len(chunks_with_metadata)} 个块")
         return chunks_with_metadata
\ No newline at end of file
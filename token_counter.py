@@ -0,0 +1,82 @@
+"""
+Token 计数
+优先使用 tiktoken 的 BPE 编码（默认 cl100k_base，与 Embedding 模型的分词结果接近）；
+未安装 tiktoken 或编码文件无法加载（如离线环境）时退化为按字符计数。
+"""
+
+import threading
+from typing import List, Optional, Sequence
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+from config import TOKENIZER_ENCODING
+
+
+class TokenCounter:
+    """文本 token 计数器"""
+
+    def __init__(self, encoding_name: str = TOKENIZER_ENCODING):
+        self.encoding_name = encoding_name
+        self.encoding = None
+        if tiktoken is None:
+            print("⚠️ 未安装 tiktoken，按字符数估算 token")
+            return
+        try:
+            self.encoding = tiktoken.get_encoding(encoding_name)
+        except Exception as e:
+            print(f"⚠️ 分词器 {encoding_name} 加载失败，按字符数估算 token: {e}")
+
+    @property
+    def exact(self) -> bool:
+        """是否使用真实分词器计数"""
+        return self.encoding is not None
+
+    def _encode(self, text: str) -> List[int]:
+        # 文档中出现的 "<|endoftext|>" 等按普通文本处理
+        return self.encoding.encode(text, disallowed_special=())
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.encoding is None:
+            return len(text)
+        return len(self._encode(text))
+
+    def token_offsets(self, text: str) -> Sequence[int]:
+        """
+        返回每个 token 在 text 中的起始字符位置，末尾追加 len(text)，长度为 token 数 + 1，单调不减。
+        一个字符被编码为多个 token 时，这些 token 的起始位置相同。
+        """
+        if self.encoding is None or not text:
+            return range(len(text) + 1)
+        _, offsets = self.encoding.decode_with_offsets(self._encode(text))
+        offsets.append(len(text))
+        return offsets
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """截取不超过 max_tokens 个 token 的最长前缀（在字符边界处截断）"""
+        offsets = self.token_offsets(text)
+        if len(offsets) - 1 <= max_tokens:
+            return text
+        return text[:offsets[max_tokens]]
+
+
+_COUNTER: Optional[TokenCounter] = None
+_COUNTER_LOCK = threading.Lock()
+
+
+def get_token_counter() -> TokenCounter:
+    """进程内共享的计数器（分词器只加载一次）"""
+    global _COUNTER
+    if _COUNTER is None:
+        with _COUNTER_LOCK:
+            if _COUNTER is None:
+                _COUNTER = TokenCounter()
+    return _COUNTER
+
+
+def count_tokens(text: str) -> int:
+    return get_token_counter().count(text)
@@ -4,12 +4,8 @@ from typing import List, Dict, Any, TYPE_CHECKING
 from datetime import datetime
 import re
 
-try:
-    from tavily import TavilyClient
-except ImportError:
-    TavilyClient = None
-
-from config import TAVILY_API_KEY, OPENAI_API_KEY, OPENAI_API_BASE, MODEL_NAME
+from client_factory import get_tavily_client
+from config import MODEL_NAME
 
 if TYPE_CHECKING:
     from rag_agent import RAGAgent
@@ -147,7 +143,7 @@ class WebSearchTool:
 
     def __init__(self):
         try:
-            self.client = TavilyClient(api_key=TAVILY_API_KEY) if TavilyClient else None
+            self.client = get_tavily_client()
         except Exception as e:
             print(f"初始化Tavily客户端失败: {e}")
             self.client = None
@@ -1,16 +1,27 @@
 import os
-import joblib
+import json
+import hashlib
+import math
+import time
 import uuid
+import random
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from tqdm import tqdm
 
+import numpy as np
 import chromadb
 from chromadb.config import Settings
-from openai import OpenAI
+from openai import BadRequestError
 
-from langchain_core.documents import Document
-from langchain_community.retrievers import BM25Retriever 
+from embedding_cache import EmbeddingCache, QueryEmbeddingCache, get_embedding_cache
+from file_lock import FileLock
+from sparse_tokenizer import SparseTokenizer
+from token_counter import count_tokens
+from client_factory import get_openai_client, is_transient_error
 
 from config import (
     VECTOR_DB_PATH,
@@ -20,9 +31,491 @@ from config import (
     OPENAI_EMBEDDING_MODEL,
     TOP_K,
     RRF_K,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_BATCH_MAX_TOKENS,
+    EMBEDDING_MAX_CONCURRENCY,
+    EMBEDDING_MAX_RETRIES,
+    EMBEDDING_CACHE_ENABLED,
+    EMBEDDING_CACHE_DTYPE,
+    EMBEDDING_CACHE_MAX_MB,
+    QUERY_EMBEDDING_CACHE_SIZE,
+    QUERY_EMBEDDING_CACHE_TTL,
+    QUERY_EMBEDDING_CACHE_PERSIST,
+    BM25_K1,
+    BM25_B,
+    BM25_MERGE_SEGMENTS,
+    BM25_TOKENIZER,
+    BM25_REMOVE_STOPWORDS,
+    HYBRID_CANDIDATE_MULTIPLIER,
+    HYBRID_LEG_TIMEOUT,
+    HYBRID_SEARCH_WORKERS,
 )
 
-BM25_INDEX_PATH = os.path.join(VECTOR_DB_PATH, "bm25_index.joblib")
+BM25_INDEX_DIRNAME = "bm25_index"
+
+# 混合检索两路（dense / sparse）共享的线程池，避免每次查询创建线程
+_SEARCH_EXECUTOR = ThreadPoolExecutor(
+    max_workers=HYBRID_SEARCH_WORKERS, thread_name_prefix="hybrid-search"
+)
+
+
+class BM25Index:
+    """基于 NumPy 数组的 BM25 稀疏索引，支持增量追加与删除
+
+    基础分段以 CSR 格式保存为 .npy 文件，加载时使用内存映射，无需反序列化：
+        vocab.json                       词表（按字典序），下标即词项 ID
+        doc_ids.json                     内部文档序号 -> 文档 ID
+        term_indptr / post_docs / post_tfs   倒排表（按词项分组）
+        doc_indptr / doc_terms / doc_tfs     正排表（按文档分组，用于删除和合并）
+        doc_len / idf / norm                 文档长度、预计算的 IDF 与长度归一项
+    增量变更写成小的 JSON 分段（与之前的格式一致），在内存中以字典倒排表叠加；
+    分段数超过阈值时合并进新的基础分段。
+
+    文档只在入库时分词一次，词频随分段持久化，合并时直接复用；查询使用同一分词器。
+    manifest 中记录分词器签名，签名不一致时 needs_rebuild 为 True，需由调用方从原文重建。
+
+    多个进程可以共用同一索引目录：分段与基础分段使用不会冲突的随机文件名，写入时持有文件锁，
+    先重新读取 manifest 并回放其他进程新增的分段，再追加自己的分段；manifest 变化后 refresh 会同步到最新状态。
+    进程内请通过 get_bm25_index 共享同一实例。
+    """
+
+    def __init__(
+        self,
+        index_dir: str,
+        k1: float = BM25_K1,
+        b: float = BM25_B,
+        merge_threshold: int = BM25_MERGE_SEGMENTS,
+        tokenizer: Optional[SparseTokenizer] = None,
+    ):
+        self.index_dir = index_dir
+        self.k1 = k1
+        self.b = b
+        self.merge_threshold = merge_threshold
+        self.tokenizer = tokenizer or SparseTokenizer()
+        self.needs_rebuild = False
+        self._manifest_path = os.path.join(index_dir, "manifest.json")
+
+        self._base_name: Optional[str] = None
+        self._segments: List[str] = []
+        self._manifest_stamp: Optional[Tuple[int, int, int]] = None
+        self._reset_state()
+
+        os.makedirs(index_dir, exist_ok=True)
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(os.path.join(index_dir, ".lock"))
+        with self._lock:
+            self._refresh(force=True)
+
+    def _reset_state(self) -> None:
+        # 基础分段（只读数组）
+        self._vocab: Dict[str, int] = {}
+        self._vocab_terms: List[str] = []
+        self._base_doc_ids: List[str] = []
+        self._term_indptr = np.zeros(1, dtype=np.int64)
+        self._post_docs = np.zeros(0, dtype=np.int32)
+        self._post_tfs = np.zeros(0, dtype=np.float32)
+        self._doc_indptr = np.zeros(1, dtype=np.int64)
+        self._doc_terms = np.zeros(0, dtype=np.int32)
+        self._doc_tfs = np.zeros(0, dtype=np.float32)
+        self._doc_len = np.zeros(0, dtype=np.float32)
+        self._idf = np.zeros(0, dtype=np.float32)
+        self._norm = np.zeros(0, dtype=np.float32)
+        # 基础分段上的增量修正
+        self._base_alive = np.ones(0, dtype=bool)
+        self._base_dead_df = np.zeros(0, dtype=np.int32)
+        # 增量文档
+        self._delta_ids: List[Optional[str]] = []
+        self._delta_tfs: List[Optional[Dict[str, int]]] = []
+        self._delta_lens: List[int] = []
+        self._delta_postings: Dict[str, Dict[int, int]] = {}
+        # 文档 ID -> ("base" | "delta", 序号)
+        self._locations: Dict[str, Tuple[str, int]] = {}
+        self._total_len = 0.0
+        self._norm_cache: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self._locations)
+
+    @property
+    def _is_clean(self) -> bool:
+        """没有增量和删除时，可直接使用基础分段中预计算的 IDF 与长度归一项"""
+        return not self._delta_ids and bool(self._base_alive.all())
+
+    # ---------- 持久化 ----------
+
+    def _write_json(self, path: str, data: Any) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _save_manifest(self) -> None:
+        """写入 manifest（需持有文件锁，且内存状态已与磁盘上的 manifest 同步）"""
+        self._write_json(self._manifest_path, {
+            "base": self._base_name,
+            "segments": self._segments,
+            "k1": self.k1,
+            "b": self.b,
+            "tokenizer": self.tokenizer.signature,
+        })
+        self._manifest_stamp = self._stat_manifest()
+
+    def _stat_manifest(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(self._manifest_path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _append_segment(self, added: List[Dict[str, Any]], deleted: List[str]) -> None:
+        """把一次变更写成新分段并登记到 manifest（需持有文件锁），必要时触发合并"""
+        name = f"seg_{uuid.uuid4().hex}.json"
+        self._write_json(os.path.join(self.index_dir, name), {"add": added, "delete": deleted})
+        self._segments.append(name)
+        self._save_manifest()
+
+        if len(self._segments) > self.merge_threshold:
+            self.merge()
+
+    def refresh(self) -> None:
+        """manifest 被其他进程更新后，同步到磁盘上的最新状态"""
+        with self._lock:
+            try:
+                self._refresh()
+            except Exception as e:
+                print(f"⚠️ BM25 索引同步失败，继续使用当前状态: {e}")
+
+    def _refresh(self, force: bool = False) -> None:
+        """
+        manifest 未变化时直接返回；基础分段未变且本地分段是其前缀时只回放新增分段，否则整体重新加载。
+        调用方需持有 self._lock。
+        """
+        if not force and self._stat_manifest() == self._manifest_stamp:
+            return
+        with self._file_lock:
+            stamp = self._stat_manifest()
+            if stamp is None:
+                self._base_name, self._segments = None, []
+                self._reset_state()
+                self._manifest_stamp = None
+                return
+            with open(self._manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("tokenizer", "whitespace") != self.tokenizer.signature:
+                # 词频是按旧分词器统计的，不能与新查询混用
+                print(f"⚠️ BM25 索引分词器由 {manifest.get('tokenizer', 'whitespace')} 变为 {self.tokenizer.signature}，需要重建。")
+                self.needs_rebuild = True
+                self._base_name, self._segments = None, []
+                self._reset_state()
+                self._manifest_stamp = stamp
+                return
+
+            self.needs_rebuild = False
+            base_name = manifest.get("base")
+            segments = manifest.get("segments", [])
+            if force or base_name != self._base_name or segments[:len(self._segments)] != self._segments:
+                self._base_name, self._segments = base_name, []
+                self._reset_state()
+                if base_name:
+                    self._load_base(os.path.join(self.index_dir, base_name))
+            self._replay(segments[len(self._segments):])
+            self._manifest_stamp = stamp
+
+    def _replay(self, names: List[str]) -> None:
+        for name in names:
+            with open(os.path.join(self.index_dir, name), "r", encoding="utf-8") as f:
+                segment = json.load(f)
+            for doc_id in segment.get("delete", []):
+                self._remove(doc_id)
+            for doc in segment.get("add", []):
+                self._insert(doc["id"], doc["tf"], doc["len"])
+            self._segments.append(name)
+
+    def _load_base(self, base_dir: str) -> None:
+        """以内存映射方式加载基础分段"""
+        with open(os.path.join(base_dir, "vocab.json"), "r", encoding="utf-8") as f:
+            self._vocab_terms = json.load(f)
+        with open(os.path.join(base_dir, "doc_ids.json"), "r", encoding="utf-8") as f:
+            self._base_doc_ids = json.load(f)
+        self._vocab = {term: i for i, term in enumerate(self._vocab_terms)}
+
+        def _array(name: str, empty_dtype) -> np.ndarray:
+            path = os.path.join(base_dir, f"{name}.npy")
+            array = np.load(path, mmap_mode="r")
+            return array if array.size else np.zeros(array.shape, dtype=empty_dtype)
+
+        self._term_indptr = _array("term_indptr", np.int64)
+        self._post_docs = _array("post_docs", np.int32)
+        self._post_tfs = _array("post_tfs", np.float32)
+        self._doc_indptr = _array("doc_indptr", np.int64)
+        self._doc_terms = _array("doc_terms", np.int32)
+        self._doc_tfs = _array("doc_tfs", np.float32)
+        self._doc_len = _array("doc_len", np.float32)
+        self._idf = _array("idf", np.float32)
+        self._norm = _array("norm", np.float32)
+
+        n_docs = len(self._base_doc_ids)
+        self._base_alive = np.ones(n_docs, dtype=bool)
+        self._base_dead_df = np.zeros(len(self._vocab_terms), dtype=np.int32)
+        self._locations = {doc_id: ("base", i) for i, doc_id in enumerate(self._base_doc_ids)}
+        self._total_len = float(self._doc_len.sum())
+
+    def merge(self) -> None:
+        """将基础分段与所有增量合并为新的基础分段（CSR 数组），并清理旧文件"""
+        with self._lock, self._file_lock:
+            self._refresh()
+            self._merge_locked()
+
+    def _merge_locked(self) -> None:
+        n_base = len(self._base_doc_ids)
+        live_delta = [i for i, doc_id in enumerate(self._delta_ids) if doc_id is not None]
+
+        # 1. 新词表 = 基础词表 ∪ 增量词项
+        delta_terms = set()
+        for i in live_delta:
+            delta_terms.update(self._delta_tfs[i])
+        vocab_terms = sorted(set(self._vocab_terms) | delta_terms)
+        vocab = {term: i for i, term in enumerate(vocab_terms)}
+
+        # 2. 存活的基础文档：用正排表整体重映射词项 ID 和文档序号
+        entry_docs = np.repeat(np.arange(n_base, dtype=np.int64), np.diff(self._doc_indptr))
+        keep = self._base_alive[entry_docs] if n_base else np.zeros(0, dtype=bool)
+        new_doc_no = np.cumsum(self._base_alive) - 1
+        old_to_new = np.array([vocab[t] for t in self._vocab_terms], dtype=np.int32)
+
+        term_parts = [old_to_new[self._doc_terms[keep]] if keep.any() else np.zeros(0, dtype=np.int32)]
+        doc_parts = [new_doc_no[entry_docs[keep]].astype(np.int32)]
+        tf_parts = [np.asarray(self._doc_tfs[keep], dtype=np.float32)]
+        doc_ids = [doc_id for doc_id, alive in zip(self._base_doc_ids, self._base_alive) if alive]
+        doc_len = [np.asarray(self._doc_len[self._base_alive], dtype=np.float32)]
+
+        # 3. 增量文档（数量受合并阈值限制，逐个处理）
+        for i in live_delta:
+            doc_no = len(doc_ids)
+            tf = self._delta_tfs[i]
+            term_parts.append(np.array([vocab[t] for t in tf], dtype=np.int32))
+            doc_parts.append(np.full(len(tf), doc_no, dtype=np.int32))
+            tf_parts.append(np.array(list(tf.values()), dtype=np.float32))
+            doc_ids.append(self._delta_ids[i])
+            doc_len.append(np.array([self._delta_lens[i]], dtype=np.float32))
+
+        terms = np.concatenate(term_parts)
+        docs = np.concatenate(doc_parts)
+        tfs = np.concatenate(tf_parts)
+        lengths = np.concatenate(doc_len)
+        n_docs, n_terms = len(doc_ids), len(vocab_terms)
+
+        # 4. 构建倒排表与正排表
+        post_order = np.lexsort((docs, terms))
+        doc_order = np.lexsort((terms, docs))
+        term_indptr = np.concatenate([[0], np.cumsum(np.bincount(terms, minlength=n_terms))]).astype(np.int64)
+        doc_indptr = np.concatenate([[0], np.cumsum(np.bincount(docs, minlength=n_docs))]).astype(np.int64)
+
+        # 5. 预计算 IDF 与长度归一项
+        df = np.diff(term_indptr)
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avgdl = float(lengths.mean()) if n_docs else 1.0
+        norm = (self.k1 * (1 - self.b + self.b * lengths / (avgdl or 1.0))).astype(np.float32)
+
+        # 6. 写入新的基础分段目录，再原子切换 manifest
+        base_name = f"base_{uuid.uuid4().hex}"
+        base_dir = os.path.join(self.index_dir, base_name)
+        os.makedirs(base_dir, exist_ok=True)
+        arrays = {
+            "term_indptr": term_indptr,
+            "post_docs": docs[post_order],
+            "post_tfs": tfs[post_order],
+            "doc_indptr": doc_indptr,
+            "doc_terms": terms[doc_order],
+            "doc_tfs": tfs[doc_order],
+            "doc_len": lengths,
+            "idf": idf,
+            "norm": norm,
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(base_dir, f"{name}.npy"), array)
+        self._write_json(os.path.join(base_dir, "vocab.json"), vocab_terms)
+        self._write_json(os.path.join(base_dir, "doc_ids.json"), doc_ids)
+
+        old_base, old_segments = self._base_name, self._segments
+        self._base_name, self._segments = base_name, []
+        self._save_manifest()
+        self._remove_files(old_base, old_segments)
+
+        self._reset_state()
+        self._load_base(base_dir)
+        print(f"🗜️ BM25 索引已合并：{len(old_segments)} 个增量分段 -> 基础分段（{n_docs} 个文档，{n_terms} 个词项）")
+
+    def _remove_files(self, base_name: Optional[str], segments: List[str]) -> None:
+        if base_name:
+            shutil.rmtree(os.path.join(self.index_dir, base_name), ignore_errors=True)
+        for name in segments:
+            path = os.path.join(self.index_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def clear(self) -> None:
+        """清空索引及其所有分段文件（包括分词器变更后遗留的旧分段）"""
+        with self._lock, self._file_lock:
+            for name in os.listdir(self.index_dir):
+                if name.startswith("base_"):
+                    self._remove_files(name, [])
+                elif name.startswith("seg_"):
+                    self._remove_files(None, [name])
+            self._base_name, self._segments = None, []
+            self.needs_rebuild = False
+            self._reset_state()
+            self._save_manifest()
+
+    # ---------- 增量更新 ----------
+
+    def _insert(self, doc_id: str, tf: Dict[str, int], length: int) -> None:
+        if doc_id in self._locations:
+            self._remove(doc_id)
+        idx = len(self._delta_ids)
+        self._delta_ids.append(doc_id)
+        self._delta_tfs.append(tf)
+        self._delta_lens.append(length)
+        self._locations[doc_id] = ("delta", idx)
+        self._total_len += length
+        for term, count in tf.items():
+            self._delta_postings.setdefault(term, {})[idx] = count
+        self._norm_cache = None
+
+    def _remove(self, doc_id: str) -> bool:
+        location = self._locations.pop(doc_id, None)
+        if location is None:
+            return False
+        kind, idx = location
+        if kind == "base":
+            # 基础分段只读：打删除标记，并按正排表扣减文档频率
+            self._base_alive[idx] = False
+            start, end = self._doc_indptr[idx], self._doc_indptr[idx + 1]
+            self._base_dead_df[self._doc_terms[start:end]] += 1
+            self._total_len -= float(self._doc_len[idx])
+        else:
+            for term in self._delta_tfs[idx]:
+                postings = self._delta_postings.get(term)
+                if postings is not None:
+                    postings.pop(idx, None)
+                    if not postings:
+                        del self._delta_postings[term]
+            self._total_len -= self._delta_lens[idx]
+            self._delta_ids[idx] = None
+            self._delta_tfs[idx] = None
+        self._norm_cache = None
+        return True
+
+    def add_documents(self, ids: List[str], texts: List[str]) -> None:
+        """追加文档（ID 已存在时覆盖），只对新文档分词"""
+        added = []
+        for doc_id, text in zip(ids, texts):
+            tokens = self.tokenizer.tokenize(text)
+            tf: Dict[str, int] = {}
+            for token in tokens:
+                tf[token] = tf.get(token, 0) + 1
+            added.append({"id": doc_id, "tf": tf, "len": len(tokens)})
+        if not added:
+            return
+        # 先同步其他进程的变更，再应用并登记本次分段，保证各进程回放顺序一致
+        with self._lock, self._file_lock:
+            self._refresh()
+            for doc in added:
+                self._insert(doc["id"], doc["tf"], doc["len"])
+            self._append_segment(added, [])
+
+    def delete_documents(self, ids: List[str]) -> None:
+        """删除文档"""
+        with self._lock, self._file_lock:
+            self._refresh()
+            deleted = [doc_id for doc_id in ids if self._remove(doc_id)]
+            if deleted:
+                self._append_segment([], deleted)
+
+    # ---------- 检索 ----------
+
+    def document_frequency(self, term: str) -> int:
+        """包含该词项的存活文档数"""
+        df = len(self._delta_postings.get(term, ()))
+        tid = self._vocab.get(term)
+        if tid is not None:
+            df += int(self._term_indptr[tid + 1] - self._term_indptr[tid] - self._base_dead_df[tid])
+        return df
+
+    def idf(self, term: str) -> float:
+        """非负 BM25 IDF：log(1 + (N - df + 0.5) / (df + 0.5))"""
+        tid = self._vocab.get(term)
+        if tid is not None and self._is_clean:
+            return float(self._idf[tid])
+        df = self.document_frequency(term)
+        return math.log1p((len(self) - df + 0.5) / (df + 0.5))
+
+    def _doc_norms(self) -> np.ndarray:
+        """所有文档（基础 + 增量）的长度归一项 k1 * (1 - b + b * len / avgdl)"""
+        if self._is_clean:
+            return self._norm
+        if self._norm_cache is None:
+            avgdl = self._total_len / len(self) if len(self) else 1.0
+            lengths = np.concatenate([
+                np.asarray(self._doc_len, dtype=np.float32),
+                np.asarray(self._delta_lens, dtype=np.float32),
+            ])
+            self._norm_cache = (self.k1 * (1 - self.b + self.b * lengths / (avgdl or 1.0))).astype(np.float32)
+        return self._norm_cache
+
+    def search(self, query: str, top_k: int = TOP_K) -> List[Tuple[str, float]]:
+        """向量化打分，返回得分最高的 (文档 ID, BM25 得分) 列表"""
+        with self._lock:
+            return self._search(query, top_k)
+
+    def _search(self, query: str, top_k: int) -> List[Tuple[str, float]]:
+        if not len(self) or top_k <= 0:
+            return []
+
+        n_base = len(self._base_doc_ids)
+        norms = self._doc_norms()
+        scores = np.zeros(n_base + len(self._delta_ids), dtype=np.float32)
+
+        for term in set(self.tokenizer.tokenize(query)):
+            idf = self.idf(term)
+            tid = self._vocab.get(term)
+            if tid is not None:
+                start, end = self._term_indptr[tid], self._term_indptr[tid + 1]
+                docs = self._post_docs[start:end]
+                tfs = self._post_tfs[start:end]
+                scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norms[docs])
+            for idx, tf in self._delta_postings.get(term, {}).items():
+                scores[n_base + idx] += idf * tf * (self.k1 + 1) / (tf + norms[n_base + idx])
+
+        if n_base:
+            scores[:n_base][~self._base_alive] = 0.0
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        results = []
+        for idx in candidates:
+            doc_id = self._base_doc_ids[idx] if idx < n_base else self._delta_ids[idx - n_base]
+            results.append((doc_id, float(scores[idx])))
+        return results
+
+
+_BM25_INDEXES: Dict[str, BM25Index] = {}
+_BM25_INDEXES_LOCK = threading.Lock()
+
+
+def get_bm25_index(index_dir: str, tokenizer: Optional[SparseTokenizer] = None) -> BM25Index:
+    """进程内每个索引目录只加载一个 BM25Index，各会话的 VectorStore 共用"""
+    key = os.path.abspath(index_dir)
+    with _BM25_INDEXES_LOCK:
+        index = _BM25_INDEXES.get(key)
+        if index is None:
+            index = BM25Index(index_dir, tokenizer=tokenizer)
+            _BM25_INDEXES[key] = index
+    return index
+
 
 class VectorStore:
 
@@ -36,8 +529,26 @@ class VectorStore:
         self.db_path = db_path
         self.collection_name = collection_name
 
-        # 初始化OpenAI客户端
-        self.client = OpenAI(api_key=api_key, base_url=api_base)
+        # 获取共享的 OpenAI 客户端
+        self.client = get_openai_client(api_key=api_key, base_url=api_base)
+        # 批量向量化自行退避重试（见 _embed_batch），关闭 SDK 内置重试以免两层重试次数相乘；共用同一连接池
+        self.batch_client = self.client.with_options(max_retries=0)
+
+        # 初始化 Embedding 持久化缓存（清空 collection 时保留，重建索引可直接复用；进程内各会话共用一个实例）
+        self.embedding_cache: Optional[EmbeddingCache] = None
+        if EMBEDDING_CACHE_ENABLED:
+            self.embedding_cache = get_embedding_cache(
+                cache_dir=os.path.join(db_path, "embedding_cache"),
+                model=OPENAI_EMBEDDING_MODEL,
+                dtype=EMBEDDING_CACHE_DTYPE,
+                max_size_mb=EMBEDDING_CACHE_MAX_MB,
+            )
+
+        # 查询向量的进程内 LRU + TTL 缓存（出题、重复提问等场景会反复检索相同查询）
+        self.query_embedding_cache = QueryEmbeddingCache(
+            max_entries=QUERY_EMBEDDING_CACHE_SIZE,
+            ttl_seconds=QUERY_EMBEDDING_CACHE_TTL,
+        )
 
         # 初始化ChromaDB
         os.makedirs(db_path, exist_ok=True)
@@ -51,29 +562,39 @@ class VectorStore:
         )
         
         # 【优化 1：引入 BM25 检索器】
-        # BM25 检索器需要所有文档才能初始化，这里先初始化为 None。
-        self.bm25_retriever: Optional[BM25Retriever] = None
+        # 增量 BM25 索引：启动时回放磁盘上的分段，新增/删除只写增量分段；进程内各会话共用一个索引实例。
+        self.bm25_index_dir = os.path.join(db_path, BM25_INDEX_DIRNAME)
+        print("🚀 正在加载 BM25 稀疏索引...")
+        self.sparse_tokenizer = SparseTokenizer(
+            mode=BM25_TOKENIZER, remove_stopwords=BM25_REMOVE_STOPWORDS
+        )
+        try:
+            self.bm25_index = get_bm25_index(self.bm25_index_dir, tokenizer=self.sparse_tokenizer)
+            print(f"✅ BM25 索引加载完成，共 {len(self.bm25_index)} 个文档块。")
+        except Exception as e:
+            print(f"❌ BM25 索引加载失败，将从向量数据库重建: {e}")
+            shutil.rmtree(self.bm25_index_dir, ignore_errors=True)
+            self.bm25_index = get_bm25_index(self.bm25_index_dir, tokenizer=self.sparse_tokenizer)
 
-        # 【启动时尝试加载 BM25 索引】
-        if os.path.exists(BM25_INDEX_PATH):
-            print("🚀 正在加载已存在的 BM25 稀疏检索器...")
-            try:
-                # 尝试从磁盘加载索引
-                self.bm25_retriever = joblib.load(BM25_INDEX_PATH)
-                print("✅ BM25 检索器加载完成。")
-            except Exception as e:
-                print(f"❌ BM25 索引加载失败: {e}")
-                self.bm25_retriever = None
-        else:
-            print("⚠️ BM25 稀疏检索器文件不存在，需通过 add_documents 初始化。")
+        # 索引为空但 collection 中已有数据（旧版本索引格式或分词器配置变更），从 ChromaDB 重建一次
+        if self.bm25_index.needs_rebuild or (len(self.bm25_index) == 0 and self.collection.count() > 0):
+            self._rebuild_bm25_index()
 
 
-    def get_embedding(self, text: str) -> List[float]:
+    def get_embedding(self, text: str, use_cache: bool = True) -> List[float]:
         """获取文本的向量表示
 
         TODO: 使用OpenAI API获取文本的embedding向量
 
+        优先查询 Embedding 持久化缓存，未命中时才调用 API 并写回缓存。
+        use_cache 为 False 时不读写持久化缓存。
         """
+        use_cache = use_cache and self.embedding_cache is not None
+        if use_cache:
+            cached = self.embedding_cache.get(text)
+            if cached is not None:
+                return cached
+
         try:
             # 调用 OpenAI API 获取 embedding
             response = self.client.embeddings.create(
@@ -81,179 +602,292 @@ class VectorStore:
                 input=text
             )
             # 返回第一个（也是唯一的）embedding 向量
-            return response.data[0].embedding
+            embedding = response.data[0].embedding
+            if use_cache:
+                self.embedding_cache.put(text, embedding)
+            return embedding
         except Exception as e:
             print(f"获取 Embedding 失败: {e}")
             return []
 
-    def _initialize_bm25_retriever(self, lc_documents: List[Document]) -> None:
+    def _embed_query(self, query: str) -> List[float]:
         """
-        【优化 2：新增 BM25 初始化方法】
-        私有方法：使用所有 LangChain Document 对象初始化 BM25 稀疏检索器，并持久化到磁盘。
+        获取查询向量：进程内 LRU 缓存 -> 持久化缓存（可选） -> Embedding API。
+        新查询的向量延迟批量写入持久化缓存，检索路径上不同步写盘。
         """
-        if not lc_documents:
-             print("⚠️ 无法初始化 BM25 检索器：没有文档。")
-             return
+        cached = self.query_embedding_cache.get(query)
+        if cached is not None:
+            return cached
 
-        print("正在初始化 BM25 稀疏检索器...")
-        # 从文档列表中创建 BM25 索引
-        self.bm25_retriever = BM25Retriever.from_documents(lc_documents)
-        self.bm25_retriever.k = TOP_K 
-        print("✅ BM25 检索器初始化完成。")
+        persist = QUERY_EMBEDDING_CACHE_PERSIST and self.embedding_cache is not None
+        embedding = self.embedding_cache.get(query) if persist else None
+        if embedding is None:
+            embedding = self.get_embedding(query, use_cache=False)
+            if persist:
+                self.embedding_cache.put_deferred(query, embedding)
+        self.query_embedding_cache.put(query, embedding)
+        return embedding
 
-        # 【将 BM25 检索器持久化到磁盘】
-        try:
-            joblib.dump(self.bm25_retriever, BM25_INDEX_PATH)
-            print(f"💾 BM25 检索器已成功保存到 {BM25_INDEX_PATH}")
-        except Exception as e:
-            print(f"❌ 警告：BM25 检索器持久化失败: {e}")
+    @staticmethod
+    def _estimate_tokens(text: str) -> int:
+        """估算文本的 token 数（分词器不可用时按字符数计）"""
+        return count_tokens(text)
 
+    def _build_embedding_batches(self, texts: List[str]) -> List[Tuple[int, List[str]]]:
+        """
+        按服务端限制（单次最多条数、单次最多 token）将文本分组。
+        返回 (起始下标, 文本列表) 的列表，起始下标用于把结果放回原位置。
+        空文本不参与请求，由调用方直接填充空向量。
+        """
+        batches = []
+        current: List[str] = []
+        current_start = 0
+        current_tokens = 0
 
-    def add_documents(self, chunks: List[Dict[str, Any]]) -> None:
-        """添加文档块到向量数据库
-        TODO: 实现文档块添加到向量数据库
-        要求：
-        1. 遍历文档块
-        2. 获取文档块内容
-        3. 获取文档块元数据
-        5. 打印添加进度
-        【优化 3：改造 add_documents】
-        添加文档块到向量数据库，并用于初始化 BM25 索引。
+        for i, text in enumerate(texts):
+            tokens = self._estimate_tokens(text)
+            if current and (
+                len(current) >= EMBEDDING_BATCH_SIZE
+                or current_tokens + tokens > EMBEDDING_BATCH_MAX_TOKENS
+            ):
+                batches.append((current_start, current))
+                current, current_tokens = [], 0
+            if not current:
+                current_start = i
+            current.append(text)
+            current_tokens += tokens
+
+        if current:
+            batches.append((current_start, current))
+        return batches
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
         """
-        if not chunks:
-            print("没有文档块可以添加。")
-            return
+        对一个批次调用 Embedding API：
+        - 暂时性错误（限流、超时、连接失败、5xx）指数退避重试，重试耗尽后抛出；
+        - 请求参数错误（400）说明批次中有无法处理的输入，二分后分别请求以隔离该输入，
+          单条仍失败时该位置返回空向量，保证结果与输入一一对应；
+        - 其他错误（如鉴权失败）直接抛出，不再重试。
+        """
+        for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+            try:
+                response = self.batch_client.embeddings.create(
+                    model=OPENAI_EMBEDDING_MODEL,
+                    input=texts
+                )
+                # 按 index 排序，确保返回顺序与输入顺序一致
+                data = sorted(response.data, key=lambda item: item.index)
+                if len(data) != len(texts):
+                    raise ValueError(f"返回向量数 {len(data)} 与输入数 {len(texts)} 不一致")
+                return [item.embedding for item in data]
+            except BadRequestError as e:
+                if len(texts) == 1:
+                    print(f"⚠️ 文本无法向量化，已跳过: {e}")
+                    return [[]]
+                mid = len(texts) // 2
+                return self._embed_batch(texts[:mid]) + self._embed_batch(texts[mid:])
+            except Exception as e:
+                if not is_transient_error(e) or attempt >= EMBEDDING_MAX_RETRIES:
+                    print(f"批量获取 Embedding 失败（{len(texts)} 条）: {e}")
+                    raise
+                delay = 2 ** attempt + random.uniform(0, 1)
+                print(f"⏳ Embedding 请求失败（{e}），{delay:.1f} 秒后重试")
+                time.sleep(delay)
 
-        texts = [chunk['content'] for chunk in chunks]
-        metadatas = []
-        ids = []
-        lc_documents = [] # 新增：用于 BM25 索引的 LangChain 文档列表
+    def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """
+        批量获取文本向量：先查询持久化缓存，仅对未命中的文本按批次分组、
+        有限并发发送请求，并按输入顺序重组结果。
+        服务端拒绝的单条文本位置返回空列表，调用方需据此过滤对应的文档块；
+        鉴权失败、服务不可用等错误会取消剩余批次并抛出，已获取的向量仍会写入缓存。
+        """
+        embeddings: List[List[float]] = [[] for _ in texts]
+        non_empty = [i for i, text in enumerate(texts) if text and text.strip()]
 
-        # 批量获取 Embedding
-        print("正在批量获取 Embedding 向量...")
-        embeddings = []
-        for text in tqdm(texts, desc="获取向量"):
-            embeddings.append(self.get_embedding(text))
-        
-        # 准备 ChromaDB 数据和 LangChain Document 列表
-        for i, chunk in enumerate(chunks):
-            # 获取文档块元数据
-            metadata = {
-                "filename": chunk.get("filename"),
-                "filetype": chunk.get("filetype"),
-                "page_number": chunk.get("page_number"),
-                "chunk_id": chunk.get("chunk_id"),
-                "filepath": chunk.get("filepath"),
-            }
-            metadatas.append(metadata)
-
-            # 使用文件名、页码、块ID组合生成唯一ID
-            unique_id = f"{chunk.get('filename')}_{chunk.get('page_number')}_{chunk.get('chunk_id')}_{i}"
-            ids.append(unique_id)
-            
-            # 创建 LangChain Document 对象 (用于 BM25)
-            lc_doc = Document(page_content=chunk['content'], metadata=metadata)
-            lc_documents.append(lc_doc)
+        if self.embedding_cache is not None and non_empty:
+            cached = self.embedding_cache.get_many([texts[i] for i in non_empty])
+            for i, vector in zip(non_empty, cached):
+                if vector is not None:
+                    embeddings[i] = vector
+            misses = [i for i in non_empty if not embeddings[i]]
+            print(f"💾 Embedding 缓存命中 {len(non_empty) - len(misses)}/{len(non_empty)}")
+            non_empty = misses
+
+        if not non_empty:
+            return embeddings
 
+        batches = self._build_embedding_batches([texts[i] for i in non_empty])
 
-        # 批量添加文档块到 ChromaDB
-        print("正在批量添加文档块到 ChromaDB...")
         try:
-            self.collection.add(
-                embeddings=embeddings,
-                documents=texts,
-                metadatas=metadatas,
-                ids=ids
-            )
-            print(f"✅ 成功将 {len(ids)} 个文档块添加到向量数据库中。")
-            
-            # 初始化 BM25 检索器
-            self._initialize_bm25_retriever(lc_documents)
-            
-        except Exception as e:
-            print(f"❌ 添加文档到 ChromaDB 失败: {e}")
+            with ThreadPoolExecutor(max_workers=EMBEDDING_MAX_CONCURRENCY) as executor:
+                futures = {
+                    executor.submit(self._embed_batch, batch): start
+                    for start, batch in batches
+                }
+                try:
+                    for future in tqdm(as_completed(futures), total=len(futures), desc="获取向量", unit="批"):
+                        start = futures[future]
+                        for offset, vector in enumerate(future.result()):
+                            embeddings[non_empty[start + offset]] = vector
+                except Exception:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            if self.embedding_cache is not None:
+                self.embedding_cache.put_many([texts[i] for i in non_empty], [embeddings[i] for i in non_empty])
+                self.embedding_cache.flush()
 
+        return embeddings
 
-    def add_documents_incremental(self, chunks: List[Dict[str, str]]) -> bool:
-        """增量添加文档到向量数据库
+    def _rebuild_bm25_index(self) -> None:
+        """
+        【优化 2：BM25 索引重建】
+        私有方法：从 ChromaDB 读取全部文档块，全量重建 BM25 索引并合并为单一分段。
+        仅在索引缺失或损坏时使用，日常新增走增量路径。
+        """
+        print("🔄 正在从向量数据库重建 BM25 索引...")
+        all_chroma_docs = self.collection.get(include=['documents'])
+        self.bm25_index.clear()
+        self.bm25_index.add_documents(all_chroma_docs['ids'], all_chroma_docs['documents'])
+        self.bm25_index.merge()
+        print(f"✅ BM25 索引重建完成，共 {len(self.bm25_index)} 个文档块。")
 
-        参数:
-            chunks: 文档块列表，每个块包含content和metadata
+    @staticmethod
+    def _chunk_source(chunk: Dict[str, Any]) -> str:
+        """文档块的来源标识：优先使用文件路径，没有时使用文件名"""
+        return chunk.get("filepath") or chunk.get("filename") or "unknown"
 
-        返回:
-            bool: 是否添加成功
+    @classmethod
+    def make_chunk_id(cls, chunk: Dict[str, Any]) -> str:
+        """由来源、页码和内容生成确定性的文档块 ID，相同内容重复入库时 ID 不变"""
+        key = f"{cls._chunk_source(chunk)}\x00{chunk.get('page_number', 0)}\x00{chunk['content']}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _delete_stale_chunks(self, current: Dict[str, Dict[str, Any]]) -> None:
+        """
+        删除这些文档块所属文件中不在 current 内的旧文档块。
+        只按文件路径匹配：同名文件可能位于不同目录，没有路径的文档块不做清理。
+        """
+        for filepath in {chunk.get("filepath") for chunk in current.values()} - {None, ""}:
+            stale = [doc_id for doc_id in self.get_ids_by_filepath(filepath) if doc_id not in current]
+            if stale:
+                print(f"🧹 删除 {filepath} 中已过期的 {len(stale)} 个文档块")
+                self.delete_documents(stale)
+
+    def upsert_documents(
+        self,
+        chunks: List[Dict[str, Any]],
+        replace_sources: bool = False,
+        extra_metadata: Optional[Dict[str, Any]] = None,
+    ) -> List[str]:
+        """
+        按确定性 ID 写入文档块：已存在的 ID 直接跳过（不会重复获取向量），只写入新内容，
+        并同步追加到 BM25 索引。重复上传同一文件因此不会产生重复文档块。
+        replace_sources 为 True 时，新内容全部写入成功后，再删除这些文件（按 filepath 匹配）中不再出现的旧文档块（文件更新后重新上传的场景）。
+        返回未能写入的文档块 ID 列表（向量获取失败或写入出错），空列表表示全部写入成功；
+        失败的块可用同样的输入重新调用写入，已写入的块会被跳过。
         """
         if not chunks:
-            print("没有文档块需要添加")
-            return True
+            print("没有文档块需要写入")
+            return []
 
+        # 计算 ID，并去掉同一批次中内容完全相同的块
+        unique: Dict[str, Dict[str, Any]] = {}
+        for chunk in chunks:
+            if chunk.get("content", "").strip():
+                unique.setdefault(self.make_chunk_id(chunk), chunk)
+
+        new_items: List[Tuple[str, Dict[str, Any]]] = []
         try:
-            # 获取现有文档数量，用于生成新ID
-            current_count = self.collection.count()
-
-            texts = [chunk['content'] for chunk in chunks]
-            metadatas = []
-            ids = []
-            new_lc_documents = [] # 新增：用于增量更新 BM25
-
-            # 批量获取embeddings（复用现有的get_embedding方法）
-            print(f"正在向量化 {len(texts)} 个新文档块...")
-            embeddings = []
-            for i, text in enumerate(texts):
-                if (i + 1) % 10 == 0:  # 每10个显示一次进度
-                    print(f"已处理 {i + 1}/{len(texts)} 个文档块")
-                embeddings.append(self.get_embedding(text))
-
-            # 准备metadata和IDs
-            for i, chunk in enumerate(chunks):
+            existing = set(self.collection.get(ids=list(unique), include=[])["ids"]) if unique else set()
+            new_items = [(doc_id, chunk) for doc_id, chunk in unique.items() if doc_id not in existing]
+            if existing:
+                print(f"⏭️ 跳过 {len(existing)} 个已存在的文档块")
+            if not new_items:
+                if replace_sources:
+                    self._delete_stale_chunks(unique)
+                return []
+
+            print(f"正在向量化 {len(new_items)} 个新文档块...")
+            all_embeddings = self.get_embeddings([chunk["content"] for _, chunk in new_items])
+
+            ids, texts, embeddings, metadatas, failed_ids = [], [], [], [], []
+            for (doc_id, chunk), embedding in zip(new_items, all_embeddings):
+                # 向量获取失败的块整体跳过，保证 ids / 向量 / 文本一一对应
+                if not embedding:
+                    print(f"⚠️ 跳过向量获取失败的文档块: {chunk.get('filename')} 第 {chunk.get('page_number')} 页")
+                    failed_ids.append(doc_id)
+                    continue
                 metadata = {
-                    "filename": chunk.get("filename", "unknown"),
-                    "filetype": chunk.get("filetype", ""),
-                    "page_number": chunk.get("page_number", 0),
-                    "chunk_id": chunk.get("chunk_id", i),
-                    "filepath": chunk.get("filepath", ""),
-                    "added_at": datetime.now().isoformat(),  # 标记添加时间
-                    "added_incrementally": True  # 标记为增量添加
+                    "filename": chunk.get("filename") or "unknown",
+                    "filetype": chunk.get("filetype") or "",
+                    "page_number": chunk.get("page_number") or 0,
+                    "chunk_id": chunk.get("chunk_id") or 0,
+                    "filepath": chunk.get("filepath") or "",
                 }
+                metadata.update(extra_metadata or {})
+                ids.append(doc_id)
+                texts.append(chunk["content"])
+                embeddings.append(embedding)
                 metadatas.append(metadata)
 
-                # 生成唯一ID（避免与现有ID冲突）
-                unique_id = f"incremental_{current_count + i}_{uuid.uuid4().hex[:8]}"
-                ids.append(unique_id)
+            if not ids:
+                print("❌ 所有文档块的向量获取均失败，未添加任何内容。")
+                return failed_ids
 
-            # 批量添加到ChromaDB（复用现有的collection操作）
-            print(f"正在添加到向量数据库...")
+            print("正在批量添加文档块到 ChromaDB...")
             self.collection.add(
                 embeddings=embeddings,
                 documents=texts,
                 metadatas=metadatas,
                 ids=ids
             )
-
-            # 【增量更新 BM25 索引】
-            # 增量添加后需要重新构建整个 BM25 索引，以包含新文档
-            print("🔄 增量添加完成，正在重建 BM25 索引...")
-            
-            # 1. 从 ChromaDB 检索所有现有文档
-            all_chroma_docs = self.collection.get(
-                include=['documents', 'metadatas']
-            )
-            
-            # 2. 将所有文档转换为 LangChain Document 格式
-            all_lc_documents = [
-                Document(page_content=all_chroma_docs['documents'][i], metadata=all_chroma_docs['metadatas'][i])
-                for i in range(len(all_chroma_docs['documents']))
-            ]
-            
-            # 3. 使用所有文档重新初始化 BM25 检索器
-            self._initialize_bm25_retriever(all_lc_documents)
-            
-            print(f"✅ 增量添加成功：{len(ids)} 个文档块，BM25 索引已重建。")
-            return True
+            # 只对新文档块分词并写入一个增量分段
+            self.bm25_index.add_documents(ids, texts)
+            print(f"✅ 成功将 {len(ids)} 个文档块添加到向量数据库中。")
+            if failed_ids:
+                print(f"⚠️ {len(failed_ids)} 个文档块未写入，可重新写入补齐")
+            elif replace_sources:
+                # 新内容全部写入后才删除旧块，写入失败时来源仍保留原有文档块
+                self._delete_stale_chunks(unique)
+            return failed_ids
 
         except Exception as e:
-            print(f"❌ 增量添加失败: {e}")
-            return False
+            print(f"❌ 写入文档块失败: {e}")
+            # 出错前尚未确定需要写入哪些块时，视为全部失败
+            return [doc_id for doc_id, _ in new_items] or list(unique)
+
+    def add_documents(self, chunks: List[Dict[str, Any]]) -> bool:
+        """添加文档块到向量数据库
+        TODO: 实现文档块添加到向量数据库
+        要求：
+        1. 遍历文档块
+        2. 获取文档块内容
+        3. 获取文档块元数据
+        5. 打印添加进度
+        【优化 3：改造 add_documents】
+        添加文档块到向量数据库，并同步追加到 BM25 索引。返回是否写入成功。
+        文档块 ID 由内容确定，已存在的文档块会被跳过。全部文档块都写入时才返回 True。
+        """
+        return not self.upsert_documents(chunks)
+
+    def add_documents_incremental(self, chunks: List[Dict[str, str]]) -> bool:
+        """增量添加文档到向量数据库
+
+        参数:
+            chunks: 文档块列表，每个块包含content和metadata
+
+        返回:
+            bool: 是否全部添加成功
+        """
+        return not self.upsert_documents(
+            chunks,
+            extra_metadata={
+                "added_at": datetime.now().isoformat(),  # 标记添加时间
+                "added_incrementally": True  # 标记为增量添加
+            },
+        )
 
     def search_dense(self, query: str, top_k: int = TOP_K) -> List[Dict]:
         """搜索相关文档
@@ -268,8 +902,8 @@ class VectorStore:
         4. 返回格式化的结果列表
         """
 
-        # 1. 获取查询文本的 embedding 向量
-        query_embedding = self.get_embedding(query)
+        # 1. 获取查询文本的 embedding 向量（带查询缓存）
+        query_embedding = self._embed_query(query)
         
         if not query_embedding:
             return []
@@ -287,12 +921,14 @@ class VectorStore:
         # results 结构通常是嵌套列表，我们提取第一个结果集
         if results and results.get("documents"):
             
+            ids = results.get("ids", [[]])[0]
             documents = results.get("documents", [[]])[0]
             metadatas = results.get("metadatas", [[]])[0]
             distances = results.get("distances", [[]])[0]
             
-            for doc, meta, dist in zip(documents, metadatas, distances):
+            for doc_id, doc, meta, dist in zip(ids, documents, metadatas, distances):
                 formatted_results.append({
+                    "id": doc_id,
                     "content": doc,
                     "metadata": meta,
                     "distance": dist # 可以用于调试或排序
@@ -306,96 +942,134 @@ class VectorStore:
         【新增/辅助方法】实现纯粹的 BM25 稀疏检索。
         注意：该方法仅供内部使用或 RRF 融合调用。
         """
-        if self.bm25_retriever is None:
-            print("⚠️ 警告: BM25 检索器未初始化，无法执行稀疏检索。")
+        # 同步其他会话或 process_data.py 写入的增量分段
+        self.bm25_index.refresh()
+        if len(self.bm25_index) == 0:
+            print("⚠️ 警告: BM25 索引为空，无法执行稀疏检索。")
             return []
 
-        # BM25 返回 LangChain Document 对象，使用 invoke() 方法进行检索
-        self.bm25_retriever.k = top_k # 确保使用传入的 top_k
-        bm25_docs = self.bm25_retriever.invoke(query)
-        
-        # 格式化 LangChain Document 为 List[Dict] 格式
+        # BM25 索引只保存文档 ID，正文和元数据按 ID 从 ChromaDB 取回
+        hits = self.bm25_index.search(query, top_k=top_k)
+        if not hits:
+            return []
+
+        records = self.collection.get(
+            ids=[doc_id for doc_id, _ in hits],
+            include=['documents', 'metadatas']
+        )
+        by_id = {
+            doc_id: (doc, meta)
+            for doc_id, doc, meta in zip(records['ids'], records['documents'], records['metadatas'])
+        }
+
+        # 按 BM25 得分顺序格式化为 List[Dict]
         formatted_results = []
-        for doc in bm25_docs:
+        for doc_id, score in hits:
+            if doc_id not in by_id:
+                continue
+            doc, meta = by_id[doc_id]
             formatted_results.append({
-                "content": doc.page_content,
-                "metadata": dict(doc.metadata),
-                "distance": 0.0 # BM25 本身不提供距离或相关性分数，设为 0.0
+                "id": doc_id,
+                "content": doc,
+                "metadata": meta,
+                "distance": 0.0, # BM25 不提供距离，相关性见 score
+                "score": score,
             })
         return formatted_results
 
-    def search(self, query: str, top_k: int = TOP_K) -> List[Dict]:
+    def search(
+        self,
+        query: str,
+        top_k: int = TOP_K,
+        dense_k: Optional[int] = None,
+        sparse_k: Optional[int] = None,
+        timeout: float = HYBRID_LEG_TIMEOUT,
+    ) -> List[Dict]:
         """
         【优化 4：实现混合检索 (RRF 融合)】 结合稀疏检索和密集检索的结果，使用 RRF 算法重新排序。
+        两路检索在共享线程池中并发执行，总耗时约为 max(dense, sparse)。
+
+        参数:
+            dense_k / sparse_k: 各路召回的候选数，默认 top_k * HYBRID_CANDIDATE_MULTIPLIER
+            timeout: 单路超时时间（秒），超时或失败的一路被丢弃，退化为单路结果
         """
         # 检查 BM25 是否已初始化，如果未初始化则退化为纯向量搜索
-        if self.bm25_retriever is None:
-            print("⚠️ 警告: 正在进行纯向量搜索，BM25 检索器未初始化。")
+        self.bm25_index.refresh()
+        if len(self.bm25_index) == 0:
+            print("⚠️ 警告: 正在进行纯向量搜索，BM25 索引为空。")
             return self.search_dense(query, top_k=top_k)
 
-        # 1. 密集检索 (向量搜索) - 获取 Top_K * 2 的结果，留给 RRF 融合
-        dense_results = self.search_dense(query, top_k=top_k * 2) 
-        
-        # 2. 稀疏检索 (BM25 关键词搜索) - 获取 Top_K * 2 的结果
-        # BM25 返回 LangChain Document 对象，使用 invoke() 方法进行检索
-        bm25_docs = self.bm25_retriever.invoke(query)
-        
-        # 3. 融合 (Reciprocal Rank Fusion, RRF) 
-        fused_scores = {}
-        all_results_map = {} # 用于存储所有独特的文档块，方便查找
-
-        # 辅助函数：根据文件名、页码和块 ID 创建唯一键，用于融合
-        def _get_unique_key(item: Dict[str, Any]) -> str:
-            meta = item.get('metadata', {})
-            # 这里的键必须与 add_documents 中的 ID 生成逻辑一致
-            return f"{meta.get('filename')}_{meta.get('page_number')}_{meta.get('chunk_id')}"
-        
-        def _get_doc_key(doc: Document) -> str:
-             return f"{doc.metadata.get('filename')}_{doc.metadata.get('page_number')}_{doc.metadata.get('chunk_id')}"
-
-        # A. 处理密集检索结果
-        for i, item in enumerate(dense_results):
-            key = _get_unique_key(item)
-            rank = i + 1
-            score = 1 / (RRF_K + rank)
-            fused_scores[key] = fused_scores.get(key, 0) + score
-            all_results_map[key] = item
-            
-        # B. 处理稀疏检索结果
-        for i, doc in enumerate(bm25_docs):
-            key = _get_doc_key(doc)
-            rank = i + 1
-            score = 1 / (RRF_K + rank)
-            fused_scores[key] = fused_scores.get(key, 0) + score
-            
-            # 如果是 BM25 独有的结果，将其加入 map 中（需转换为 Dict 格式）
-            if key not in all_results_map:
-                 all_results_map[key] = {
-                    "content": doc.page_content,
-                    "metadata": dict(doc.metadata),
-                    "distance": 0.0 # RRF 融合后距离不再有意义
-                }
+        dense_k = dense_k or top_k * HYBRID_CANDIDATE_MULTIPLIER
+        sparse_k = sparse_k or top_k * HYBRID_CANDIDATE_MULTIPLIER
 
-        # 4. 排序和提取 Top-K 结果
-        
-        # 根据融合得分降序排列所有唯一的文档键
-        sorted_keys = sorted(fused_scores.keys(), key=lambda x: fused_scores[x], reverse=True)
-        
-        # 提取 Top-K 结果
-        final_results = []
-        for key in sorted_keys:
-            if len(final_results) >= top_k:
-                break
-            final_results.append(all_results_map[key])
-            
-        return final_results
+        # 1 & 2. 并发执行密集检索（Embedding + 向量查询）和稀疏检索（BM25）
+        futures = {
+            "dense": _SEARCH_EXECUTOR.submit(self.search_dense, query, dense_k),
+            "sparse": _SEARCH_EXECUTOR.submit(self.search_bm25, query, sparse_k),
+        }
+        wait(futures.values(), timeout=timeout)
+
+        leg_results: Dict[str, List[Dict]] = {}
+        for leg, future in futures.items():
+            if not future.done():
+                future.cancel()
+                print(f"⚠️ {leg} 检索超时（>{timeout}s），本次退化为单路结果。")
+                continue
+            try:
+                leg_results[leg] = future.result()
+            except Exception as e:
+                print(f"⚠️ {leg} 检索失败，本次退化为单路结果: {e}")
+
+        if len(leg_results) < 2:
+            single = next(iter(leg_results.values()), [])
+            return single[:top_k]
+
+        # 3. 融合 (Reciprocal Rank Fusion, RRF)，两路结果都带有 ChromaDB 的文档 ID
+        fused_scores: Dict[str, float] = {}
+        all_results_map: Dict[str, Dict] = {} # 用于存储所有独特的文档块，方便查找
+
+        for results in (leg_results["dense"], leg_results["sparse"]):
+            for rank, item in enumerate(results, start=1):
+                key = item["id"]
+                fused_scores[key] = fused_scores.get(key, 0) + 1 / (RRF_K + rank)
+                # 同一文档块优先保留密集检索的结果（带有向量距离）
+                all_results_map.setdefault(key, item)
+
+        # 4. 排序和提取 Top-K 结果，score 字段为融合后的 RRF 得分
+        sorted_keys = sorted(fused_scores, key=lambda x: fused_scores[x], reverse=True)[:top_k]
+        return [dict(all_results_map[key], score=fused_scores[key]) for key in sorted_keys]
     
+    def get_ids_by_filepath(self, filepath: str) -> List[str]:
+        """查询某个源文件对应的全部文档块 ID"""
+        return self.collection.get(where={"filepath": filepath}, include=[])["ids"]
+
+    def delete_by_source(self, filepath: str) -> int:
+        """
+        删除某个源文件（按完整文件路径匹配，上传的文件为 uploaded://文件名）的全部文档块，
+        同时更新 BM25 索引，返回删除数量。不按文件名匹配，避免误删其他目录中的同名文件。
+        """
+        if not filepath:
+            raise ValueError("delete_by_source 需要文件路径")
+        ids = self.get_ids_by_filepath(filepath)
+        self.delete_documents(ids)
+        if ids:
+            print(f"🗑️ 已删除 {filepath} 的 {len(ids)} 个文档块")
+        return len(ids)
+
+    def delete_documents(self, ids: List[str]) -> None:
+        """按 ID 删除文档块，同时从 ChromaDB 和 BM25 索引中移除"""
+        if not ids:
+            return
+        self.collection.delete(ids=ids)
+        self.bm25_index.delete_documents(ids)
+
     def clear_collection(self) -> None:
         """清空collection"""
         self.chroma_client.delete_collection(name=self.collection_name)
         self.collection = self.chroma_client.create_collection(
             name=self.collection_name, metadata={"description": "课程向量数据库"}
         )
+        self.bm25_index.clear()
         print("向量数据库已清空")
 
     def get_collection_count(self) -> int: